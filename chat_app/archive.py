@@ -0,0 +1,357 @@
+"""
+Retention and archival of old messages.
+
+Each room keeps messages in the Message table for `ChatRoom.retention_days`
+(or CHAT_RETENTION_DAYS); older ones are moved to append-only archive
+segments under CHAT_ARCHIVE_DIR, one file per room and month:
+
+    <room id>/<YYYY-MM>.seg   blocks: 4-byte length + zlib-compressed JSON rows
+    <room id>/<YYYY-MM>.idx   one fixed-size IndexEntry per block
+
+Rows keep their Fernet ciphertext, so nothing is decrypted to archive them.
+archive_room() moves a batch at a time: the blocks are appended and fsynced,
+the rows deleted in one short transaction, and only then are the blocks
+indexed. Readers only see indexed blocks. A crash in between leaves unindexed
+blocks at a segment's tail, which the next run indexes (their rows are gone)
+or truncates (their rows are still live and will be archived again).
+
+The history functions (chat_app.history) fall back to archived_page() and
+archived_since() once a cursor reaches past the live rows.
+"""
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .crypto import get_cipher
+from .models import ChatRoom, Message
+
+logger = logging.getLogger(__name__)
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+BLOCK_HEADER = struct.Struct('>I')
+# first/last (timestamp micros, id), first/last seq, offset, length
+_ENTRY = struct.Struct('>qqqqqqQI')
+
+
+class IndexEntry(namedtuple('IndexEntry', 'first_micros first_id last_micros last_id first_seq last_seq offset length')):
+    __slots__ = ()
+
+    @property
+    def first(self):
+        return self.first_micros, self.first_id
+
+    @property
+    def last(self):
+        return self.last_micros, self.last_id
+
+
+class RetentionBusy(Exception):
+    pass
+
+
+def _micros(timestamp):
+    return (timestamp - _EPOCH) // timedelta(microseconds=1)
+
+
+def _timestamp(micros):
+    return _EPOCH + timedelta(microseconds=micros)
+
+
+def _index_entry(rows, offset, length):
+    # Blocks hold rows in id order, which imported or backdated messages can
+    # take out of timestamp order, so the bounds are taken over all of them
+    first = min(rows, key=lambda row: (row[4], row[0]))
+    last = max(rows, key=lambda row: (row[4], row[0]))
+    seqs = [row[1] for row in rows if row[1] is not None]
+    return IndexEntry(
+        first[4], first[0], last[4], last[0], min(seqs, default=0), max(seqs, default=0), offset, length,
+    )
+
+
+class ArchiveStore:
+    """The archive segments under one directory."""
+
+    def __init__(self, root):
+        self.root = str(root)
+        # .idx path -> (size read, entries); the files only ever grow
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def _room_dir(self, room_id):
+        return os.path.join(self.root, str(int(room_id)))
+
+    def _paths(self, room_id, month):
+        base = os.path.join(self._room_dir(room_id), month)
+        return base + '.seg', base + '.idx'
+
+    def months(self, room_id):
+        try:
+            names = os.listdir(self._room_dir(room_id))
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-4] for name in names if name.endswith('.idx'))
+
+    def entries(self, room_id):
+        """(month, IndexEntry) for every indexed block of a room, oldest first."""
+        found = []
+        for month in self.months(room_id):
+            found.extend((month, entry) for entry in self._read_index(self._paths(room_id, month)[1]))
+        found.sort(key=lambda item: item[1].first)
+        return found
+
+    def _read_index(self, path):
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return []
+        size -= size % _ENTRY.size  # ignore a partly written entry
+        with self._lock:
+            cached = self._indexes.get(path)
+            if cached is not None and cached[0] == size:
+                return cached[1]
+        with open(path, 'rb') as index:
+            data = index.read(size)
+        entries = [IndexEntry(*_ENTRY.unpack_from(data, offset)) for offset in range(0, size, _ENTRY.size)]
+        with self._lock:
+            self._indexes[path] = (size, entries)
+        return entries
+
+    def read(self, room_id, month, entry):
+        """The rows of one block: [id, seq, user_id, username, micros, content] lists."""
+        with open(self._paths(room_id, month)[0], 'rb') as segment:
+            segment.seek(entry.offset + BLOCK_HEADER.size)
+            return json.loads(zlib.decompress(segment.read(entry.length)))
+
+    def write_block(self, room_id, month, rows):
+        """
+        Append a block of rows (sorted by id) to a segment and fsync it.
+        Returns its IndexEntry; the block is invisible until commit() indexes it.
+        """
+        os.makedirs(self._room_dir(room_id), exist_ok=True)
+        data = zlib.compress(json.dumps(rows, separators=(',', ':')).encode('utf-8'), 6)
+        with open(self._paths(room_id, month)[0], 'ab') as segment:
+            offset = segment.tell()
+            segment.write(BLOCK_HEADER.pack(len(data)) + data)
+            segment.flush()
+            os.fsync(segment.fileno())
+        return _index_entry(rows, offset, len(data))
+
+    def commit(self, room_id, month, entry):
+        with open(self._paths(room_id, month)[1], 'ab') as index:
+            index.write(_ENTRY.pack(*entry))
+            index.flush()
+            os.fsync(index.fileno())
+
+    def recover(self, room_id, still_live):
+        """
+        Settle blocks left unindexed by an interrupted run: index them if
+        `still_live(ids)` is false (their rows were deleted), else cut them off.
+        """
+        for month in self.months(room_id) + self._unindexed_months(room_id):
+            segment_path, index_path = self._paths(room_id, month)
+            entries = self._read_index(index_path)
+            end = entries[-1].offset + BLOCK_HEADER.size + entries[-1].length if entries else 0
+            try:
+                size = os.path.getsize(segment_path)
+            except FileNotFoundError:
+                continue
+            while end < size:
+                with open(segment_path, 'rb') as segment:
+                    segment.seek(end)
+                    header = segment.read(BLOCK_HEADER.size)
+                    length = BLOCK_HEADER.unpack(header)[0] if len(header) == BLOCK_HEADER.size else None
+                    data = segment.read(length) if length is not None else b''
+                try:
+                    rows = json.loads(zlib.decompress(data)) if length is not None and len(data) == length else None
+                except (zlib.error, ValueError):
+                    rows = None
+                if not rows or still_live([row[0] for row in rows]):
+                    logger.warning("Truncating %s at %d: unfinished archive block", segment_path, end)
+                    with open(segment_path, 'r+b') as segment:
+                        segment.truncate(end)
+                    break
+                self.commit(room_id, month, _index_entry(rows, end, length))
+                end += BLOCK_HEADER.size + length
+
+    def _unindexed_months(self, room_id):
+        try:
+            names = os.listdir(self._room_dir(room_id))
+        except FileNotFoundError:
+            return []
+        indexed = set(self.months(room_id))
+        return sorted(name[:-4] for name in names if name.endswith('.seg') and name[:-4] not in indexed)
+
+    @contextmanager
+    def locked(self):
+        """Exclusive across processes: one retention run at a time per archive."""
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, '.lock'), 'w') as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise RetentionBusy(f"Another retention run holds {self.root}")
+            yield
+
+
+_store = None
+
+
+def get_archive_store():
+    """The process-wide ArchiveStore for CHAT_ARCHIVE_DIR."""
+    global _store
+    root = str(getattr(settings, 'CHAT_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'archive')))
+    if _store is None or _store.root != root:
+        _store = ArchiveStore(root)
+    return _store
+
+
+# -- Reading ---------------------------------------------------------------------
+
+def _entries_from(rows):
+    from .history import HistoryEntry
+
+    plaintexts = get_cipher().decrypt_many([row[5] for row in rows])
+    return [
+        HistoryEntry(row[0], row[2], row[3], plaintext, _timestamp(row[4]), row[1])
+        for row, plaintext in zip(rows, plaintexts)
+    ]
+
+
+def archived_page(room_id, before=None, after=None, limit=50):
+    """
+    (entries, has_more) from the archive, oldest first: the `limit` archived
+    messages just older than the `before` position or just newer than the
+    `after` position ((timestamp, id) tuples), or the newest ones with neither.
+    """
+    store = get_archive_store()
+    blocks = store.entries(room_id)
+    if not blocks:
+        return [], False
+    found = []
+    if after is not None:
+        position = (_micros(after[0]), after[1])
+        for month, entry in blocks:
+            if entry.last <= position:
+                continue
+            if len(found) > limit and entry.first > (found[limit][4], found[limit][0]):
+                continue
+            found.extend(row for row in store.read(room_id, month, entry) if (row[4], row[0]) > position)
+            found.sort(key=lambda row: (row[4], row[0]))
+        rows = found[:limit]
+    else:
+        position = (_micros(before[0]), before[1]) if before is not None else None
+        for month, entry in reversed(blocks):
+            if position is not None and entry.first >= position:
+                continue
+            if len(found) > limit and entry.last < (found[limit][4], found[limit][0]):
+                continue
+            found.extend(
+                row for row in store.read(room_id, month, entry)
+                if position is None or (row[4], row[0]) < position
+            )
+            found.sort(key=lambda row: (row[4], row[0]), reverse=True)
+        rows = found[:limit][::-1]
+    return _entries_from(rows), len(found) > limit
+
+
+def iter_archived(room_id):
+    """Every archived message of a room, oldest block first, as lists of (seq, username, timestamp, token)."""
+    store = get_archive_store()
+    for month, entry in store.entries(room_id):
+        yield [(row[1], row[3], _timestamp(row[4]), row[5]) for row in store.read(room_id, month, entry)]
+
+
+def archived_since(room_id, seq, limit=200):
+    """(entries, has_more): archived messages with a sequence number above `seq`, in order."""
+    store = get_archive_store()
+    found = []
+    for month, entry in sorted(store.entries(room_id), key=lambda item: item[1].first_seq):
+        if entry.last_seq <= seq:
+            continue
+        if len(found) > limit and entry.first_seq > found[limit][1]:
+            continue
+        found.extend(row for row in store.read(room_id, month, entry) if row[1] is not None and row[1] > seq)
+        found.sort(key=lambda row: row[1])
+    return _entries_from(found[:limit]), len(found) > limit
+
+
+# -- Retention -------------------------------------------------------------------
+
+def retention_days(room):
+    return room.retention_days if room.retention_days is not None else getattr(settings, 'CHAT_RETENTION_DAYS', None)
+
+
+def archive_room(room_id, cutoff, batch_size=500, pause=0.05, store=None):
+    """
+    Move a room's messages older than `cutoff` into the archive, `batch_size`
+    rows per delete transaction with `pause` seconds between batches so other
+    writers get the database lock. Returns the number of messages moved.
+    """
+    store = store or get_archive_store()
+    store.recover(room_id, lambda ids: Message.objects.filter(id__in=ids).exists())
+    moved = 0
+    while True:
+        rows = [
+            [pk, seq, user_id, username, _micros(timestamp), content]
+            for pk, seq, user_id, username, timestamp, content in Message.objects
+            .filter(room_id=room_id, timestamp__lt=cutoff)
+            .order_by('id')
+            .values_list('id', 'seq', 'user_id', 'user__username', 'timestamp', 'content')[:batch_size]
+        ]
+        if not rows:
+            return moved
+
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(_timestamp(row[4]).strftime('%Y-%m'), []).append(row)
+        written = [(month, store.write_block(room_id, month, month_rows)) for month, month_rows in by_month.items()]
+        with transaction.atomic():
+            Message.objects.filter(id__in=[row[0] for row in rows]).delete()
+        for month, entry in written:
+            store.commit(room_id, month, entry)
+
+        moved += len(rows)
+        if len(rows) < batch_size:
+            return moved
+        if pause:
+            time.sleep(pause)
+
+
+def apply_retention(now=None, room_names=None, batch_size=500, pause=0.05):
+    """
+    Archive every room's messages past its retention period. Returns
+    {room name: messages moved}. Raises RetentionBusy if another run holds the
+    archive.
+    """
+    now = now or timezone.now()
+    store = get_archive_store()
+    rooms = ChatRoom.objects.order_by('id')
+    if room_names:
+        rooms = rooms.filter(name__in=room_names)
+    moved = {}
+    with store.locked():
+        for room in rooms:
+            days = retention_days(room)
+            if days is None:
+                continue
+            count = archive_room(room.id, now - timedelta(days=days), batch_size=batch_size, pause=pause, store=store)
+            if count:
+                moved[room.name] = count
+    return moved
@@ -0,0 +1,258 @@
+"""
+Per-connection outbound queues with a high-water mark.
+
+ChatConsumer handles one event at a time, so a socket that is slow to accept
+frames used to hold up every event behind it while its channel-layer backlog
+grew. Frames now go into an OutboundQueue that a per-connection task drains
+into the socket, and the queued bytes are accounted per connection:
+
+* below `high_water` everything is queued;
+* past it, typing frames are dropped first (queued ones too), then history
+  pages are skipped; a page queued with a `notice` is replaced by that small
+  frame, so the client learns its request went unanswered and can ask again;
+* past `max_bytes` the queue is discarded and the connection is closed with
+  SLOW_CONSUMER_CLOSE_CODE, so the memory a connection can hold is bounded.
+
+A single frame is always accepted into an empty queue, whatever its size.
+Counters for all of this are kept in `stats` (see get_outbound_stats).
+
+The queue only sees frames the ASGI server hasn't accepted yet. Servers with
+WebSocket flow control (uvicorn, hypercorn) make send() wait on a slow
+socket. Daphne accepts every send at once and buffers it in its Twisted
+transport, so TransportFlowMiddleware registers a TransportFlow with that
+transport, and the drain task waits while the transport's write buffer is
+over its limit. Under other servers the scope has no flow, and
+send() itself is what waits.
+"""
+import asyncio
+import logging
+from collections import deque
+from functools import partial
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Also used when the channel layer gives up on a connection's backlog
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+TYPING = 'typing'
+HISTORY = 'history'
+MESSAGE = 'message'
+
+
+class OutboundStats:
+    """Process-wide counters across every OutboundQueue."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.queued_bytes = 0
+        self.peak_connection_bytes = 0
+        self.typing_dropped = 0
+        self.history_skipped = 0
+        self.high_water_crossings = 0
+        self.evicted = 0
+
+    def as_dict(self):
+        return {
+            'queued_bytes': self.queued_bytes,
+            'peak_connection_bytes': self.peak_connection_bytes,
+            'typing_dropped': self.typing_dropped,
+            'history_skipped': self.history_skipped,
+            'high_water_crossings': self.high_water_crossings,
+            'evicted': self.evicted,
+        }
+
+
+stats = OutboundStats()
+
+
+def get_outbound_stats():
+    return stats.as_dict()
+
+
+class TransportFlow:
+    """
+    Write-side flow control of one server transport, as a Twisted push
+    producer: the transport pauses it once its write buffer is over the limit
+    and resumes it when the buffer has drained. The calls are passed on to the
+    producer it replaced, if any.
+    """
+
+    def __init__(self, previous=None):
+        self.previous = previous
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    def pauseProducing(self):
+        self._writable.clear()
+        if self.previous is not None:
+            self.previous.pauseProducing()
+
+    def resumeProducing(self):
+        self._writable.set()
+        if self.previous is not None:
+            self.previous.resumeProducing()
+
+    def stopProducing(self):
+        # The connection is gone; sends to it are dropped by the server
+        self._writable.set()
+        if self.previous is not None:
+            self.previous.stopProducing()
+
+    async def wait(self):
+        await self._writable.wait()
+
+
+def server_flow(send):
+    """
+    A TransportFlow for the connection behind the server's ASGI `send`, or
+    None if the server doesn't expose its transport. Daphne hands each
+    application `partial(server.handle_reply, protocol)`. After the upgrade,
+    the protocol's Twisted transport still has Daphne's HTTP channel as its
+    producer, so the flow takes that producer's place and passes it every call.
+    """
+    protocol = send.args[0] if isinstance(send, partial) and send.args else None
+    transport = getattr(protocol, 'transport', None)
+    if not hasattr(transport, 'registerProducer'):
+        return None
+    previous = getattr(transport, 'producer', None)
+    if previous is not None:
+        transport.unregisterProducer()
+    flow = TransportFlow(previous)
+    transport.registerProducer(flow, True)
+    return flow
+
+
+class TransportFlowMiddleware:
+    """
+    Outermost ASGI middleware that puts the connection's TransportFlow (or
+    None) in the scope as 'transport_flow'. It has to see the server's own
+    `send`, before session middleware wraps it.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'websocket':
+            scope = dict(scope, transport_flow=server_flow(send))
+        return await self.inner(scope, receive, send)
+
+
+class OutboundQueue:
+    """
+    Outbound frames of one connection, drained in order by a task that awaits
+    `send(text_data=..., bytes_data=...)`. Every frame has a kind (MESSAGE,
+    HISTORY or TYPING) that decides what is shed first under backpressure.
+    With a TransportFlow, frames stay queued while the server's transport is
+    full.
+    """
+
+    def __init__(self, send, high_water=64 * 1024, max_bytes=256 * 1024, flow=None):
+        self.high_water = high_water
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.flow = flow
+        self._send = send
+        self._frames = deque()
+        self._task = None
+        self._over = False
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, kind, text_data=None, bytes_data=None, notice=None):
+        """
+        Queue a frame. A HISTORY frame may carry `notice`, a short text frame
+        sent in its place if it is skipped. Returns False if the backlog went
+        past `max_bytes`: the queue has then been discarded and the caller must
+        close the connection.
+        """
+        size = len(text_data) if text_data is not None else len(bytes_data)
+        if self.size and self.size + size > self.high_water:
+            if not self._over:
+                self._over = True
+                stats.high_water_crossings += 1
+            if kind == TYPING:
+                stats.typing_dropped += 1
+                return True
+            self._shed(TYPING)
+            if self.size + size > self.high_water:
+                if kind == HISTORY:
+                    stats.history_skipped += 1
+                    return notice is None or self.put(MESSAGE, notice)
+                self._shed(HISTORY)
+            if self.size + size > self.max_bytes:
+                stats.evicted += 1
+                self.discard()
+                return False
+
+        self._frames.append((kind, text_data, bytes_data, size, notice))
+        self.size += size
+        stats.queued_bytes += size
+        stats.peak_connection_bytes = max(stats.peak_connection_bytes, self.size)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._drain())
+        return True
+
+    def discard(self):
+        """Drop everything queued and stop draining (the connection is going away)."""
+        for frame in self._frames:
+            self._release(frame[3])
+        self._frames.clear()
+        if self._task is not None and not self._task.done() and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    async def _drain(self):
+        while self._frames:
+            if self.flow is not None:
+                await self.flow.wait()
+                if not self._frames:
+                    break
+            _, text_data, bytes_data, size, _ = self._frames.popleft()
+            try:
+                await self._send(text_data=text_data, bytes_data=bytes_data)
+            except Exception:
+                logger.debug("Outbound send failed; dropping the queue", exc_info=True)
+                self.discard()
+                return
+            finally:
+                self._release(size)
+            if self.size <= self.high_water:
+                self._over = False
+
+    def _shed(self, kind):
+        kept = deque()
+        for frame in self._frames:
+            if frame[0] == kind:
+                self._release(frame[3])
+                if kind == TYPING:
+                    stats.typing_dropped += 1
+                else:
+                    stats.history_skipped += 1
+                    notice = frame[4]
+                    if notice is not None:
+                        # Keeps the skipped page's place in the stream
+                        kept.append((MESSAGE, notice, None, len(notice), None))
+                        self.size += len(notice)
+                        stats.queued_bytes += len(notice)
+            else:
+                kept.append(frame)
+        self._frames = kept
+
+    def _release(self, size):
+        self.size -= size
+        stats.queued_bytes -= size
+
+
+def outbound_queue(send, flow=None):
+    """An OutboundQueue sized from settings."""
+    return OutboundQueue(
+        send,
+        high_water=getattr(settings, 'CHAT_OUTBOUND_HIGH_WATER', 64 * 1024),
+        max_bytes=getattr(settings, 'CHAT_OUTBOUND_MAX_BYTES', 256 * 1024),
+        flow=flow,
+    )
@@ -0,0 +1,324 @@
+"""
+In-process WebSocket load generator for ChatConsumer.
+
+Drives the real ASGI application (config.asgi) with simulated clients. Each
+client connects with a genuine session cookie, joins one of the rooms and
+then sends chat messages and typing frames at Poisson-distributed intervals
+while reading everything the server pushes to it. run_benchmark() returns a
+plain dict (ack and fan-out latency percentiles, throughput, memory per
+connection) that can be dumped as JSON and compared across commits; see
+`python manage.py chat_benchmark`.
+
+Clients and server share one process and one event loop, so absolute
+numbers include the clients' own overhead. Compare runs made with the same
+options on the same machine.
+"""
+import asyncio
+import json
+import random
+import time
+import tracemalloc
+from datetime import timedelta
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from . import wire
+from .models import ChatRoom
+
+BACKEND = 'django.contrib.auth.backends.ModelBackend'
+
+
+def percentiles(samples):
+    """p50/p90/p99/max/mean of a list of milliseconds (nearest rank), or None if empty."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+    return {
+        'p50': round(rank(50), 3),
+        'p90': round(rank(90), 3),
+        'p99': round(rank(99), 3),
+        'max': round(ordered[-1], 3),
+        'mean': round(sum(ordered) / len(ordered), 3),
+        'count': len(ordered),
+    }
+
+
+def _rss_bytes():
+    """Resident set size from /proc (Linux only), or None."""
+    if resource is None:
+        return None
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def create_fixtures(prefix, clients, rooms):
+    """Users with ready-made sessions, and rooms. Returns (session keys, room names)."""
+    users = User.objects.bulk_create(
+        [User(username=f'{prefix}-user-{i}', password='!') for i in range(clients)]
+    )
+    if any(user.pk is None for user in users):
+        users = list(User.objects.filter(username__startswith=f'{prefix}-user-').order_by('id'))
+    ChatRoom.objects.bulk_create([ChatRoom(name=f'{prefix}-room-{i}') for i in range(rooms)])
+
+    store = SessionStore()
+    expires = timezone.now() + timedelta(days=1)
+    sessions = [
+        Session(
+            session_key=get_random_string(32),
+            session_data=store.encode({
+                SESSION_KEY: str(user.pk),
+                BACKEND_SESSION_KEY: BACKEND,
+                HASH_SESSION_KEY: user.get_session_auth_hash(),
+            }),
+            expire_date=expires,
+        )
+        for user in users
+    ]
+    Session.objects.bulk_create(sessions)
+    return [session.session_key for session in sessions], [f'{prefix}-room-{i}' for i in range(rooms)]
+
+
+def delete_fixtures(prefix, session_keys):
+    Session.objects.filter(session_key__in=session_keys).delete()
+    User.objects.filter(username__startswith=f'{prefix}-user-').delete()
+    ChatRoom.objects.filter(name__startswith=f'{prefix}-room-').delete()
+
+
+class Recorder:
+    def __init__(self):
+        self.measure_from = None
+        self.ack_latencies = []
+        self.fanout_latencies = []
+        self.sent = 0
+        self.acked = 0
+        self.typing_sent = 0
+        self.deliveries = 0
+        self.typing_snapshots = 0
+        self.errors = 0
+        self.closed_by_server = 0
+
+    def in_window(self, sent_ns):
+        return self.measure_from is not None and sent_ns >= self.measure_from
+
+
+class SimulatedClient:
+    def __init__(self, index, application, room, session_key, binary, recorder, message_size):
+        self.index = index
+        self.binary = binary
+        self.recorder = recorder
+        self.message_size = message_size
+        self.communicator = WebsocketCommunicator(
+            application,
+            f'/ws/chat/{room}/',
+            headers=[(b'cookie', f'sessionid={session_key}'.encode()), (b'host', b'localhost')],
+            subprotocols=[wire.SUBPROTOCOL] if binary else None,
+        )
+        self.pending = {}
+        self.usernames = {}
+        self.counter = 0
+        self.reader = None
+
+    async def connect(self, timeout):
+        connected, _ = await self.communicator.connect(timeout=timeout)
+        if connected:
+            self.reader = asyncio.ensure_future(self.read())
+        return connected
+
+    async def drive(self, deadline, rate, typing_rate, rng):
+        total = rate + typing_rate
+        if total <= 0:
+            return
+        while True:
+            delay = rng.expovariate(total)
+            if time.monotonic() + delay >= deadline:
+                return
+            await asyncio.sleep(delay)
+            if rng.random() * total < rate:
+                await self.send_message()
+            else:
+                await self.send_typing()
+
+    async def send_message(self):
+        self.counter += 1
+        client_msg_id = f'{self.index}-{self.counter}'
+        sent_ns = time.perf_counter_ns()
+        # The send time rides in the message so receivers can time the fan-out
+        message = f'{sent_ns} '.ljust(self.message_size, 'x')
+        payload = {'type': 'chat_message', 'message': message, 'client_msg_id': client_msg_id}
+        self.pending[client_msg_id] = sent_ns
+        if self.recorder.in_window(sent_ns):
+            self.recorder.sent += 1
+        await self._send(payload)
+
+    async def send_typing(self):
+        self.recorder.typing_sent += 1
+        await self._send({'type': 'typing', 'is_typing': True})
+
+    async def _send(self, payload):
+        if self.binary:
+            await self.communicator.send_to(bytes_data=wire.encode_client(payload))
+        else:
+            await self.communicator.send_to(text_data=json.dumps(payload))
+
+    async def read(self):
+        recorder = self.recorder
+        # receive_output() would kill the application on a timeout; read the queue directly
+        queue = self.communicator.output_queue
+        while True:
+            output = await queue.get()
+            now = time.perf_counter_ns()
+            if output['type'] == 'websocket.close':
+                recorder.closed_by_server += 1
+                return
+            if output.get('bytes') is not None:
+                data = wire.decode_server(output['bytes'], self.usernames)
+            else:
+                data = json.loads(output['text'])
+
+            kind = data.get('type')
+            if kind == 'ack':
+                sent_ns = self.pending.pop(data.get('client_msg_id'), None)
+                if sent_ns is not None and recorder.in_window(sent_ns):
+                    recorder.acked += 1
+                    recorder.ack_latencies.append((now - sent_ns) / 1e6)
+            elif kind == 'chat_message':
+                sent_ns = int(data['message'].split(' ', 1)[0])
+                if recorder.in_window(sent_ns):
+                    recorder.deliveries += 1
+                    recorder.fanout_latencies.append((now - sent_ns) / 1e6)
+            elif kind == 'typing_state':
+                recorder.typing_snapshots += 1
+            elif kind == 'error':
+                recorder.errors += 1
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        await self.communicator.disconnect()
+
+
+async def run_benchmark(
+    application=None,
+    clients=100,
+    rooms=10,
+    duration=10.0,
+    warmup=1.0,
+    rate=0.2,
+    typing_rate=0.5,
+    message_size=64,
+    binary=False,
+    connect_concurrency=200,
+    drain_timeout=5.0,
+    seed=None,
+    prefix=None,
+    fixtures=None,
+):
+    """
+    Run one benchmark and return its results as a dict.
+
+    `rate` and `typing_rate` are per client per second. Clients are spread
+    round-robin over `rooms`. Only messages sent after `warmup` seconds count.
+    `fixtures` may pass (session keys, room names) from create_fixtures;
+    otherwise they are created here and deleted afterwards.
+    """
+    if application is None:
+        from config.asgi import application
+    rng = random.Random(seed)
+    prefix = prefix or f'bench-{get_random_string(6).lower()}'
+    own_fixtures = fixtures is None
+    if own_fixtures:
+        fixtures = await database_sync_to_async(create_fixtures)(prefix, clients, rooms)
+    session_keys, room_names = fixtures
+
+    recorder = Recorder()
+    simulated = [
+        SimulatedClient(
+            i, application, room_names[i % len(room_names)], session_keys[i], binary, recorder, message_size
+        )
+        for i in range(clients)
+    ]
+
+    # Connect phase: memory is traced only here, so the load phase runs at full speed
+    rss_before = _rss_bytes()
+    tracemalloc.start()
+    traced_before = tracemalloc.get_traced_memory()[0]
+    limit = asyncio.Semaphore(connect_concurrency)
+
+    async def connect(client):
+        async with limit:
+            return await client.connect(timeout=30)
+
+    started = time.monotonic()
+    connected = await asyncio.gather(*[connect(client) for client in simulated])
+    connect_seconds = time.monotonic() - started
+    traced_after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    rss_after = _rss_bytes()
+    simulated = [client for client, ok in zip(simulated, connected) if ok]
+
+    # Load phase
+    deadline = time.monotonic() + warmup + duration
+    recorder.measure_from = time.perf_counter_ns() + int(warmup * 1e9)
+    await asyncio.gather(*[client.drive(deadline, rate, typing_rate, rng) for client in simulated])
+
+    # Give outstanding acks and deliveries a chance to arrive
+    drain_deadline = time.monotonic() + drain_timeout
+    while any(client.pending for client in simulated) and time.monotonic() < drain_deadline:
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.1)
+
+    for client in simulated:
+        await client.close()
+    if own_fixtures:
+        await database_sync_to_async(delete_fixtures)(prefix, session_keys)
+
+    count = max(1, len(simulated))
+    return {
+        'config': {
+            'clients': clients,
+            'rooms': rooms,
+            'duration': duration,
+            'warmup': warmup,
+            'rate': rate,
+            'typing_rate': typing_rate,
+            'message_size': message_size,
+            'wire': 'binary' if binary else 'json',
+            'seed': seed,
+        },
+        'connected': len(simulated),
+        'connect_seconds': round(connect_seconds, 3),
+        'messages_sent': recorder.sent,
+        'messages_acked': recorder.acked,
+        'messages_per_second': round(recorder.acked / duration, 2) if duration else None,
+        'deliveries': recorder.deliveries,
+        'deliveries_per_second': round(recorder.deliveries / duration, 2) if duration else None,
+        'typing_frames_sent': recorder.typing_sent,
+        'typing_snapshots_received': recorder.typing_snapshots,
+        'ack_latency_ms': percentiles(recorder.ack_latencies),
+        'fanout_latency_ms': percentiles(recorder.fanout_latencies),
+        'memory_per_connection_bytes': round((traced_after - traced_before) / count),
+        'rss_per_connection_bytes': (
+            round((rss_after - rss_before) / count) if rss_before is not None and rss_after is not None else None
+        ),
+        'errors': recorder.errors,
+        'closed_by_server': recorder.closed_by_server,
+    }
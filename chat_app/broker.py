@@ -0,0 +1,219 @@
+"""
+Local message broker for running several ASGI worker processes on one machine.
+
+Each worker's SocketChannelLayer (chat_app.layers) keeps a connection to the
+broker over a Unix domain socket. The broker knows which worker owns every
+channel (the worker id is part of the channel name) and which channels are in
+each group, and routes sends and group sends to the owning workers. A group
+send crosses each worker connection once, carrying the list of that worker's
+member channels, no matter how many members the worker has.
+
+Wire format: every frame is a 4-byte big-endian length followed by a JSON
+array of operations, so a worker can publish everything it produced in one
+event loop tick as a single frame. Operations are arrays whose first item is
+the op name:
+
+    worker -> broker   ["hello", worker_id]
+                       ["send", channel, message]
+                       ["group_add", group, channel]
+                       ["group_discard", group, channel]
+                       ["group_send", group, message]
+    broker -> worker   ["deliver", [channel, ...], message]
+
+Frames to a worker wait for its socket to drain; a worker that stops reading
+is disconnected once `max_pending` operations are waiting for it, and
+re-registers its groups when it reconnects.
+
+Run it with `python manage.py run_chat_broker`.
+"""
+import asyncio
+import base64
+import json
+import logging
+import os
+import struct
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('!I')
+MAX_FRAME = 64 * 1024 * 1024
+# Operations the broker holds for a worker whose socket is not draining
+MAX_PENDING = 10000
+
+
+def _default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable by the chat broker")
+
+
+def _object_hook(obj):
+    if len(obj) == 1 and '__bytes__' in obj:
+        return base64.b64decode(obj['__bytes__'])
+    return obj
+
+
+def encode_frame(ops):
+    body = json.dumps(ops, separators=(',', ':'), default=_default).encode('utf-8')
+    return HEADER.pack(len(body)) + body
+
+
+async def read_frame(reader):
+    """Read one frame and return its list of operations. Raises IncompleteReadError at EOF."""
+    (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if length > MAX_FRAME:
+        raise ValueError(f"Frame of {length} bytes exceeds the {MAX_FRAME} byte limit")
+    return json.loads(await reader.readexactly(length), object_hook=_object_hook)
+
+
+def channel_owner(channel):
+    """Worker id embedded in a process-specific channel name ('<prefix>.<worker>!<id>')."""
+    return channel[:channel.index('!')].rsplit('.', 1)[-1]
+
+
+class _Worker:
+    def __init__(self, worker_id, writer, max_pending=MAX_PENDING):
+        self.worker_id = worker_id
+        self.writer = writer
+        self.max_pending = max_pending
+        self.outbox = []
+        self._flusher = None
+        # channel -> set of groups, so everything can be cleaned up on disconnect
+        self.memberships = {}
+
+    def queue(self, op):
+        if self._flusher is None:
+            self._flusher = asyncio.get_running_loop().create_task(self.flush())
+        self.outbox.append(op)
+        if len(self.outbox) > self.max_pending:
+            # The worker has stopped reading. Drop it rather than buffer for it
+            # without bound; it reconnects and replays its groups
+            logger.warning("Worker %s is %d operations behind; dropping its connection", self.worker_id, len(self.outbox))
+            self.outbox = []
+            self.writer.transport.abort()
+
+    async def flush(self):
+        # Everything queued while the previous frame drains goes out as the next frame
+        try:
+            while self.outbox and not self.writer.is_closing():
+                ops, self.outbox = self.outbox, []
+                self.writer.write(encode_frame(ops))
+                await self.writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.outbox = []
+            self._flusher = None
+
+
+class ChatBroker:
+    def __init__(self, path, max_pending=MAX_PENDING):
+        self.path = path
+        self.max_pending = max_pending
+        self.workers = {}
+        # group -> {worker_id: set of that worker's member channels}
+        self.groups = {}
+        self._server = None
+        self._handlers = set()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle, path=self.path)
+        os.chmod(self.path, 0o600)
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        logger.info("Chat broker listening on %s", self.path)
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for worker in list(self.workers.values()):
+            worker.writer.close()
+        # Closing the sockets ends each handler's read loop; wait for them so
+        # no connection task is left to be cancelled with the event loop
+        if self._handlers:
+            await asyncio.wait(list(self._handlers), timeout=1)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _handle(self, reader, writer):
+        worker = None
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            while True:
+                for op in await read_frame(reader):
+                    if op[0] == 'hello':
+                        previous = self.workers.get(op[1])
+                        if previous is not None:
+                            # A reconnect that beat the old connection's EOF: its
+                            # memberships are stale, the hello replays current ones
+                            self._forget(previous)
+                            previous.writer.transport.abort()
+                        worker = _Worker(op[1], writer, self.max_pending)
+                        self.workers[worker.worker_id] = worker
+                    elif worker is not None:
+                        self._dispatch(worker, op)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            logger.exception("Dropping broker connection after a bad frame")
+        finally:
+            if worker is not None and self.workers.get(worker.worker_id) is worker:
+                self._forget(worker)
+            writer.close()
+            self._handlers.discard(task)
+
+    def _dispatch(self, worker, op):
+        name = op[0]
+        if name == 'send':
+            _, channel, message = op
+            target = self.workers.get(channel_owner(channel))
+            if target is not None:
+                target.queue(['deliver', [channel], message])
+        elif name == 'group_send':
+            _, group, message = op
+            for worker_id, channels in self.groups.get(group, {}).items():
+                target = self.workers.get(worker_id)
+                if target is not None:
+                    target.queue(['deliver', list(channels), message])
+        elif name == 'group_add':
+            _, group, channel = op
+            self.groups.setdefault(group, {}).setdefault(worker.worker_id, set()).add(channel)
+            worker.memberships.setdefault(channel, set()).add(group)
+        elif name == 'group_discard':
+            _, group, channel = op
+            self._discard(group, worker.worker_id, channel)
+            groups = worker.memberships.get(channel)
+            if groups is not None:
+                groups.discard(group)
+                if not groups:
+                    del worker.memberships[channel]
+        else:
+            logger.warning("Ignoring unknown broker op %r", name)
+
+    def _discard(self, group, worker_id, channel):
+        members = self.groups.get(group)
+        if members is None:
+            return
+        channels = members.get(worker_id)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del members[worker_id]
+        if not members:
+            del self.groups[group]
+
+    def _forget(self, worker):
+        del self.workers[worker.worker_id]
+        for channel, groups in worker.memberships.items():
+            for group in groups:
+                self._discard(group, worker.worker_id, channel)
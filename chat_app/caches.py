@@ -0,0 +1,244 @@
+"""
+In-process caches for the chat hot paths.
+"""
+import asyncio
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+# Rough per-entry bookkeeping cost (OrderedDict node, key int, value tuple)
+ENTRY_OVERHEAD = 120
+
+
+class PlaintextCache:
+    """
+    Bounded LRU of decrypted message content keyed by Message.pk.
+
+    Size is accounted in bytes (string size plus a fixed per-entry overhead) and
+    the least recently used entries are evicted once `max_bytes` is exceeded.
+    Each entry also remembers a hash of the ciphertext it was decrypted from, so
+    a row whose content changed (or a reused pk) is reported as a miss instead
+    of returning stale plaintext.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, pk, token):
+        with self._lock:
+            entry = self._entries.get(pk)
+            if entry is None or entry[0] != hash(token):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(pk)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, pk, token, plaintext):
+        if pk is None:
+            return
+        cost = sys.getsizeof(plaintext) + ENTRY_OVERHEAD
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(pk, None)
+            if old is not None:
+                self.size -= old[2]
+            self._entries[pk] = (hash(token), plaintext, cost)
+            self.size += cost
+            while self.size > self.max_bytes:
+                _, (_, _, evicted_cost) = self._entries.popitem(last=False)
+                self.size -= evicted_cost
+                self.evictions += 1
+
+    def discard(self, pk):
+        with self._lock:
+            entry = self._entries.pop(pk, None)
+            if entry is not None:
+                self.size -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self.size,
+        }
+
+
+_plaintext_cache = None
+
+
+def get_plaintext_cache():
+    """Return the process-wide PlaintextCache, sized from settings on first use."""
+    global _plaintext_cache
+    if _plaintext_cache is None:
+        _plaintext_cache = PlaintextCache(
+            max_bytes=getattr(settings, 'CHAT_PLAINTEXT_CACHE_BYTES', 16 * 1024 * 1024),
+        )
+    return _plaintext_cache
+
+
+class RoomIdCache:
+    """
+    Process-wide TTL cache of ChatRoom name -> id.
+
+    Rooms are looked up by name on every WebSocket connect; the mapping almost
+    never changes, so it is kept here for `ttl` seconds. Entries are dropped
+    when a room is saved or deleted (see chat_app.signals) so renames and
+    deletes are picked up immediately in this process.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._ids = {}
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        entry = self._ids.get(name)
+        if entry is None:
+            return None
+        room_id, expires = entry
+        if expires < time.monotonic():
+            self.invalidate(room_id)
+            return None
+        return room_id
+
+    def put(self, name, room_id):
+        with self._lock:
+            self._ids[name] = (room_id, time.monotonic() + self.ttl)
+            self._names[room_id] = name
+
+    def invalidate(self, room_id):
+        with self._lock:
+            name = self._names.pop(room_id, None)
+            if name is not None:
+                self._ids.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+            self._names.clear()
+
+
+_room_ids = None
+
+
+def get_room_id_cache():
+    """Return the process-wide RoomIdCache."""
+    global _room_ids
+    if _room_ids is None:
+        _room_ids = RoomIdCache(ttl=getattr(settings, 'CHAT_ROOM_CACHE_TTL', 300))
+    return _room_ids
+
+
+def resolve_room_id(name):
+    """Room id for `name`, from the cache or the database. None if there is no such room."""
+    cache = get_room_id_cache()
+    room_id = cache.get(name)
+    if room_id is None:
+        from .models import ChatRoom
+        room_id = ChatRoom.objects.filter(name=name).values_list('id', flat=True).first()
+        if room_id is not None:
+            cache.put(name, room_id)
+    return room_id
+
+
+class SendDedup:
+    """
+    Time-windowed record of recent (user_id, client_msg_id) sends and their acks.
+
+    A client that retries a send after a timeout reuses its client_msg_id. The
+    first send of an id claims it; retries that arrive while it is still being
+    written wait for it, and retries after it are answered with the same ack,
+    all without writing or broadcasting again. Entries expire after `window`
+    seconds and at most `max_entries` are kept (oldest dropped first); past
+    that, the unique constraint on Message catches the duplicate instead.
+    Used from the event loop only.
+    """
+
+    def __init__(self, window=300, max_entries=100_000):
+        self.window = window
+        self.max_entries = max_entries
+        self.duplicates = 0
+        # key -> (expires, future resolving to the ack payload, or None if the send failed)
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def claim(self, key):
+        """
+        Return None if the caller is the first to send `key` (it must then call
+        complete() or release()), otherwise the ack payload of the original send.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            now = time.monotonic()
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is None or (not entry[1].done() and entry[1].get_loop() is not loop):
+                self._entries[key] = (now + self.window, loop.create_future())
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                return None
+            ack = await asyncio.shield(entry[1])
+            if ack is not None:
+                self.duplicates += 1
+                return ack
+            # The original send failed and gave up the id; this retry takes it over
+
+    def complete(self, key, ack):
+        entry = self._entries.get(key)
+        if entry is not None and not entry[1].done():
+            entry[1].set_result(ack)
+
+    def release(self, key):
+        """Forget a claim whose send failed, so a retry can go through."""
+        entry = self._entries.pop(key, None)
+        if entry is not None and not entry[1].done():
+            entry[1].set_result(None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def _expire(self, now):
+        while self._entries:
+            key, (expires, future) = next(iter(self._entries.items()))
+            if expires > now or not (future.done() or future.get_loop().is_closed()):
+                break
+            del self._entries[key]
+
+
+_send_dedup = None
+
+
+def get_send_dedup():
+    """Return the process-wide SendDedup."""
+    global _send_dedup
+    if _send_dedup is None:
+        _send_dedup = SendDedup(
+            window=getattr(settings, 'CHAT_DEDUP_WINDOW', 300),
+            max_entries=getattr(settings, 'CHAT_DEDUP_MAX_ENTRIES', 100_000),
+        )
+    return _send_dedup
@@ -1,23 +1,99 @@
 import json
+from time import perf_counter
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from .models import ChatRoom, Message
-from django.contrib.auth.models import User
+from .caches import get_plaintext_cache, get_room_id_cache, get_send_dedup, resolve_room_id
+from . import metrics, profiling, wire
+from .backpressure import HISTORY, MESSAGE, SLOW_CONSUMER_CLOSE_CODE, TYPING, outbound_queue
+from .fanout import broadcast_event
+from .history import HistoryEntry, fetch_page, get_recent_messages, recent_page, replay, InvalidCursor
+from .models import CLIENT_MSG_ID_MAX_LENGTH
+from .monitoring import db_sync_to_async, watch_current_loop
+from .persistence import get_writer
+from .presence import get_presence, presence_group
+from .typing_indicators import get_typing_aggregator
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    # chat_app.wire.Session when the connection uses the binary subprotocol
+    wire_session = None
+    # chat_app.backpressure.OutboundQueue, once the socket is accepted
+    outbound = None
+    # Set when the client follows the room's presence (chat_app.presence)
+    presence_group_name = None
+
     async def connect(self):
+        metrics.WS_CONNECTS.inc()
+        watch_current_loop()
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_group_name = f'chat_{self.room_name}'
 
+        # Resolve identities once for the life of the connection; sends then
+        # carry plain ids instead of looking the user and room up every time
+        self.user_id = self.scope['user'].id
+        self.room_id = get_room_id_cache().get(self.room_name)
+        if self.room_id is None:
+            self.room_id = await db_sync_to_async(resolve_room_id)(self.room_name)
+        if self.room_id is None:
+            # Rooms are created from the dashboard/room view; nothing to join here
+            metrics.WS_REJECTED.inc()
+            await self.close(code=4004)
+            return
+
         # Join room group
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
 
-        await self.accept()
+        # JSON unless the client offers the binary subprotocol (chat_app.wire).
+        # Browsers fail the handshake if they offered subprotocols and none is
+        # picked, so the JSON one is echoed back when offered
+        subprotocols = self.scope.get('subprotocols') or []
+        self.wire_session = wire.Session() if wire.SUBPROTOCOL in subprotocols else None
+        if self.wire_session is not None:
+            await self.accept(subprotocol=wire.SUBPROTOCOL)
+        elif wire.JSON_SUBPROTOCOL in subprotocols:
+            await self.accept(subprotocol=wire.JSON_SUBPROTOCOL)
+        else:
+            await self.accept()
+        self.outbound = outbound_queue(super().send, self.scope.get('transport_flow'))
+        metrics.WS_OPEN.inc()
+        # Everyone is counted; clients that pass ?presence=1 also get a snapshot
+        # now and the room's batched joined/left diffs after it
+        presence = get_presence()
+        presence.touch(self.room_name, self.scope['user'].username, self.channel_name)
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        if query.get('presence') == ['1']:
+            self.presence_group_name = presence_group(self.room_name)
+            await self.channel_layer.group_add(self.presence_group_name, self.channel_name)
+            await self.send(text_data=json.dumps(presence.snapshot(self.room_name)), kind=TYPING)
+        await self.send_recent_history()
+
+    async def send(self, text_data=None, bytes_data=None, close=False, kind=MESSAGE, notice=None):
+        # Frames are queued and written by the connection's drain task, so a slow
+        # socket can't hold up this consumer; past the high-water mark typing and
+        # history frames are shed, past the hard limit the connection is closed
+        if self.outbound is None or close:
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+        elif not self.outbound.put(kind, text_data, bytes_data, notice):
+            await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    async def send_history(self, page, **request):
+        # A page shed under backpressure is replaced by a small 'history_skipped'
+        # frame echoing the request, so the client can ask again instead of waiting
+        notice = {'type': 'history_skipped', **{key: page[key] for key in ('initial', 'resume') if key in page}, **request}
+        await self.send(text_data=json.dumps(page), kind=HISTORY, notice=json.dumps(notice))
 
     async def disconnect(self, close_code):
+        metrics.WS_DISCONNECTS.inc()
+        if self.outbound is not None:
+            self.outbound.discard()
+            metrics.WS_OPEN.dec()
+            get_presence().leave(self.channel_name)
+        if self.presence_group_name is not None:
+            await self.channel_layer.group_discard(self.presence_group_name, self.channel_name)
+        get_typing_aggregator().update(self.room_group_name, self.scope['user'].username, False)
+
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
@@ -25,47 +101,146 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
 
     # Receive message from WebSocket
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+    @profiling.timed('receive')
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            try:
+                text_data_json = wire.decode_client(bytes_data)
+            except wire.WireError as e:
+                await self.send(text_data=json.dumps({'type': 'error', 'error': str(e)}))
+                return
+        else:
+            text_data_json = json.loads(text_data)
         message_type = text_data_json.get('type')
+        metrics.WS_FRAMES_BY_TYPE.get(message_type, metrics.WS_FRAMES_OTHER).inc()
+        # Any frame keeps the connection online; idle pages send 'heartbeat'
+        get_presence().touch(self.room_name, self.scope['user'].username, self.channel_name)
         
         if message_type == 'chat_message':
             message = text_data_json['message']
             username = self.scope['user'].username
-            
-            # Save message to database
-            await self.save_message(username, self.room_name, message)
+
+            # Retries of a send reuse its client_msg_id; only the first is
+            # stored and broadcast, the rest get the original ack back
+            client_msg_id = text_data_json.get('client_msg_id')
+            if client_msg_id is not None and not (
+                isinstance(client_msg_id, str) and 0 < len(client_msg_id) <= CLIENT_MSG_ID_MAX_LENGTH
+            ):
+                await self.send(text_data=json.dumps({
+                    'type': 'error',
+                    'error': f'client_msg_id must be a string of 1 to {CLIENT_MSG_ID_MAX_LENGTH} characters'
+                }))
+                return
+            dedup_key = (self.user_id, client_msg_id) if client_msg_id is not None else None
+            if dedup_key is not None:
+                original_ack = await get_send_dedup().claim(dedup_key)
+                if original_ack is not None:
+                    metrics.DUPLICATE_SENDS.inc()
+                    await self.send_ack(original_ack)
+                    return
+
+            # Save message to database (resolves once the write-behind batch has committed)
+            started = perf_counter()
+            try:
+                saved = await self.save_message(message, client_msg_id)
+            except BaseException:
+                if dedup_key is not None:
+                    get_send_dedup().release(dedup_key)
+                raise
+            metrics.MESSAGE_SAVE_SECONDS.observe(perf_counter() - started)
 
             # Send acknowledgement to the sender (Delivery Verification)
-            await self.send(text_data=json.dumps({
+            ack = {
                 'type': 'ack',
                 'status': 'Message saved',
-                'message': message
-            }))
+                'message': message,
+                'seq': saved.seq
+            }
+            if client_msg_id is not None:
+                ack['client_msg_id'] = client_msg_id
+            if dedup_key is not None:
+                get_send_dedup().complete(dedup_key, ack)
+            await self.send_ack(ack)
+            if getattr(saved, '_duplicate', False):
+                # Stored (and broadcast) by an earlier attempt outside the dedup window
+                metrics.DUPLICATE_SENDS.inc()
+                return
+            metrics.MESSAGES_SAVED.inc()
+
+            entry = HistoryEntry(saved.pk, self.user_id, username, message, saved.timestamp, saved.seq)
+            get_recent_messages().append(self.room_id, entry)
+            # Sending a message ends the sender's typing state
+            get_typing_aggregator().update(self.room_group_name, username, False)
 
-            # Send message to room group
+            # Send message to room group (encoded once for every member). 'seq'
+            # lets clients spot gaps and resume from the last one they saw
+            started = perf_counter()
             await self.channel_layer.group_send(
                 self.room_group_name,
-                {
+                broadcast_event({
                     'type': 'chat_message',
                     'message': message,
-                    'username': username
-                }
+                    'username': username,
+                    'id': entry.id,
+                    'seq': entry.seq,
+                    'cursor': entry.cursor,
+                    'timestamp': entry.timestamp.isoformat()
+                })
             )
-            
+            metrics.BROADCASTS.inc()
+            metrics.BROADCAST_SECONDS.observe(perf_counter() - started)
+
         elif message_type == 'typing':
-            # Broadcast typing status
-            username = self.scope['user'].username
-            await self.channel_layer.group_send(
+            # Coalesced server-side: the room gets one 'typing_state' snapshot per
+            # interval instead of a group_send per keystroke
+            get_typing_aggregator().update(
                 self.room_group_name,
-                {
-                    'type': 'typing',
-                    'username': username,
-                    'is_typing': text_data_json.get('is_typing', True)
-                }
+                self.scope['user'].username,
+                bool(text_data_json.get('is_typing', True))
+            )
+
+        elif message_type == 'fetch_history':
+            # Keyset-paginated history: 'before'/'after' cursors from a previous page
+            try:
+                page = await self.fetch_history(
+                    text_data_json.get('before'),
+                    text_data_json.get('after'),
+                    text_data_json.get('limit'),
+                )
+            except InvalidCursor as e:
+                await self.send(text_data=json.dumps({'type': 'error', 'error': str(e)}))
+                return
+            await self.send_history(
+                {'type': 'history', **page},
+                before=text_data_json.get('before'), after=text_data_json.get('after'),
             )
 
-    # Receive message from room group
+        elif message_type == 'resume':
+            # Replay whatever the client missed after the last sequence number it saw
+            try:
+                last_seq = int(text_data_json['last_seq'])
+            except (KeyError, TypeError, ValueError):
+                await self.send(text_data=json.dumps({'type': 'error', 'error': 'resume needs an integer last_seq'}))
+                return
+            await self.send_replay(last_seq)
+
+    # Receive a pre-encoded frame from room group; identical for every member
+    async def chat_broadcast(self, event):
+        if self.wire_session is not None and 'binary' in event:
+            # Shared body plus this connection's user ids (and any new USER frames)
+            kind = event.get('kind', MESSAGE)
+            *bindings, frame = self.wire_session.frames(*event['binary'])
+            for binding in bindings:
+                # USER frames must never be shed; later frames refer to them
+                await self.send(bytes_data=binding)
+            await self.send(bytes_data=frame, kind=kind)
+        elif 'bytes' in event:
+            await self.send(bytes_data=event['bytes'], kind=event.get('kind', MESSAGE))
+        else:
+            await self.send(text_data=event['text'], kind=event.get('kind', MESSAGE))
+
+    # Receive message from room group (per-recipient encoding, kept for events
+    # that were not sent through broadcast_event)
     async def chat_message(self, event):
         message = event['message']
         username = event['username']
@@ -77,7 +252,13 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'username': username
         }))
 
-    # Receive typing event from room group
+    # The channel layer gave up on our backlog (full_policy='close' in
+    # chat_app.layers); we are no longer in the room group, so hang up
+    async def layer_overflow(self, event):
+        await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    # Receive typing event from room group (per-recipient; rooms now get
+    # aggregated 'typing_state' snapshots through chat_broadcast instead)
     async def typing(self, event):
         username = event['username']
         is_typing = event['is_typing']
@@ -89,11 +270,48 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 'type': 'typing',
                 'username': username,
                 'is_typing': is_typing
-            }))
-
-    @database_sync_to_async
-    def save_message(self, username, room_name, message_content):
-        user = User.objects.get(username=username)
-        room = ChatRoom.objects.get(name=room_name)
-        # Content is encrypted in the save() method of the model
-        Message.objects.create(user=user, room=room, content=message_content)
+            }), kind=TYPING)
+
+    async def send_ack(self, ack):
+        if self.wire_session is not None:
+            for frame in self.wire_session.frames(*wire.ack_parts(ack)):
+                await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=json.dumps(ack))
+
+    async def send_recent_history(self):
+        # Clients that already rendered history pass ?after=<cursor of their
+        # newest message> and only get what is newer; the room's ring buffer
+        # answers unless the cursor is older than anything it holds
+        # A reconnecting client passes ?last_seq=N instead and gets a replay
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        last_seq = query.get('last_seq', [None])[0]
+        if last_seq is not None and last_seq.isdigit():
+            await self.send_replay(int(last_seq), always=False)
+            return
+        after = query.get('after', [None])[0]
+        try:
+            page = await db_sync_to_async(recent_page)(self.room_id, after=after)
+        except InvalidCursor:
+            page = await db_sync_to_async(recent_page)(self.room_id)
+        if page.messages:
+            await self.send_history({'type': 'history', 'initial': True, **page.as_dict()})
+
+    async def send_replay(self, last_seq, always=True):
+        page = await db_sync_to_async(replay)(self.room_id, last_seq)
+        if page.messages or always:
+            await self.send_history({'type': 'history', 'resume': True, **page.as_dict()}, last_seq=last_seq)
+
+    @db_sync_to_async
+    def fetch_history(self, before, after, limit):
+        return fetch_page(self.room_id, before=before, after=after, limit=limit).as_dict()
+
+    @profiling.timed('save_message')
+    async def save_message(self, message_content, client_msg_id=None):
+        # Queued on the process-wide writer and flushed with bulk_create alongside
+        # other senders' messages; content is encrypted by the writer
+        saved = await get_writer().submit(self.user_id, self.room_id, message_content, client_msg_id)
+        if not getattr(saved, '_duplicate', False):
+            # We already hold the plaintext, so history reads of this row never decrypt it
+            get_plaintext_cache().put(saved.pk, saved.content, message_content)
+        return saved
@@ -0,0 +1,188 @@
+"""
+Shared cipher service for message content.
+
+Building a Fernet object derives its signing and encryption keys, so doing it
+for every message showed up as a large share of CPU when rendering history.
+The process keeps one MessageCipher and hands out batch APIs; batches at or
+above `pool_threshold` are split across a process pool so crypto for large
+reads (history, exports) can use more than one core.
+
+The cipher holds a keyring (CHAT_ENCRYPTION_KEYS, newest first): new content
+is encrypted with the first key and any key decrypts, so a key can be
+introduced without downtime and retired once `manage.py rotate_encryption_key`
+has re-encrypted the rows that still use it (see chat_app.rotation).
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+DECRYPTION_ERROR = "[Decryption Error]"
+
+
+def _to_bytes(value):
+    return value.encode('utf-8') if isinstance(value, str) else value
+
+
+# Process-pool workers build their MultiFernet once and reuse it for every chunk
+_worker_fernets = {}
+
+
+def _worker_fernet(keys):
+    fernet = _worker_fernets.get(keys)
+    if fernet is None:
+        fernet = _worker_fernets[keys] = MultiFernet([Fernet(key) for key in keys])
+    return fernet
+
+
+def _encrypt_chunk(keys, texts):
+    fernet = _worker_fernet(keys)
+    return [fernet.encrypt(_to_bytes(text)).decode('utf-8') for text in texts]
+
+
+def _decrypt_chunk(keys, tokens, default):
+    fernet = _worker_fernet(keys)
+    results = []
+    for token in tokens:
+        try:
+            results.append(fernet.decrypt(_to_bytes(token)).decode('utf-8'))
+        except (InvalidToken, TypeError, ValueError):
+            results.append(default)
+    return results
+
+
+def _rotate_chunk(keys, tokens):
+    primary, fernet = _worker_fernet(keys[:1]), _worker_fernet(keys)
+    results = []
+    for token in tokens:
+        token = _to_bytes(token)
+        try:
+            primary.decrypt(token)
+            results.append(None)
+            continue
+        except (InvalidToken, TypeError, ValueError):
+            pass
+        try:
+            results.append(fernet.rotate(token).decode('utf-8'))
+        except (InvalidToken, TypeError, ValueError):
+            results.append(False)
+    return results
+
+
+class MessageCipher:
+    """
+    Encrypts and decrypts message content with a single, reused MultiFernet.
+
+    `keys` is one Fernet key or a list of them, newest first: encryption uses
+    the first, decryption tries each in turn. encrypt/decrypt work on one value;
+    encrypt_many/decrypt_many take a list and return a list in the same order.
+    decrypt_many never raises: rows that fail to decrypt come back as
+    `default`, matching Message.decrypted_content.
+    """
+
+    def __init__(self, keys, pool_threshold=None, pool_workers=None):
+        self.keys = (keys,) if isinstance(keys, (bytes, str)) else tuple(keys)
+        if not self.keys:
+            raise ValueError("MessageCipher needs at least one key")
+        self.key = self.keys[0]
+        self.fernet = _worker_fernet(self.keys)
+        self.pool_threshold = pool_threshold
+        self.pool_workers = pool_workers or os.cpu_count() or 1
+        self._pool = None
+
+    def encrypt(self, text):
+        return self.fernet.encrypt(_to_bytes(text)).decode('utf-8')
+
+    def decrypt(self, token):
+        """Decrypt one token. Raises cryptography.fernet.InvalidToken on bad input."""
+        return self.fernet.decrypt(_to_bytes(token)).decode('utf-8')
+
+    def encrypt_many(self, texts):
+        texts = list(texts)
+        if self._use_pool(len(texts)):
+            return self._map(_encrypt_chunk, texts)
+        return _encrypt_chunk(self.keys, texts)
+
+    def decrypt_many(self, tokens, default=DECRYPTION_ERROR):
+        tokens = list(tokens)
+        if self._use_pool(len(tokens)):
+            return self._map(_decrypt_chunk, tokens, default)
+        return _decrypt_chunk(self.keys, tokens, default)
+
+    def rotate_many(self, tokens):
+        """
+        Re-encrypt tokens under the newest key, keeping their timestamps. Each
+        result is the new token, None if the token already uses the newest key,
+        or False if no key in the ring decrypts it.
+        """
+        tokens = list(tokens)
+        if self._use_pool(len(tokens)):
+            return self._map(_rotate_chunk, tokens)
+        return _rotate_chunk(self.keys, tokens)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _use_pool(self, count):
+        return bool(self.pool_threshold) and self.pool_workers > 1 and count >= self.pool_threshold
+
+    def _map(self, func, values, *extra):
+        if self._pool is None:
+            # Never fork: the server process runs threads (writer, executors,
+            # monitors) whose locks a forked child could inherit held
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.pool_workers, mp_context=multiprocessing.get_context(method),
+            )
+        size = -(-len(values) // self.pool_workers)
+        chunks = [values[i:i + size] for i in range(0, len(values), size)]
+        futures = [self._pool.submit(func, self.keys, chunk, *extra) for chunk in chunks]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+
+def encryption_keys():
+    """The keyring from CHAT_ENCRYPTION_KEYS (newest first), or the built-in demo key."""
+    keys = getattr(settings, 'CHAT_ENCRYPTION_KEYS', None)
+    if keys is None:
+        from .models import ENCRYPTION_KEY
+        return (ENCRYPTION_KEY,)
+    keys = tuple(_to_bytes(key) for key in keys)
+    if not keys:
+        raise ImproperlyConfigured("CHAT_ENCRYPTION_KEYS is empty")
+    for key in keys:
+        try:
+            Fernet(key)
+        except ValueError:
+            raise ImproperlyConfigured("CHAT_ENCRYPTION_KEYS holds a value that is not a Fernet key")
+    return keys
+
+
+_cipher = None
+_cipher_setting = None
+
+
+def get_cipher():
+    """
+    Return the process-wide MessageCipher, creating it from settings on first
+    use (and again if CHAT_ENCRYPTION_KEYS changes).
+    """
+    global _cipher, _cipher_setting
+    setting = getattr(settings, 'CHAT_ENCRYPTION_KEYS', None)
+    if _cipher is None or setting != _cipher_setting:
+        if _cipher is not None:
+            _cipher.close()
+        _cipher_setting = list(setting) if setting is not None else None
+        _cipher = MessageCipher(
+            encryption_keys(),
+            pool_threshold=getattr(settings, 'CHAT_CRYPTO_POOL_THRESHOLD', 2000),
+            pool_workers=getattr(settings, 'CHAT_CRYPTO_POOL_WORKERS', None),
+        )
+    return _cipher
@@ -0,0 +1,24 @@
+import json
+
+from . import wire
+from .backpressure import TYPING
+
+
+def broadcast_event(payload):
+    """
+    Group event carrying a frame that is JSON-encoded once, here, by the sender.
+    Every member forwards the same text unchanged (see ChatConsumer.chat_broadcast),
+    so a broadcast costs one serialization instead of one per member.
+
+    Events with a binary form also carry its shared part for members on the
+    binary subprotocol, who only prepend their own user ids (see chat_app.wire).
+    """
+    event = {'type': 'chat.broadcast', 'text': json.dumps(payload)}
+    if payload.get('type') in ('typing', 'typing_state', 'presence'):
+        # First to be shed for a backed-up connection (chat_app.backpressure);
+        # presence diffs carry the count, so the next one resyncs it
+        event['kind'] = TYPING
+    binary = wire.broadcast_parts(payload)
+    if binary is not None:
+        event['binary'] = binary
+    return event
@@ -0,0 +1,415 @@
+"""
+Keyset-paginated message history.
+
+Pages are addressed by a cursor made of (timestamp, id) rather than an OFFSET,
+so every page is a range scan on the (room, timestamp, id) index no matter how
+deep into a room's history it is. Without a cursor the newest page is returned.
+
+The newest messages of active rooms are also kept in memory (RecentMessages),
+so joins and the room view are served without touching the database; only
+pages older than the buffer go to the DB.
+
+Every message also has a gap-free per-room sequence number (Message.seq). A
+client that reconnects sends the last one it saw and gets only the messages
+after it (replay), again from the buffer when it reaches back far enough and
+otherwise from the (room, seq) unique index.
+
+Messages past their room's retention period live in archive segments
+(chat_app.archive); pages that run past the live rows continue there.
+"""
+import sys
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Q
+
+from .archive import archived_page, archived_since
+from .models import Message
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(message):
+    """Cursor for a message: '<microseconds since epoch>-<id>'."""
+    micros = (message.timestamp - _EPOCH) // timedelta(microseconds=1)
+    return f"{micros}-{message.pk}"
+
+
+def decode_cursor(cursor):
+    try:
+        micros, pk = cursor.split('-', 1)
+        return _EPOCH + timedelta(microseconds=int(micros)), int(pk)
+    except (AttributeError, ValueError):
+        raise InvalidCursor(f"Invalid history cursor: {cursor!r}")
+
+
+def clamp_limit(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+class HistoryEntry:
+    """A decrypted message as history serves it: plain attributes, no DB access."""
+
+    __slots__ = ('id', 'user_id', 'username', 'message', 'timestamp', 'seq')
+
+    def __init__(self, id, user_id, username, message, timestamp, seq=None):
+        self.id = id
+        self.user_id = user_id
+        self.username = username
+        self.message = message
+        self.timestamp = timestamp
+        self.seq = seq
+
+    @classmethod
+    def from_message(cls, message, username=None):
+        """Build from a saved Message; pass `username` to avoid loading message.user."""
+        return cls(
+            message.pk,
+            message.user_id,
+            username if username is not None else message.user.username,
+            message.decrypted_content,
+            message.timestamp,
+            message.seq,
+        )
+
+    @property
+    def pk(self):
+        return self.id
+
+    @property
+    def cursor(self):
+        return encode_cursor(self)
+
+    def size(self):
+        return sys.getsizeof(self.message) + sys.getsizeof(self.username) + 200
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'username': self.username,
+            'message': self.message,
+            'timestamp': self.timestamp.isoformat(),
+            'cursor': self.cursor,
+            'seq': self.seq,
+        }
+
+
+class HistoryPage:
+    """One page of history entries, oldest first, plus the cursors to continue from."""
+
+    def __init__(self, messages, has_more):
+        self.messages = messages
+        self.has_more = has_more
+
+    @property
+    def before(self):
+        """Cursor for the next older page."""
+        return encode_cursor(self.messages[0]) if self.messages else None
+
+    @property
+    def after(self):
+        """Cursor for the next newer page."""
+        return encode_cursor(self.messages[-1]) if self.messages else None
+
+    def as_dict(self):
+        return {
+            'messages': [entry.as_dict() for entry in self.messages],
+            'has_more': self.has_more,
+            'before': self.before,
+            'after': self.after,
+        }
+
+
+def fetch_page(room_id, before=None, after=None, limit=PAGE_SIZE):
+    """
+    Return a HistoryPage for a room.
+
+    `before` reads the page of messages just older than that cursor, `after` the
+    page just newer than it; with neither, the newest page. Messages come back
+    in chronological order as HistoryEntry objects. `has_more` says whether
+    another page exists in the direction that was read.
+    """
+    limit = clamp_limit(limit)
+    # One query per page: the author's username comes in via the join, and only
+    # the columns history needs are loaded
+    queryset = (
+        Message.objects.filter(room_id=room_id)
+        .select_related('user')
+        .only('id', 'room_id', 'user_id', 'content', 'timestamp', 'seq', 'user__username')
+    )
+
+    if after is not None:
+        timestamp, pk = decode_cursor(after)
+        queryset = queryset.filter(
+            Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk)
+        ).order_by('timestamp', 'id')
+    else:
+        if before is not None:
+            timestamp, pk = decode_cursor(before)
+            queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk))
+        queryset = queryset.order_by('-timestamp', '-id')
+
+    messages = list(queryset[:limit + 1])
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if after is None:
+        messages.reverse()
+
+    Message.prefetch_decrypted(messages)
+    entries = [HistoryEntry.from_message(message) for message in messages]
+
+    # Older messages may have been moved to the archive (chat_app.archive)
+    if after is not None:
+        archived, more = archived_page(room_id, after=decode_cursor(after), limit=limit)
+        if archived:
+            entries = archived + entries
+            has_more = has_more or more or len(entries) > limit
+            entries = entries[:limit]
+    elif not has_more:
+        if entries:
+            position = (entries[0].timestamp, entries[0].id)
+        else:
+            position = decode_cursor(before) if before is not None else None
+        archived, has_more = archived_page(room_id, before=position, limit=limit - len(entries))
+        entries = archived + entries
+    return HistoryPage(entries, has_more)
+
+
+def fetch_since(room_id, seq, limit=MAX_PAGE_SIZE):
+    """HistoryPage of the messages after sequence number `seq`, oldest first."""
+    limit = clamp_limit(limit)
+    messages = list(
+        Message.objects.filter(room_id=room_id, seq__gt=seq)
+        .select_related('user')
+        .only('id', 'room_id', 'user_id', 'content', 'timestamp', 'seq', 'user__username')
+        .order_by('seq')[:limit + 1]
+    )
+    has_more = len(messages) > limit
+    messages = Message.prefetch_decrypted(messages[:limit])
+    entries = [HistoryEntry.from_message(message) for message in messages]
+    if not messages or messages[0].seq is None or messages[0].seq > seq + 1:
+        # The messages right after `seq` may have been archived
+        archived, more = archived_since(room_id, seq, limit=limit)
+        if archived:
+            entries = archived + entries
+            has_more = has_more or more or len(entries) > limit
+            entries = entries[:limit]
+    return HistoryPage(entries, has_more)
+
+
+def serialize_message(message):
+    return HistoryEntry.from_message(message).as_dict()
+
+
+class _RoomBuffer:
+    __slots__ = ('entries', 'truncated', 'size')
+
+    def __init__(self, capacity, entries, truncated):
+        self.entries = deque(entries, maxlen=capacity)
+        # True when the room has older messages than the buffer holds
+        self.truncated = truncated
+        self.size = sum(entry.size() for entry in self.entries)
+
+
+class RecentMessages:
+    """
+    Per-room ring buffer of the newest `per_room` decrypted messages.
+
+    A room's buffer is seeded from the database the first time it is read and
+    then kept current by the ChatConsumer send path. Rooms are kept in LRU
+    order and the least recently used are evicted once the buffers together
+    exceed `max_bytes`. Writes that bypass the consumer (admin, Message.save)
+    simply drop the room's buffer so it is re-seeded on the next read.
+    Appends that arrive while a room is being seeded are held for the seed.
+    """
+
+    def __init__(self, per_room=100, max_bytes=32 * 1024 * 1024):
+        self.per_room = per_room
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._rooms = OrderedDict()
+        # room -> appends held while the room is being seeded
+        self._seeding = {}
+        self._lock = threading.Lock()
+
+    def get(self, room_id):
+        """(entries, truncated) for a buffered room, or None if it isn't buffered."""
+        with self._lock:
+            buffer = self._rooms.get(room_id)
+            if buffer is None:
+                self.misses += 1
+                return None
+            self._rooms.move_to_end(room_id)
+            self.hits += 1
+            return list(buffer.entries), buffer.truncated
+
+    def begin_seed(self, room_id):
+        """
+        Call before reading a room's page from the database, and pass the
+        result to seed(): messages appended during the read are held for it.
+        """
+        with self._lock:
+            return self._seeding.setdefault(room_id, deque(maxlen=self.per_room))
+
+    def seed(self, room_id, entries, truncated, pending=None):
+        """
+        Buffer a room's newest messages. With `pending` from begin_seed(), the
+        appends held since then are applied on top, skipping any the read
+        already saw (seq <= the page's last seq). Nothing is buffered if the
+        room was discarded during the read or another seed finished first.
+        """
+        with self._lock:
+            if pending is not None:
+                if self._seeding.get(room_id) is not pending:
+                    return
+                del self._seeding[room_id]
+            self._drop(room_id)
+            buffer = self._rooms[room_id] = _RoomBuffer(self.per_room, entries, truncated)
+            buffer.truncated = truncated or len(entries) > self.per_room
+            self.size += buffer.size
+            last_seq = entries[-1].seq if entries else None
+            for entry in pending or ():
+                if None not in (entry.seq, last_seq) and entry.seq <= last_seq:
+                    continue
+                if not self._append(room_id, buffer, entry):
+                    break
+            self._evict()
+
+    def append(self, room_id, entry):
+        """Add a just-written message. Rooms that aren't buffered are left to be seeded later."""
+        with self._lock:
+            buffer = self._rooms.get(room_id)
+            if buffer is None:
+                held = self._seeding.get(room_id)
+                if held is not None:
+                    held.append(entry)
+                return
+            self._append(room_id, buffer, entry)
+            self._evict()
+
+    def discard(self, room_id):
+        with self._lock:
+            self._drop(room_id)
+            # A seed already reading may have missed the write; don't let it land
+            self._seeding.pop(room_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+            self._seeding.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'rooms': len(self._rooms),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _append(self, room_id, buffer, entry):
+        last = buffer.entries[-1] if buffer.entries else None
+        if last is not None and None not in (entry.seq, last.seq) and entry.seq != last.seq + 1:
+            # Someone else (another worker process) wrote in between; replay
+            # must never skip a message, so re-seed rather than leave a hole
+            self._drop(room_id)
+            return False
+        if len(buffer.entries) == buffer.entries.maxlen:
+            oldest = buffer.entries[0]
+            buffer.size -= oldest.size()
+            self.size -= oldest.size()
+            buffer.truncated = True
+        buffer.entries.append(entry)
+        buffer.size += entry.size()
+        self.size += entry.size()
+        return True
+
+    def _drop(self, room_id):
+        buffer = self._rooms.pop(room_id, None)
+        if buffer is not None:
+            self.size -= buffer.size
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self._rooms) > 1:
+            _, buffer = self._rooms.popitem(last=False)
+            self.size -= buffer.size
+            self.evictions += 1
+
+
+_recent = None
+
+
+def get_recent_messages():
+    """Return the process-wide RecentMessages buffer, sized from settings on first use."""
+    global _recent
+    if _recent is None:
+        _recent = RecentMessages(
+            per_room=getattr(settings, 'CHAT_RECENT_MESSAGES', 100),
+            max_bytes=getattr(settings, 'CHAT_RECENT_MESSAGES_BYTES', 32 * 1024 * 1024),
+        )
+    return _recent
+
+
+def _buffered(room_id):
+    """(entries, truncated) from the room's ring buffer, seeding it from the DB if needed."""
+    recent = get_recent_messages()
+    buffered = recent.get(room_id)
+    if buffered is None:
+        pending = recent.begin_seed(room_id)
+        page = fetch_page(room_id, limit=recent.per_room)
+        recent.seed(room_id, page.messages, page.has_more, pending)
+        buffered = page.messages, page.has_more
+    return buffered
+
+
+def recent_page(room_id, after=None, limit=PAGE_SIZE):
+    """
+    Like fetch_page(room_id) / fetch_page(room_id, after=...), served from the
+    room's ring buffer (seeding it from the DB if needed). Falls back to the DB
+    when `after` is older than anything the buffer holds.
+    """
+    limit = clamp_limit(limit)
+    entries, truncated = _buffered(room_id)
+
+    if after is None:
+        return HistoryPage(entries[-limit:], truncated or len(entries) > limit)
+
+    position = decode_cursor(after)
+    newer = [entry for entry in entries if (entry.timestamp, entry.id) > position]
+    if truncated and len(newer) == len(entries):
+        # The cursor is older than the buffer; the gap has to come from the DB
+        return fetch_page(room_id, after=after, limit=limit)
+    return HistoryPage(newer[:limit], len(newer) > limit)
+
+
+def replay(room_id, seq, limit=MAX_PAGE_SIZE):
+    """
+    Messages after sequence number `seq`, for a client resuming a dropped
+    connection. Served from the ring buffer when it reaches back to `seq`,
+    otherwise from the database. `has_more` means the client should resume
+    again from the last message of this page.
+    """
+    limit = clamp_limit(limit)
+    entries, truncated = _buffered(room_id)
+    newer = [entry for entry in entries if entry.seq is not None and entry.seq > seq]
+    covers = not truncated or (entries and entries[0].seq is not None and entries[0].seq <= seq + 1)
+    if not covers:
+        return fetch_since(room_id, seq, limit=limit)
+    return HistoryPage(newer[:limit], len(newer) > limit)
@@ -0,0 +1,512 @@
+"""
+Channel layer backends tuned for chat traffic.
+
+ShardedInMemoryChannelLayer is a drop-in replacement for
+channels.layers.InMemoryChannelLayer for single-node deployments that can't run
+Redis:
+
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "chat_app.layers.ShardedInMemoryChannelLayer",
+            "CONFIG": {"capacity": 500, "full_policy": "drop_oldest"},
+        },
+    }
+
+Differences from the stock in-memory layer:
+
+* Group tables are split into `shards` dicts by group name. Expiry runs at
+  most every `cleanup_interval` seconds, instead of scanning every channel
+  and group on every receive/group_send: channels with queued messages sit
+  in a heap by the expiry of their oldest message, and group memberships in
+  a heap by join time plus `group_expiry`, so a cleanup only looks at the
+  entries that are actually due.
+* Each channel tracks the groups it belongs to, so group_add, group_discard and
+  dropping a dead channel from all its groups are O(1) per membership.
+* group_send puts directly onto member queues (no task per member) and yields
+  to the event loop every `send_batch` members so a 50k-member room cannot
+  stall other connections.
+* When a channel's queue is full, `full_policy` decides what happens:
+  "raise" (ChannelFull, like the stock layer), "drop_oldest", "drop_newest",
+  or "close", which discards the backlog, removes the channel from its groups
+  and queues a single `overflow_type` message so the consumer can close itself.
+
+Messages sent to a group are copied once for the whole group; every member
+gets its own top-level dict but nested values are shared, so handlers must
+treat events as read-only (Channels consumers do).
+
+SocketChannelLayer lets several worker processes on one machine share groups
+through the broker in chat_app.broker (`python manage.py run_chat_broker`):
+
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "chat_app.layers.SocketChannelLayer",
+            "CONFIG": {"path": "/run/chat/broker.sock"},
+        },
+    }
+"""
+import asyncio
+import heapq
+import logging
+import random
+import string
+import time
+import uuid
+from collections import deque
+from copy import deepcopy
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+from .broker import channel_owner, encode_frame, read_frame
+
+logger = logging.getLogger(__name__)
+
+FULL_POLICIES = ('raise', 'drop_oldest', 'drop_newest', 'close')
+
+
+class _ChannelState:
+    __slots__ = ('messages', 'waiters', 'capacity')
+
+    def __init__(self, capacity):
+        self.messages = deque()
+        self.waiters = deque()
+        self.capacity = capacity
+
+
+class ShardedInMemoryChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(
+        self,
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        shards=64,
+        full_policy='drop_oldest',
+        overflow_type='layer.overflow',
+        send_batch=1000,
+        cleanup_interval=1.0,
+        **kwargs,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, **kwargs)
+        if full_policy not in FULL_POLICIES:
+            raise ValueError(f"full_policy must be one of {FULL_POLICIES}, not {full_policy!r}")
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.group_expiry = group_expiry
+        self.full_policy = full_policy
+        self.overflow_type = overflow_type
+        self.send_batch = send_batch
+        self.cleanup_interval = cleanup_interval
+        self.shard_count = shards
+        self.dropped = 0
+        self.overflowed = 0
+        self._reset()
+
+    def _reset(self):
+        self.channels = {}
+        # shard -> {group: {channel: joined_at}}
+        self.shards = [{} for _ in range(self.shard_count)]
+        # channel -> set of groups, for O(1) removal from every group it joined
+        self.memberships = {}
+        # (deadline, channel) heap with one entry per channel in _deadlines;
+        # a deadline is the expiry of the channel's oldest message when queued
+        self._expiry_heap = []
+        self._deadlines = {}
+        # (expiry, group, channel) heap of memberships; an entry whose join
+        # time no longer matches the group table is stale and skipped. Rebuilt
+        # when stale entries (from rejoins and discards) outnumber live ones
+        self._group_heap = []
+        self._member_count = 0
+        self._next_cleanup = 0.0
+
+    def _shard(self, group):
+        return self.shards[hash(group) % self.shard_count]
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert "__asgi_channel__" not in message
+        self._put(channel, deepcopy(message))
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        self._maybe_clean()
+
+        state = self._state(channel)
+        while True:
+            while state.messages:
+                expires, message = state.messages.popleft()
+                if expires >= time.time():
+                    self._release(channel, state)
+                    return message
+            waiter = asyncio.get_running_loop().create_future()
+            state.waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in state.waiters:
+                    state.waiters.remove(waiter)
+            # The channel may have been flushed or dropped while we waited
+            state = self._state(channel)
+
+    async def new_channel(self, prefix="specific."):
+        return "%s.sharded!%s" % (
+            prefix,
+            "".join(random.choice(string.ascii_letters) for i in range(12)),
+        )
+
+    async def flush(self):
+        for state in self.channels.values():
+            for waiter in state.waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+        self._reset()
+
+    async def close(self):
+        pass
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        members = self._shard(group).setdefault(group, {})
+        if channel not in members:
+            self._member_count += 1
+        members[channel] = joined_at = time.time()
+        self.memberships.setdefault(channel, set()).add(group)
+        heapq.heappush(self._group_heap, (joined_at + self.group_expiry, group, channel))
+        if len(self._group_heap) > 2 * self._member_count + 64:
+            self._rebuild_group_heap()
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        self._discard(group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        self._maybe_clean()
+
+        members = self._shard(group).get(group)
+        if not members:
+            return
+        message = deepcopy(message)
+        for index, channel in enumerate(list(members)):
+            if index and index % self.send_batch == 0:
+                await asyncio.sleep(0)
+            try:
+                self._put(channel, dict(message))
+            except ChannelFull:
+                # Group sends are best-effort, as in the stock layers
+                pass
+
+    # Internals
+
+    def _state(self, channel):
+        state = self.channels.get(channel)
+        if state is None:
+            state = self.channels[channel] = _ChannelState(self.get_capacity(channel))
+        return state
+
+    def _release(self, channel, state):
+        if not state.messages and not state.waiters:
+            self.channels.pop(channel, None)
+
+    def _put(self, channel, message):
+        state = self._state(channel)
+        if len(state.messages) >= state.capacity:
+            if self.full_policy == 'raise':
+                raise ChannelFull(channel)
+            self.dropped += 1
+            if self.full_policy == 'drop_newest':
+                return
+            if self.full_policy == 'drop_oldest':
+                state.messages.popleft()
+            else:
+                # 'close': the receiver can't keep up; throw away its backlog,
+                # stop routing group traffic to it and tell it to go away
+                self.overflowed += 1
+                self._remove_from_groups(channel)
+                state.messages.clear()
+                message = {'type': self.overflow_type}
+        expires = time.time() + self.expiry
+        state.messages.append((expires, message))
+        if channel not in self._deadlines:
+            self._schedule(channel, expires)
+        while state.waiters:
+            waiter = state.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def _discard(self, group, channel):
+        shard = self._shard(group)
+        members = shard.get(group)
+        if members is not None:
+            if members.pop(channel, None) is not None:
+                self._member_count -= 1
+            if not members:
+                del shard[group]
+        groups = self.memberships.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self.memberships[channel]
+
+    def _remove_from_groups(self, channel):
+        for group in list(self.memberships.get(channel, ())):
+            self._discard(group, channel)
+
+    def _maybe_clean(self):
+        now = time.time()
+        if now < self._next_cleanup:
+            return
+        self._next_cleanup = now + self.cleanup_interval
+        self._clean_channels(now)
+        self._clean_groups(now)
+
+    def _schedule(self, channel, deadline):
+        self._deadlines[channel] = deadline
+        heapq.heappush(self._expiry_heap, (deadline, channel))
+
+    def _clean_channels(self, now):
+        # A channel whose oldest message expired unread has no live receiver:
+        # drop the backlog and its group memberships (like the stock layer).
+        # Only due heap entries are looked at; a channel that was read from
+        # since is rescheduled for its current oldest message
+        heap = self._expiry_heap
+        while heap and heap[0][0] < now:
+            deadline, channel = heapq.heappop(heap)
+            if self._deadlines.get(channel) != deadline:
+                continue
+            del self._deadlines[channel]
+            state = self.channels.get(channel)
+            if state is None or not state.messages:
+                continue
+            oldest = state.messages[0][0]
+            if oldest < now and not state.waiters:
+                del self.channels[channel]
+                self._remove_from_groups(channel)
+            else:
+                self._schedule(channel, oldest if oldest >= now else now + self.cleanup_interval)
+
+    def _clean_groups(self, now):
+        heap = self._group_heap
+        while heap and heap[0][0] < now:
+            expires, group, channel = heapq.heappop(heap)
+            joined_at = self._shard(group).get(group, {}).get(channel)
+            if joined_at is not None and joined_at + self.group_expiry == expires:
+                self._discard(group, channel)
+
+    def _rebuild_group_heap(self):
+        self._group_heap = [
+            (joined_at + self.group_expiry, group, channel)
+            for shard in self.shards
+            for group, members in shard.items()
+            for channel, joined_at in members.items()
+        ]
+        heapq.heapify(self._group_heap)
+
+
+class SocketChannelLayer(BaseChannelLayer):
+    """
+    Channel layer for multi-process deployments on a single machine.
+
+    Every process connects to the broker over a Unix domain socket. Channel
+    names embed this process's worker id, so the broker can route sends to the
+    process that owns the channel; group membership lives in the broker. Sends
+    to this process's own channels skip the broker. Operations produced during
+    one event loop tick are published to the broker as a single frame, and
+    publishing waits while the broker connection's write buffer is full.
+
+    Delivered messages land in a local ShardedInMemoryChannelLayer, which
+    applies `capacity`, `expiry` and `full_policy` per channel. Only
+    process-specific channels (names containing "!") are supported.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(
+        self,
+        path='/tmp/chat_broker.sock',
+        expiry=60,
+        capacity=100,
+        channel_capacity=None,
+        full_policy='drop_oldest',
+        reconnect_delay=0.5,
+        **kwargs,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, **kwargs)
+        self.path = str(path)
+        self.reconnect_delay = reconnect_delay
+        self.worker_id = uuid.uuid4().hex[:12]
+        self.local = ShardedInMemoryChannelLayer(
+            expiry=expiry,
+            capacity=capacity,
+            channel_capacity=channel_capacity,
+            full_policy=full_policy,
+        )
+        # Memberships of this process's channels, replayed after a reconnect
+        self.groups = {}
+        self._loop = None
+        self._lock = None
+        self._writer = None
+        self._reader_task = None
+        self._outbox = []
+        self._closed = False
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        if '!' not in channel:
+            raise TypeError("SocketChannelLayer only supports process-specific channels")
+        if channel_owner(channel) == self.worker_id:
+            self._deliver([channel], deepcopy(message))
+        else:
+            await self._publish(['send', channel, message])
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        # Deliveries only flow while we are connected
+        await self._connect()
+        return await self.local.receive(channel)
+
+    async def new_channel(self, prefix="specific."):
+        return "%s.%s!%s" % (
+            prefix,
+            self.worker_id,
+            "".join(random.choice(string.ascii_letters) for i in range(12)),
+        )
+
+    async def flush(self):
+        for group, channels in list(self.groups.items()):
+            for channel in channels:
+                await self._publish(['group_discard', group, channel])
+        self.groups = {}
+        await self.local.flush()
+
+    async def close(self):
+        self._closed = True
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if self._writer is not None:
+            self._flush_outbox()
+            self._writer.close()
+            self._writer = None
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self.groups.setdefault(group, set()).add(channel)
+        await self._publish(['group_add', group, channel])
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        self._forget(group, channel)
+        await self._publish(['group_discard', group, channel])
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        await self._publish(['group_send', group, message])
+
+    # Broker connection
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # First use, or a new event loop (e.g. between tests): start over
+            self._loop = loop
+            self._lock = asyncio.Lock()
+            self._writer = None
+            self._outbox = []
+        if self._writer is not None and not self._writer.is_closing():
+            return
+        async with self._lock:
+            if self._writer is not None and not self._writer.is_closing():
+                return
+            reader, writer = await asyncio.open_unix_connection(self.path)
+            hello = [['hello', self.worker_id]]
+            for group, channels in self.groups.items():
+                hello.extend(['group_add', group, channel] for channel in channels)
+            writer.write(encode_frame(hello))
+            self._closed = False
+            self._writer = writer
+            self._reader_task = loop.create_task(self._read(reader))
+
+    async def _publish(self, op):
+        await self._connect()
+        if not self._outbox:
+            self._loop.call_soon(self._flush_outbox)
+        self._outbox.append(op)
+        # Wait while the socket's write buffer is over its high-water mark, so
+        # a broker that falls behind slows publishers down instead of the
+        # buffer growing without bound
+        try:
+            await self._writer.drain()
+        except ConnectionError:
+            pass  # _read() reconnects; _flush_outbox() logs what was lost
+
+    def _flush_outbox(self):
+        ops, self._outbox = self._outbox, []
+        if not ops:
+            return
+        if self._writer is None or self._writer.is_closing():
+            logger.warning("Broker connection lost; dropped %d operations", len(ops))
+            return
+        self._writer.write(encode_frame(ops))
+
+    async def _read(self, reader):
+        try:
+            while True:
+                for op in await read_frame(reader):
+                    if op[0] == 'deliver':
+                        self._deliver(op[1], op[2])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writer = None
+        if not self._closed:
+            await self._reconnect()
+
+    async def _reconnect(self):
+        while not self._closed:
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                await self._connect()
+                return
+            except OSError:
+                logger.warning("Chat broker at %s unavailable, retrying", self.path)
+
+    def _deliver(self, channels, message):
+        for channel in channels:
+            overflowed = self.local.overflowed
+            try:
+                self.local._put(channel, dict(message))
+            except ChannelFull:
+                continue
+            if self.local.overflowed != overflowed:
+                # full_policy='close': stop routing group traffic to this channel
+                for group in [g for g, members in self.groups.items() if channel in members]:
+                    self._forget(group, channel)
+                    self._outbox.append(['group_discard', group, channel])
+                    if len(self._outbox) == 1 and self._loop is not None:
+                        self._loop.call_soon(self._flush_outbox)
+
+    def _forget(self, group, channel):
+        channels = self.groups.get(group)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.groups[group]
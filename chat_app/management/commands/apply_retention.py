@@ -0,0 +1,46 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat_app.archive import RetentionBusy, apply_retention
+
+
+class Command(BaseCommand):
+    help = (
+        "Move messages past their room's retention period into the archive segments "
+        "(CHAT_ARCHIVE_DIR). Runs once, or every --every seconds until interrupted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', action='append', default=None, help="Only this room (repeatable).")
+        parser.add_argument(
+            '--batch-size', type=int, default=getattr(settings, 'CHAT_RETENTION_BATCH_SIZE', 500),
+            help="Messages deleted per transaction.",
+        )
+        parser.add_argument(
+            '--pause', type=float, default=getattr(settings, 'CHAT_RETENTION_PAUSE', 0.05),
+            help="Seconds between batches, leaving the write lock to the chat.",
+        )
+        parser.add_argument('--every', type=float, default=None, help="Repeat every this many seconds.")
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                moved = apply_retention(
+                    room_names=options['room'], batch_size=options['batch_size'], pause=options['pause'],
+                )
+            except RetentionBusy as e:
+                if options['every'] is None:
+                    raise CommandError(str(e))
+                self.stderr.write(str(e))
+            else:
+                for name, count in moved.items():
+                    self.stdout.write(f"{name}: archived {count} messages")
+                self.stdout.write(f"Archived {sum(moved.values())} messages from {len(moved)} rooms.")
+            if options['every'] is None:
+                return
+            try:
+                time.sleep(options['every'])
+            except KeyboardInterrupt:
+                return
@@ -0,0 +1,89 @@
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+import channels
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.utils import setup_databases, teardown_databases
+
+from chat_app.benchmark import run_benchmark
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=5,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test ChatConsumer in process: simulated WebSocket clients across many rooms "
+        "against config.asgi.application. Prints the results as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000, help="Simulated WebSocket clients.")
+        parser.add_argument('--rooms', type=int, default=50, help="Rooms the clients are spread over.")
+        parser.add_argument('--duration', type=float, default=10.0, help="Measured seconds of load.")
+        parser.add_argument('--warmup', type=float, default=2.0, help="Seconds of load before measuring.")
+        parser.add_argument('--rate', type=float, default=0.2, help="Chat messages per client per second.")
+        parser.add_argument('--typing-rate', type=float, default=0.5, help="Typing frames per client per second.")
+        parser.add_argument('--message-size', type=int, default=64, help="Characters per chat message.")
+        parser.add_argument('--wire', choices=['json', 'binary'], default='json', help="Wire protocol to use.")
+        parser.add_argument('--seed', type=int, default=None, help="Random seed for the send schedule.")
+        parser.add_argument(
+            '--database', choices=['test', 'default'], default='test',
+            help="'test' (default) runs against a throwaway test database; 'default' uses the "
+                 "configured one and deletes the benchmark's users and rooms afterwards.",
+        )
+        parser.add_argument('--output', default='-', help="File to write the JSON results to ('-' for stdout).")
+
+    def handle(self, *args, **options):
+        old_config = None
+        if options['database'] == 'test':
+            old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            results = asyncio.run(run_benchmark(
+                clients=options['clients'],
+                rooms=options['rooms'],
+                duration=options['duration'],
+                warmup=options['warmup'],
+                rate=options['rate'],
+                typing_rate=options['typing_rate'],
+                message_size=options['message_size'],
+                binary=options['wire'] == 'binary',
+                seed=options['seed'],
+            ))
+        finally:
+            if old_config is not None:
+                teardown_databases(old_config, verbosity=0)
+
+        report = {
+            'commit': _git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'channels': channels.__version__,
+            'channel_layer': settings.CHANNEL_LAYERS.get('default', {}).get('BACKEND'),
+            'database': settings.DATABASES['default']['ENGINE'],
+            **results,
+        }
+        text = json.dumps(report, indent=2)
+        if options['output'] == '-':
+            self.stdout.write(text)
+        else:
+            with open(options['output'], 'w') as output:
+                output.write(text + '\n')
+            ack = results['ack_latency_ms'] or {}
+            self.stderr.write(
+                f"{results['connected']} clients, {results['messages_per_second']} msg/s, "
+                f"ack p50 {ack.get('p50')} ms p99 {ack.get('p99')} ms -> {options['output']}"
+            )
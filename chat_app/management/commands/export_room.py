@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat_app.models import ChatRoom
+from chat_app.transfer import export_room, open_stream
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream a room's messages (archived ones included) to NDJSON, gzipped if the "
+        "output ends in .gz. Content stays encrypted unless --decrypt is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('room', help="Name of the room to export.")
+        parser.add_argument('--output', default='-', help="File to write ('-' for stdout).")
+        parser.add_argument('--decrypt', action='store_true', help="Write plaintext instead of Fernet tokens.")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Messages read (and decrypted) per batch.")
+
+    def handle(self, *args, **options):
+        try:
+            room = ChatRoom.objects.get(name=options['room'])
+        except ChatRoom.DoesNotExist:
+            raise CommandError(f"Room {options['room']!r} does not exist")
+        with open_stream(options['output'], 'w') as out:
+            count = export_room(room, out, decrypt=options['decrypt'], batch_size=options['batch_size'])
+        self.stderr.write(f"Exported {count} messages from {room.name!r}.")
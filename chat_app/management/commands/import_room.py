@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat_app.transfer import TransferError, import_room, open_stream
+
+
+class Command(BaseCommand):
+    help = (
+        "Load a room exported with export_room. Authors missing here get accounts without "
+        "a usable password. Each batch commits on its own, so a failed import can be "
+        "resumed with --append after removing what it loaded."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help="Export file ('-' for stdin); .gz files are decompressed.")
+        parser.add_argument('--room', default=None, help="Import under this name instead of the exported one.")
+        parser.add_argument('--append', action='store_true', help="Allow importing into a room that has messages.")
+        parser.add_argument('--batch-size', type=int, default=2000, help="Messages inserted per transaction.")
+
+    def handle(self, *args, **options):
+        try:
+            stream = open_stream(options['input'], 'r')
+        except OSError as e:
+            raise CommandError(str(e))
+        try:
+            with stream:
+                room, count, undecryptable = import_room(
+                    stream, room_name=options['room'], append=options['append'], batch_size=options['batch_size'],
+                )
+        except (TransferError, OSError) as e:
+            raise CommandError(str(e))
+        self.stdout.write(f"Imported {count} messages into {room.name!r}.")
+        if undecryptable:
+            self.stderr.write(
+                f"{undecryptable} messages could not be decrypted with this instance's key; "
+                "they were stored as exported but are not searchable."
+            )
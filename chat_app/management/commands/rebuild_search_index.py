@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from chat_app.crypto import DECRYPTION_ERROR
+from chat_app.models import ChatRoom, Message, MessageSearchToken
+from chat_app.search import index_rows
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the blind keyword index used by message search, for every room or one. "
+        "Messages are re-indexed in batches, so search keeps working while it runs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', default=None, help="Only re-index this room (by name).")
+        parser.add_argument('--batch-size', type=int, default=2000, help="Messages decrypted and indexed per transaction.")
+
+    def handle(self, *args, **options):
+        messages = Message.objects.only('id', 'room_id', 'content').order_by('id')
+        if options['room']:
+            try:
+                room = ChatRoom.objects.get(name=options['room'])
+            except ChatRoom.DoesNotExist:
+                raise CommandError(f"Room {options['room']!r} does not exist")
+            messages = messages.filter(room=room)
+
+        indexed = tokens = failed = 0
+        last_id = 0
+        while True:
+            # decrypt_many spreads large batches over the crypto process pool
+            batch = Message.prefetch_decrypted(messages.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].pk
+            readable = [message for message in batch if message._decrypted_content != DECRYPTION_ERROR]
+            rows = index_rows(readable)
+            with transaction.atomic():
+                MessageSearchToken.objects.filter(message_id__in=[message.pk for message in batch]).delete()
+                MessageSearchToken.objects.bulk_create(rows, batch_size=5000)
+            indexed += len(readable)
+            tokens += len(rows)
+            failed += len(batch) - len(readable)
+
+        self.stdout.write(f"Indexed {indexed} messages ({tokens} tokens).")
+        if failed:
+            self.stderr.write(f"{failed} messages could not be decrypted and were left out of the index.")
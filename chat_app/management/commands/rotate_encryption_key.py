@@ -0,0 +1,64 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat_app.crypto import get_cipher
+from chat_app.rotation import key_fingerprint, load_state, rotate_messages, state_path
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-encrypt stored messages under the newest key in CHAT_ENCRYPTION_KEYS, in "
+        "small batches while the chat keeps running. Resumes from its checkpoint if interrupted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=getattr(settings, 'CHAT_KEY_ROTATION_BATCH_SIZE', 500),
+            help="Messages re-encrypted per transaction.",
+        )
+        parser.add_argument(
+            '--pause', type=float, default=getattr(settings, 'CHAT_KEY_ROTATION_PAUSE', 0.05),
+            help="Seconds between batches, leaving the write lock to the chat.",
+        )
+        parser.add_argument('--state', default=None, help="Checkpoint file (default CHAT_KEY_ROTATION_STATE).")
+        parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint and start from the first message.")
+        parser.add_argument('--status', action='store_true', help="Show the checkpoint and exit.")
+
+    def handle(self, *args, **options):
+        path = options['state'] or state_path()
+        cipher = get_cipher()
+        if options['status']:
+            state = load_state(path)
+            if state is None:
+                raise CommandError(f"No rotation checkpoint at {path}")
+            if state.get('key') != key_fingerprint(cipher.key):
+                self.stdout.write("The checkpoint is for a different key than the current newest one.")
+            self.stdout.write(self.describe(state))
+            return
+        if len(cipher.keys) == 1:
+            raise CommandError("Only one key is configured; put the new key first in CHAT_ENCRYPTION_KEYS.")
+
+        def progress(state):
+            if options['verbosity'] > 1:
+                self.stdout.write(self.describe(state))
+
+        try:
+            state = rotate_messages(
+                batch_size=options['batch_size'], pause=options['pause'], path=path,
+                restart=options['restart'], progress=progress,
+            )
+        except KeyboardInterrupt:
+            self.stderr.write(f"Interrupted; run again to resume from {path}.")
+            return
+        self.stdout.write(self.describe(state))
+        if state['failed']:
+            self.stderr.write(
+                f"{state['failed']} messages could not be decrypted with any configured key and were left as they are."
+            )
+
+    def describe(self, state):
+        status = 'finished' if state.get('finished_at') else f"at id {state['last_id']} of {state.get('upto', '?')}"
+        return (
+            f"Key {state['key']}: {status}; {state['rotated']} re-encrypted, "
+            f"{state['current']} already current, {state['failed']} undecryptable."
+        )
@@ -0,0 +1,28 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat_app.broker import ChatBroker
+
+
+class Command(BaseCommand):
+    help = "Run the local message broker used by chat_app.layers.SocketChannelLayer."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--socket',
+            default=None,
+            help="Unix socket path (defaults to the 'path' in CHANNEL_LAYERS['default']['CONFIG']).",
+        )
+
+    def handle(self, *args, **options):
+        path = options['socket'] or (
+            settings.CHANNEL_LAYERS.get('default', {}).get('CONFIG', {}).get('path', '/tmp/chat_broker.sock')
+        )
+        self.stdout.write(f"Chat broker listening on {path}")
+        broker = ChatBroker(str(path))
+        try:
+            asyncio.run(broker.serve_forever())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,288 @@
+"""
+Low-overhead in-process metrics, exposed in the Prometheus text format.
+
+Counters, gauges and histograms are plain objects updated in place: an
+increment is an attribute add and a histogram observation one bisect into a
+short bucket list, both well under a microsecond, so instrumentation stays on
+under full load. Hot paths time themselves with two perf_counter() calls
+rather than a context manager. Updates take no lock; under heavy thread
+contention an increment can occasionally be lost, which monitoring tolerates.
+
+Values are per process; with several workers scrape (or sum) each of them.
+views.metrics renders everything registered here at /metrics.
+"""
+from bisect import bisect_left
+from time import perf_counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+REGISTRY = []
+
+# Seconds; fine-grained at the low end where the hot paths live
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), function=None, register=True):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Read the value from here at scrape time instead of recording it
+        self.function = function
+        self._children = {}
+        if register:
+            REGISTRY.append(self)
+
+    def labels(self, *values):
+        """The child for one combination of label values (created on first use)."""
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children.setdefault(values, self._child())
+        return child
+
+    def _child(self):
+        return type(self)(self.name, self.documentation, register=False)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        if self.labelnames:
+            for values, child in sorted(self._children.items()):
+                lines.extend(child._sample_lines(self.labelnames, values))
+        else:
+            lines.extend(self._sample_lines((), ()))
+        return '\n'.join(lines) + '\n'
+
+    def _sample_lines(self, names, values):
+        return [f'{self.name}{_labels(names, values)} {_number(self.get())}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        self.value = 0
+        super().__init__(*args, **kwargs)
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        self.value = 0
+        super().__init__(*args, **kwargs)
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, register=True):
+        self.buckets = tuple(sorted(buckets))
+        # counts[i] is observations in (buckets[i-1], buckets[i]]; the last is above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        super().__init__(name, documentation, labelnames, register=register)
+
+    def _child(self):
+        return Histogram(self.name, self.documentation, buckets=self.buckets, register=False)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self):
+        """Context manager observing the duration of its block (for code off the hot paths)."""
+        return _Timer(self)
+
+    def _sample_lines(self, names, values):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{_labels(names, values, ("le", _number(bound)))} {cumulative}')
+        lines.append(f'{self.name}_sum{_labels(names, values)} {_number(self.sum)}')
+        lines.append(f'{self.name}_count{_labels(names, values)} {cumulative}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(perf_counter() - self.start)
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format."""
+    return ''.join(metric.render() for metric in REGISTRY)
+
+
+# -- WebSocket -----------------------------------------------------------------
+
+WS_CONNECTS = Counter('chat_ws_connects_total', "WebSocket connection attempts.")
+WS_REJECTED = Counter('chat_ws_rejected_total', "WebSocket connections refused (unknown room).")
+WS_DISCONNECTS = Counter('chat_ws_disconnects_total', "WebSocket disconnects.")
+WS_OPEN = Gauge('chat_ws_open_connections', "Accepted WebSocket connections currently open.")
+WS_FRAMES = Counter('chat_ws_frames_received_total', "Frames received from clients, by type.", ['type'])
+FRAME_TYPES = ('chat_message', 'typing', 'fetch_history', 'resume', 'heartbeat')
+# Children resolved up front: clients choose 'type', so unknown ones share 'other'
+WS_FRAMES_BY_TYPE = {frame_type: WS_FRAMES.labels(frame_type) for frame_type in FRAME_TYPES}
+WS_FRAMES_OTHER = WS_FRAMES.labels('other')
+
+MESSAGES_SAVED = Counter('chat_messages_saved_total', "Chat messages stored from WebSocket sends.")
+DUPLICATE_SENDS = Counter('chat_duplicate_sends_total', "Retried sends answered without storing again.")
+MESSAGE_SAVE_SECONDS = Histogram(
+    'chat_message_save_seconds', "Time from queuing a WebSocket message to its batch committing.",
+)
+BROADCASTS = Counter('chat_broadcasts_total', "Chat messages broadcast to a room group.")
+BROADCAST_SECONDS = Histogram('chat_broadcast_seconds', "Time spent in group_send for a chat message.")
+
+# -- Persistence and crypto ----------------------------------------------------
+
+WRITE_BATCH_SECONDS = Histogram('chat_write_batch_seconds', "Time to encrypt and insert one write-behind batch.")
+WRITE_BATCH_SIZE = Histogram('chat_write_batch_size', "Messages per write-behind batch.", buckets=SIZE_BUCKETS)
+DB_SAVE_SECONDS = Histogram('chat_db_save_seconds', "Database time of Message.save().")
+ENCRYPT_SECONDS = Histogram('chat_encrypt_seconds', "Time per encryption call (one message or one batch).")
+DECRYPT_SECONDS = Histogram('chat_decrypt_seconds', "Time per decryption call (one message or one batch).")
+DECRYPT_ERRORS = Counter('chat_decrypt_errors_total', "Messages that failed to decrypt.")
+
+# -- Event loop and sync executors (see chat_app.monitoring) -------------------
+
+LOOP_LAG_SECONDS = Histogram('chat_loop_lag_seconds', "How late the event loop ran its monitor's heartbeat.")
+LOOP_STALLS = Counter('chat_loop_stalls_total', "Times the event loop was blocked past CHAT_LOOP_LAG_THRESHOLD.")
+EXECUTOR_WAIT_SECONDS = Histogram(
+    'chat_executor_wait_seconds', "Time sync calls waited for an executor thread, by executor.", ['executor'],
+)
+EXECUTOR_QUEUE_DEPTH = Gauge('chat_executor_queued', "Sync calls waiting for an executor thread.", ['executor'])
+EXECUTOR_SLOW_WAITS = Counter(
+    'chat_executor_slow_waits_total', "Sync calls that waited past CHAT_EXECUTOR_WAIT_THRESHOLD.", ['executor'],
+)
+
+# -- HTTP ----------------------------------------------------------------------
+
+HTTP_REQUESTS = Counter('chat_http_requests_total', "HTTP requests, by view and status.", ['view', 'method', 'status'])
+HTTP_SECONDS = Histogram('chat_http_request_seconds', "HTTP request latency, by view.", ['view'])
+
+
+def _plaintext_cache():
+    from .caches import get_plaintext_cache
+    return get_plaintext_cache()
+
+
+def _recent_messages():
+    from .history import get_recent_messages
+    return get_recent_messages()
+
+
+def _outbound():
+    from .backpressure import stats
+    return stats
+
+
+def _presence():
+    from .presence import get_presence
+    return get_presence()
+
+
+# Read at scrape time from the stats the caches and queues already keep
+Counter('chat_plaintext_cache_hits_total', "Decrypted-content cache hits.",
+        function=lambda: _plaintext_cache().hits)
+Counter('chat_plaintext_cache_misses_total', "Decrypted-content cache misses.",
+        function=lambda: _plaintext_cache().misses)
+Gauge('chat_plaintext_cache_bytes', "Approximate bytes held by the decrypted-content cache.",
+      function=lambda: _plaintext_cache().size)
+Gauge('chat_recent_buffer_rooms', "Rooms held in the recent-message buffer.",
+      function=lambda: _recent_messages().stats()['rooms'])
+Gauge('chat_recent_buffer_bytes', "Approximate bytes held by the recent-message buffer.",
+      function=lambda: _recent_messages().size)
+Gauge('chat_outbound_queued_bytes', "Bytes queued on outbound connection queues.",
+      function=lambda: _outbound().queued_bytes)
+Counter('chat_outbound_typing_dropped_total', "Typing frames shed under backpressure.",
+        function=lambda: _outbound().typing_dropped)
+Counter('chat_outbound_history_skipped_total', "History pages skipped under backpressure.",
+        function=lambda: _outbound().history_skipped)
+Counter('chat_outbound_evictions_total', "Connections closed for falling too far behind.",
+        function=lambda: _outbound().evicted)
+Gauge('chat_presence_connections', "Connections tracked as online by the presence service.",
+      function=lambda: len(_presence()._connections))
+
+
+class MetricsMiddleware:
+    """Counts and times every HTTP request, labelled by URL name rather than path."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Stay on whichever side the handler runs, so async requests don't hop to a thread
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self._acall(request)
+        started = perf_counter()
+        response = self.get_response(request)
+        self._record(request, response, started)
+        return response
+
+    async def _acall(self, request):
+        started = perf_counter()
+        response = await self.get_response(request)
+        self._record(request, response, started)
+        return response
+
+    @staticmethod
+    def _record(request, response, started):
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match is not None else 'unresolved'
+        HTTP_SECONDS.labels(view).observe(perf_counter() - started)
+        HTTP_REQUESTS.labels(view, request.method, response.status_code).inc()
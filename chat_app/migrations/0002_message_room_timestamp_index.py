@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:20
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'timestamp', 'id'], name='chat_msg_room_ts_id'),
+        ),
+    ]
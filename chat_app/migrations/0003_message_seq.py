@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:35
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def number_existing_messages(apps, schema_editor):
+    """Give existing messages their room's sequence numbers in chronological order."""
+    ChatRoom = apps.get_model('chat_app', 'ChatRoom')
+    Message = apps.get_model('chat_app', 'Message')
+    for room in ChatRoom.objects.only('id'):
+        rows = list(Message.objects.filter(room_id=room.id).only('id').order_by('timestamp', 'id'))
+        for seq, row in enumerate(rows, start=1):
+            row.seq = seq
+        Message.objects.bulk_update(rows, ['seq'], batch_size=500)
+        ChatRoom.objects.filter(id=room.id).update(last_seq=len(rows))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0002_message_room_timestamp_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(number_existing_messages, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('room', 'seq'), name='chat_msg_room_seq'),
+        ),
+    ]
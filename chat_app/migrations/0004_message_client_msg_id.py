@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:38
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0003_message_seq'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='client_msg_id',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('user', 'client_msg_id'), name='chat_msg_user_client_id'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0004_message_client_msg_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.BinaryField(max_length=16)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='chat_app.message')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat_app.chatroom')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'token', 'message'], name='chat_search_room_token')],
+            },
+        ),
+    ]
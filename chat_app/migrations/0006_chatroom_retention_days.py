@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0005_message_search_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:44
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0006_chatroom_retention_days'),
+    ]
+
+    operations = [
+        # auto_now_add -> default=timezone.now is Python-side only; the column is
+        # unchanged, so skip the table rebuild SQLite would otherwise do
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='message',
+                    name='timestamp',
+                    field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+                ),
+            ],
+        ),
+    ]
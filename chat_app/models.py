@@ -1,8 +1,12 @@
-from django.db import models
+from time import perf_counter
+
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
 from django.contrib.auth.models import User
-from cryptography.fernet import Fernet
-import base64
-import os
+from . import metrics
+from .caches import get_plaintext_cache
+from .crypto import get_cipher, DECRYPTION_ERROR
 
 # Generate a key for encryption (In production, store this in environment variables)
 # For this project, we'll use a hardcoded key for demonstration or generate one if not present
@@ -13,41 +17,143 @@ ENCRYPTION_KEY = b'YourStaticFernetKeyForDemoPurposeOnly=' # This needs to be 32
 # Let's use a valid key:
 ENCRYPTION_KEY = b'epj_J1L4s5zL3A7K5qT8xL9zR0aQ2wE4rT5yU7iO8p0=' 
 
+CLIENT_MSG_ID_MAX_LENGTH = 64
+
 class ChatRoom(models.Model):
     name = models.CharField(max_length=255, unique=True)
+    # Highest Message.seq handed out in this room (see allocate_seq)
+    last_seq = models.PositiveBigIntegerField(default=0, editable=False)
+    # Days messages stay in the Message table before chat_app.archive moves
+    # them out; None uses CHAT_RETENTION_DAYS
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # last_seq only ever moves through allocate_seq's UPDATE; saving a stale
+        # in-memory copy of the room (admin, renames) must not write it back
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'last_seq'
+            ]
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def allocate_seq(cls, room_id, count=1):
+        """
+        Reserve `count` consecutive message sequence numbers in a room and return
+        the first. Call inside a transaction so the numbers commit (or roll back)
+        together with the messages that use them.
+        """
+        cls.objects.filter(pk=room_id).update(last_seq=F('last_seq') + count)
+        last_seq = cls.objects.filter(pk=room_id).values_list('last_seq', flat=True).get()
+        return last_seq - count + 1
+
 class Message(models.Model):
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages')
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField() # Stores encrypted content
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # A default rather than auto_now_add, so imports can insert the original time
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+    # Position in the room, 1, 2, 3, ... with no gaps; clients resume from it
+    seq = models.PositiveBigIntegerField(null=True, blank=True, editable=False)
+    # Optional id the sending client picked, so a retried send is stored once
+    client_msg_id = models.CharField(max_length=CLIENT_MSG_ID_MAX_LENGTH, null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of room history (see chat_app.history)
+            models.Index(fields=['room', 'timestamp', 'id'], name='chat_msg_room_ts_id'),
+        ]
+        constraints = [
+            # Also the index that resume (seq > N within a room) scans
+            models.UniqueConstraint(fields=['room', 'seq'], name='chat_msg_room_seq'),
+            models.UniqueConstraint(fields=['user', 'client_msg_id'], name='chat_msg_user_client_id'),
+        ]
 
     def save(self, *args, **kwargs):
         """Encrypt message before saving"""
         if self.content:
-            cipher_suite = Fernet(ENCRYPTION_KEY)
-            # If content is already bytes, use it, otherwise encode
-            if isinstance(self.content, str):
-                content_bytes = self.content.encode('utf-8')
-            else:
-                content_bytes = self.content
-            
-            # Encrypt
-            encrypted_content = cipher_suite.encrypt(content_bytes)
-            # Save as string
-            self.content = encrypted_content.decode('utf-8')
-        
-        super().save(*args, **kwargs)
+            plaintext = self.content
+            # The shared cipher accepts both str and bytes and returns a str token
+            started = perf_counter()
+            self.content = get_cipher().encrypt(plaintext)
+            metrics.ENCRYPT_SECONDS.observe(perf_counter() - started)
+            if isinstance(plaintext, str):
+                self._decrypted_content = plaintext
+
+        started = perf_counter()
+        if self._state.adding and self.seq is None and self.room_id is not None:
+            with transaction.atomic():
+                self.seq = ChatRoom.allocate_seq(self.room_id)
+                super().save(*args, **kwargs)
+        else:
+            super().save(*args, **kwargs)
+        metrics.DB_SAVE_SECONDS.observe(perf_counter() - started)
+
+        if '_decrypted_content' in self.__dict__:
+            get_plaintext_cache().put(self.pk, self.content, self._decrypted_content)
 
     @property
     def decrypted_content(self):
         """Decrypt message for display"""
-        try:
-            cipher_suite = Fernet(ENCRYPTION_KEY)
-            decrypted_content = cipher_suite.decrypt(self.content.encode('utf-8'))
-            return decrypted_content.decode('utf-8')
-        except Exception as e:
-            return "[Decryption Error]"
+        if '_decrypted_content' in self.__dict__:
+            return self._decrypted_content
+        cache = get_plaintext_cache()
+        decrypted_content = cache.get(self.pk, self.content)
+        if decrypted_content is None:
+            started = perf_counter()
+            try:
+                decrypted_content = get_cipher().decrypt(self.content)
+            except Exception as e:
+                metrics.DECRYPT_ERRORS.inc()
+                return DECRYPTION_ERROR
+            finally:
+                metrics.DECRYPT_SECONDS.observe(perf_counter() - started)
+            cache.put(self.pk, self.content, decrypted_content)
+        self._decrypted_content = decrypted_content
+        return decrypted_content
+
+    @classmethod
+    def prefetch_decrypted(cls, messages):
+        """
+        Decrypt a list of messages in one batch so decrypted_content is free
+        afterwards (e.g. in templates). Returns the messages as a list.
+        """
+        messages = list(messages)
+        cache = get_plaintext_cache()
+        missing = []
+        for message in messages:
+            plaintext = cache.get(message.pk, message.content)
+            if plaintext is None:
+                missing.append(message)
+            else:
+                message._decrypted_content = plaintext
+
+        if not missing:
+            return messages
+        started = perf_counter()
+        plaintexts = get_cipher().decrypt_many([message.content for message in missing])
+        metrics.DECRYPT_SECONDS.observe(perf_counter() - started)
+        for message, plaintext in zip(missing, plaintexts):
+            message._decrypted_content = plaintext
+            if plaintext != DECRYPTION_ERROR:
+                cache.put(message.pk, message.content, plaintext)
+            else:
+                metrics.DECRYPT_ERRORS.inc()
+        return messages
+
+
+class MessageSearchToken(models.Model):
+    """One distinct word of a message, as a keyed hash (see chat_app.search)."""
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='search_tokens')
+    # Copied from the message so a lookup is one range scan of a room's tokens
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='+')
+    token = models.BinaryField(max_length=16)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'token', 'message'], name='chat_search_room_token'),
+        ]
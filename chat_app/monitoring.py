@@ -0,0 +1,304 @@
+"""
+Event-loop lag and sync-executor wait monitoring.
+
+Channels runs database_sync_to_async calls thread-sensitively: every ORM call
+of a worker goes through asgiref's one shared thread. A slow query there holds
+up every socket's acks, and the event loop can't tell. Two monitors make this
+visible, both reporting into chat_app.metrics and the `chat_app.monitoring`
+logger:
+
+* LoopMonitor beats every `interval` on the loop and records how late each
+  beat was. A watchdog thread notices when beats stop and logs the loop
+  thread's stack at that moment, i.e. the callable that is blocking it.
+* CallTracker records how long each call waited for a thread and how many
+  are queued. While a call has been waiting past the threshold, the watchdog
+  logs the stacks of the calls holding the threads.
+
+watch_current_loop() starts the loop monitor for the running loop
+(ChatConsumer.connect calls it). db_sync_to_async runs this app's ORM calls
+and tracks them. With CHAT_SYNC_THREADS set they run on a MonitoredExecutor
+pool of that many threads. Otherwise they run on the shared thread, where
+only this app's calls are counted. asgiref's executor is left alone, so other
+code's sync_to_async calls go unmonitored.
+"""
+import asyncio
+import functools
+import logging
+import sys
+import threading
+import traceback
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, perf_counter
+
+from asgiref.sync import AsyncToSync
+from channels.db import DatabaseSyncToAsync, database_sync_to_async
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Every CallTracker, checked by the loop watchdogs
+_executors = weakref.WeakSet()
+
+
+def _thread_stack(thread_id):
+    frame = sys._current_frames().get(thread_id)
+    if frame is None:
+        return '  (thread has finished)\n'
+    return ''.join(traceback.format_stack(frame))
+
+
+def _describe(fn):
+    """The function a (possibly asgiref-wrapped) executor call will end up running."""
+    while isinstance(fn, functools.partial):
+        inner = [arg for arg in fn.args if isinstance(arg, functools.partial)]
+        fn = inner[-1] if inner else fn.func
+    return getattr(fn, '__qualname__', repr(fn))
+
+
+class CallTracker:
+    """
+    Records how long each call waited for a thread and how many are queued,
+    under `name`. check() (run by the loop watchdog) logs when the oldest
+    queued call has waited past `wait_threshold`, with the stacks of the calls
+    holding the threads at that moment. A call is registered with enqueue()
+    when it is handed off and run through call() once it has a thread.
+    """
+
+    def __init__(self, name='default', wait_threshold=0.5):
+        self.name = name
+        self.wait_threshold = wait_threshold
+        # token -> (callable, submit time) of queued calls, oldest first
+        self.waiting = {}
+        # thread id -> (callable, start time) of the calls holding the threads
+        self.running = {}
+        self._lock = threading.Lock()
+        self._stalled = False
+        self._wait = metrics.EXECUTOR_WAIT_SECONDS.labels(name)
+        self._depth = metrics.EXECUTOR_QUEUE_DEPTH.labels(name)
+        self._slow = metrics.EXECUTOR_SLOW_WAITS.labels(name)
+        _executors.add(self)
+
+    @property
+    def queued(self):
+        return len(self.waiting)
+
+    def enqueue(self, fn):
+        token = object()
+        with self._lock:
+            self.waiting[token] = (fn, perf_counter())
+            self._depth.set(len(self.waiting))
+        return token
+
+    def call(self, token, fn, args, kwargs):
+        started = perf_counter()
+        with self._lock:
+            _, submitted = self.waiting.pop(token)
+            self._depth.set(len(self.waiting))
+        waited = started - submitted
+        self._wait.observe(waited)
+        if waited > self.wait_threshold:
+            self._slow.inc()
+
+        ident = threading.get_ident()
+        # A call on the caller's own thread can run inside another tracked call
+        outer = self.running.get(ident)
+        self.running[ident] = (fn, started)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if outer is None:
+                del self.running[ident]
+            else:
+                self.running[ident] = outer
+
+    def check(self):
+        """Log once per stall while the oldest queued call is waiting past the threshold."""
+        with self._lock:
+            oldest = next(iter(self.waiting.values()), None)
+        now = perf_counter()
+        if oldest is None or now - oldest[1] <= self.wait_threshold:
+            self._stalled = False
+            return
+        if self._stalled:
+            return
+        self._stalled = True
+        busy = ''.join(
+            f'\n--- {_describe(fn)}, running for {now - since:.3f}s:\n{_thread_stack(ident)}'
+            for ident, (fn, since) in list(self.running.items())
+        )
+        logger.warning(
+            "%s has waited %.3fs for a thread of the %r executor (%d queued). Busy threads:%s",
+            _describe(oldest[0]), now - oldest[1], self.name, self.queued, busy or ' none',
+        )
+
+
+class MonitoredExecutor(CallTracker, ThreadPoolExecutor):
+    """ThreadPoolExecutor whose calls are tracked by CallTracker."""
+
+    def __init__(self, max_workers=None, thread_name_prefix='', name='default', wait_threshold=0.5):
+        ThreadPoolExecutor.__init__(self, max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        CallTracker.__init__(self, name=name, wait_threshold=wait_threshold)
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(self.call, self.enqueue(fn), fn, args, kwargs)
+
+
+class LoopMonitor:
+    """
+    Lag histogram and stall watchdog for one event loop. Start it from a
+    coroutine running on that loop; it stops when its heartbeat task is
+    cancelled (e.g. by asyncio.run shutting the loop down).
+    """
+
+    def __init__(self, interval=0.1, threshold=0.25):
+        self.interval = interval
+        self.threshold = threshold
+        self.stopped = threading.Event()
+        self._thread_id = None
+        self._beat = None
+        self._stalled_since = None
+        self._task = None
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._beat = monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name='chat-loop-watchdog', daemon=True).start()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self.stopped.set()
+
+    async def _heartbeat(self):
+        try:
+            while True:
+                expected = monotonic() + self.interval
+                await asyncio.sleep(self.interval)
+                now = monotonic()
+                metrics.LOOP_LAG_SECONDS.observe(max(0.0, now - expected))
+                self._beat = now
+                stalled_since = self._stalled_since
+                if stalled_since is not None:
+                    self._stalled_since = None
+                    logger.warning("Event loop responsive again after %.3fs", now - stalled_since)
+        finally:
+            self.stopped.set()
+            # The task references the loop; let _monitors drop it with the loop
+            self._task = None
+
+    def _watch(self):
+        while not self.stopped.wait(self.interval):
+            for executor in list(_executors):
+                executor.check()
+            behind = monotonic() - self._beat - self.interval
+            if behind > self.threshold and self._stalled_since is None:
+                self._stalled_since = self._beat + self.interval
+                metrics.LOOP_STALLS.inc()
+                logger.warning(
+                    "Event loop blocked for %.3fs so far; it is running:\n%s",
+                    behind, _thread_stack(self._thread_id),
+                )
+
+
+_monitors = weakref.WeakKeyDictionary()
+_shared_thread = None
+_sync_pool = None
+_write_thread = None
+_pool_lock = threading.Lock()
+
+
+def watch_current_loop():
+    """Start the loop and executor monitors for the running loop, once (no-op if disabled)."""
+    if not getattr(settings, 'CHAT_LOOP_MONITOR', True):
+        return None
+    loop = asyncio.get_running_loop()
+    monitor = _monitors.get(loop)
+    if monitor is not None and not monitor.stopped.is_set():
+        return monitor
+
+    monitor = LoopMonitor(
+        interval=getattr(settings, 'CHAT_LOOP_MONITOR_INTERVAL', 0.1),
+        threshold=getattr(settings, 'CHAT_LOOP_LAG_THRESHOLD', 0.25),
+    )
+    monitor.start()
+    _monitors[loop] = monitor
+    return monitor
+
+
+def get_shared_thread_tracker():
+    """Tracks this app's db_sync_to_async calls that run on asgiref's shared thread."""
+    global _shared_thread
+    if _shared_thread is None:
+        with _pool_lock:
+            if _shared_thread is None:
+                _shared_thread = CallTracker(
+                    name='thread_sensitive',
+                    wait_threshold=getattr(settings, 'CHAT_EXECUTOR_WAIT_THRESHOLD', 0.5),
+                )
+    return _shared_thread
+
+
+def get_sync_executor():
+    """The CHAT_SYNC_THREADS pool, or None when ORM calls stay on the shared thread."""
+    global _sync_pool
+    threads = getattr(settings, 'CHAT_SYNC_THREADS', None)
+    if not threads:
+        return None
+    if _sync_pool is None:
+        with _pool_lock:
+            if _sync_pool is None:
+                _sync_pool = MonitoredExecutor(
+                    max_workers=threads, thread_name_prefix='chat-sync', name='chat_sync',
+                    wait_threshold=getattr(settings, 'CHAT_EXECUTOR_WAIT_THRESHOLD', 0.5),
+                )
+    return _sync_pool
+
+
+def get_write_executor():
+    """
+    The dedicated message-writer thread when CHAT_DB_WRITER_THREAD is set,
+    otherwise the same pool as every other ORM call.
+    """
+    global _write_thread
+    if not getattr(settings, 'CHAT_DB_WRITER_THREAD', False):
+        return get_sync_executor()
+    if _write_thread is None:
+        with _pool_lock:
+            if _write_thread is None:
+                _write_thread = MonitoredExecutor(
+                    max_workers=1, thread_name_prefix='chat-db-writer', name='db_writer',
+                    wait_threshold=getattr(settings, 'CHAT_EXECUTOR_WAIT_THRESHOLD', 0.5),
+                )
+    return _write_thread
+
+
+def db_sync_to_async(func, executor=get_sync_executor):
+    """
+    database_sync_to_async that runs on the executor `executor()` returns (by
+    default the CHAT_SYNC_THREADS pool), or on the shared thread when that is
+    None. Only for self-contained ORM calls: calls made under async_to_sync
+    (sync callers, tests) keep running in the caller's thread so they see its
+    transaction. Calls on the shared thread are tracked as 'thread_sensitive'.
+    """
+    get_executor = executor
+    thread_sensitive = None
+    pooled = None
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        nonlocal thread_sensitive, pooled
+        executor = get_executor()
+        if executor is None or getattr(AsyncToSync.executors, 'current', None) is not None:
+            tracker = get_shared_thread_tracker()
+            if thread_sensitive is None:
+                thread_sensitive = database_sync_to_async(tracker.call)
+            return await thread_sensitive(tracker.enqueue(func), func, args, kwargs)
+        if pooled is None or pooled[0] is not executor:
+            pooled = (executor, DatabaseSyncToAsync(func, thread_sensitive=False, executor=executor))
+        return await pooled[1](*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,240 @@
+"""
+Write-behind persistence for chat messages.
+
+ChatConsumer used to run one INSERT (plus two lookups and a thread hop) per
+message before it could ack. Messages are now queued here and a single flusher
+task writes them in batches with bulk_create, so concurrent senders share one
+transaction. Each sender still awaits its own message: the ack only goes out
+once the batch holding it has committed.
+"""
+import asyncio
+import atexit
+import copy
+import logging
+from collections import deque
+from time import perf_counter
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+
+from . import metrics
+from .crypto import get_cipher
+from .monitoring import db_sync_to_async, get_write_executor
+from .models import ChatRoom, Message, MessageSearchToken
+from .search import index_rows
+
+logger = logging.getLogger(__name__)
+
+
+class PendingMessage:
+    __slots__ = ('user_id', 'room_id', 'content', 'future', 'client_msg_id')
+
+    def __init__(self, user_id, room_id, content, future, client_msg_id=None):
+        self.user_id = user_id
+        self.room_id = room_id
+        self.content = content
+        self.future = future
+        self.client_msg_id = client_msg_id
+
+
+def _resolve(future, result=None, exception=None):
+    """Complete a sender's future, unless its event loop has already gone away."""
+    if future is None or future.done() or future.get_loop().is_closed():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+class MessageWriter:
+    """
+    Collects messages in a per-process queue and flushes them with bulk_create.
+
+    A batch is written as soon as `max_batch` messages are waiting, or
+    `max_delay` seconds after the first one arrived, whichever comes first.
+    While a batch is being written new messages keep queueing up, so under
+    load batches grow on their own without adding latency at low traffic.
+    """
+
+    def __init__(self, max_batch=100, max_delay=0.005):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._pending = deque()
+        self._flusher = None
+        self._batch_ready = None
+
+    async def submit(self, user_id, room_id, content, client_msg_id=None):
+        """
+        Queue a message and wait until it has been committed. Returns the saved
+        Message. If the user already stored a message under `client_msg_id`,
+        nothing is written and that message is returned with `_duplicate` set.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(PendingMessage(user_id, room_id, content, future, client_msg_id))
+
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._flusher = loop.create_task(self._run())
+        elif len(self._pending) >= self.max_batch and self._batch_ready is not None:
+            self._batch_ready.set()
+
+        return await future
+
+    async def flush(self):
+        """Wait until everything queued so far has been written."""
+        while self._flusher is not None and not self._flusher.done():
+            await asyncio.shield(self._flusher)
+
+    async def _run(self):
+        self._batch_ready = asyncio.Event()
+        while self._pending:
+            if len(self._pending) < self.max_batch and self.max_delay > 0:
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._batch_ready.clear()
+
+            batch = [self._pending.popleft() for _ in range(min(len(self._pending), self.max_batch))]
+            await self._commit(batch)
+
+    async def _commit(self, batch):
+        try:
+            results = await db_sync_to_async(self.write_batch, executor=get_write_executor)(batch)
+        except Exception as exc:
+            logger.exception("Failed to write a batch of %d messages", len(batch))
+            for item in batch:
+                _resolve(item.future, exception=exc)
+            return
+
+        for item, result in zip(batch, results):
+            if isinstance(result, Exception):
+                _resolve(item.future, exception=result)
+            else:
+                _resolve(item.future, result)
+
+    def write_batch(self, batch):
+        """
+        Write a batch in one transaction. Returns one entry per item: the saved
+        Message, or the exception explaining why that item was not written.
+        """
+        started = perf_counter()
+        try:
+            return self._write_batch(batch)
+        except IntegrityError:
+            # Another process stored one of these client_msg_ids between our
+            # check and the insert; the second pass finds it and skips it
+            return self._write_batch(batch)
+        finally:
+            metrics.WRITE_BATCH_SECONDS.observe(perf_counter() - started)
+            metrics.WRITE_BATCH_SIZE.observe(len(batch))
+
+    def _write_batch(self, batch):
+        # Ids come resolved from the consumer; one existence check per batch keeps
+        # a deleted room or user from failing everybody else's messages at commit
+        user_ids = set(
+            User.objects.filter(id__in={item.user_id for item in batch}).values_list('id', flat=True)
+        )
+        room_ids = set(
+            ChatRoom.objects.filter(id__in={item.room_id for item in batch}).values_list('id', flat=True)
+        )
+        stored = self._stored_client_ids(batch)
+        results = []
+        rows = []
+        # (user_id, client_msg_id) -> row this batch writes; repeats share it
+        claimed = {}
+        repeats = []
+        for item in batch:
+            if item.user_id not in user_ids:
+                results.append(User.DoesNotExist(f"User {item.user_id!r} does not exist"))
+                continue
+            if item.room_id not in room_ids:
+                results.append(ChatRoom.DoesNotExist(f"Room {item.room_id!r} does not exist"))
+                continue
+            key = (item.user_id, item.client_msg_id)
+            if item.client_msg_id is not None:
+                if key in stored:
+                    results.append(stored[key])
+                    continue
+                if key in claimed:
+                    repeats.append((len(results), key))
+                    results.append(None)
+                    continue
+            row = Message(
+                user_id=item.user_id, room_id=item.room_id, content=item.content,
+                client_msg_id=item.client_msg_id,
+            )
+            if item.client_msg_id is not None:
+                claimed[key] = row
+            rows.append(row)
+            results.append(row)
+
+        if rows:
+            # bulk_create skips Message.save(), so encrypt the whole batch here
+            started = perf_counter()
+            tokens = get_cipher().encrypt_many([row.content for row in rows])
+            metrics.ENCRYPT_SECONDS.observe(perf_counter() - started)
+            for row, token in zip(rows, tokens):
+                row._decrypted_content = row.content
+                row.content = token
+            with transaction.atomic():
+                # Number the batch per room with one reservation each, inside
+                # the transaction so a failed insert doesn't leave a gap
+                by_room = {}
+                for row in rows:
+                    by_room.setdefault(row.room_id, []).append(row)
+                for room_id, room_rows in by_room.items():
+                    first = ChatRoom.allocate_seq(room_id, len(room_rows))
+                    for offset, row in enumerate(room_rows):
+                        row.seq = first + offset
+                Message.objects.bulk_create(rows)
+                MessageSearchToken.objects.bulk_create(index_rows(rows))
+
+        for index, key in repeats:
+            duplicate = copy.copy(claimed[key])
+            duplicate._duplicate = True
+            results[index] = duplicate
+        return results
+
+    def _stored_client_ids(self, batch):
+        """Already stored messages for the batch's client_msg_ids, keyed by (user_id, client_msg_id)."""
+        keys = {(item.user_id, item.client_msg_id) for item in batch if item.client_msg_id is not None}
+        if not keys:
+            return {}
+        stored = {}
+        candidates = Message.objects.filter(
+            user_id__in={user_id for user_id, _ in keys},
+            client_msg_id__in={client_msg_id for _, client_msg_id in keys},
+        ).only('id', 'room_id', 'user_id', 'content', 'timestamp', 'seq', 'client_msg_id')
+        for message in candidates:
+            key = (message.user_id, message.client_msg_id)
+            if key in keys:
+                message._duplicate = True
+                stored[key] = message
+        return stored
+
+    def drain(self):
+        """Synchronously write anything still queued. Used at interpreter shutdown."""
+        while self._pending:
+            batch = [self._pending.popleft() for _ in range(min(len(self._pending), self.max_batch))]
+            try:
+                self.write_batch(batch)
+            except Exception:
+                logger.exception("Dropped %d queued messages at shutdown", len(batch))
+
+
+_writer = None
+
+
+def get_writer():
+    """Return the process-wide MessageWriter, creating it from settings on first use."""
+    global _writer
+    if _writer is None:
+        _writer = MessageWriter(
+            max_batch=getattr(settings, 'CHAT_WRITE_BATCH_SIZE', 100),
+            max_delay=getattr(settings, 'CHAT_WRITE_BATCH_DELAY', 0.005),
+        )
+        atexit.register(_writer.drain)
+    return _writer
@@ -0,0 +1,165 @@
+"""
+Who is online in each room.
+
+Every accepted WebSocket is tracked under its room and user; a user is online
+in a room while they have at least one live connection there. Connections
+stay live while the client sends anything (the page sends a 'heartbeat' frame
+every `timeout / 3` seconds) and expire `timeout` seconds after the last
+frame, so a socket whose disconnect never ran drops out on its own.
+
+Joins and leaves are not broadcast as they happen. Every `interval` seconds
+each room whose set of users changed gets one 'presence' event with the users
+who joined and left since the last one (or, when more than `list_limit` did,
+only the new count), so a join storm costs one small broadcast per room per
+interval instead of one per join to every member. Events go to the room's
+presence group, which only connections that asked for presence
+(`?presence=1`) join; every connection is counted either way.
+
+The state is per process: with several workers behind chat_app.broker each
+worker counts its own connections.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .fanout import broadcast_event
+
+
+def presence_group(room_name):
+    """The channel layer group of a room's connections that follow presence."""
+    return f'presence_{room_name}'
+
+
+class PresenceTracker:
+    def __init__(self, interval=1.0, timeout=60.0, list_limit=100):
+        self.interval = interval
+        self.timeout = timeout
+        self.list_limit = list_limit
+        # channel name -> (room, username, expiry), least recently seen first;
+        # every connection gets the same timeout, so this is also expiry order
+        self._connections = OrderedDict()
+        # room -> {username: live connections}
+        self._users = {}
+        # room -> users online as of the last event sent to it
+        self._announced = {}
+        # room -> usernames whose state may have changed since then
+        self._dirty = {}
+        self._flusher = None
+
+    def touch(self, room, username, channel):
+        """Record a connection as alive, adding it if it is new (or had expired)."""
+        expires = time.monotonic() + self.timeout
+        entry = self._connections.get(channel)
+        if entry is not None and entry[0] == room:
+            self._connections[channel] = (room, username, expires)
+            self._connections.move_to_end(channel)
+            return
+        if entry is not None:
+            self.leave(channel)
+        self._connections[channel] = (room, username, expires)
+        users = self._users.get(room)
+        if users is None:
+            users = self._users[room] = {}
+        users[username] = users.get(username, 0) + 1
+        if users[username] == 1:
+            self._dirty.setdefault(room, set()).add(username)
+        self._ensure_flusher()
+
+    def leave(self, channel):
+        entry = self._connections.pop(channel, None)
+        if entry is None:
+            return
+        room, username, _ = entry
+        users = self._users[room]
+        users[username] -= 1
+        if not users[username]:
+            del users[username]
+            if not users:
+                del self._users[room]
+            self._dirty.setdefault(room, set()).add(username)
+            self._ensure_flusher()
+
+    def count(self, room):
+        """Users online in a room. O(1), so pages can ask for every room."""
+        return len(self._users.get(room, ()))
+
+    def online(self, room):
+        """The usernames online in a room, sorted."""
+        return sorted(self._users.get(room, ()))
+
+    def snapshot(self, room):
+        """
+        The 'presence' frame a newly connected client starts from. Rooms with
+        more than list_limit users only get the count, so joining a big room
+        doesn't cost a scan of its members.
+        """
+        count = self.count(room)
+        snapshot = {'type': 'presence', 'count': count, 'heartbeat': self.timeout / 3}
+        if count > self.list_limit:
+            snapshot['truncated'] = True
+        else:
+            snapshot['online'] = self.online(room)
+        return snapshot
+
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        while self._connections:
+            channel, (_, _, expires) = next(iter(self._connections.items()))
+            if expires > now:
+                break
+            self.leave(channel)
+
+    async def flush(self, channel_layer=None):
+        """Expire silent connections and send one diff to every room whose users changed."""
+        self.expire()
+        if not self._dirty:
+            return
+        channel_layer = channel_layer or get_channel_layer()
+        dirty, self._dirty = self._dirty, {}
+        for room, usernames in dirty.items():
+            users = self._users.get(room, {})
+            announced = self._announced.setdefault(room, set())
+            joined = sorted(name for name in usernames if name in users and name not in announced)
+            left = sorted(name for name in usernames if name not in users and name in announced)
+            announced.update(joined)
+            announced.difference_update(left)
+            if not announced:
+                del self._announced[room]
+            if not joined and not left:
+                continue  # joined and left again within the interval
+            event = {'type': 'presence', 'count': len(users)}
+            if len(joined) + len(left) > self.list_limit:
+                event['truncated'] = True
+            else:
+                event['joined'] = joined
+                event['left'] = left
+            await channel_layer.group_send(presence_group(room), broadcast_event(event))
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._flusher = loop.create_task(self._run())
+
+    async def _run(self):
+        # Runs while there are connections to expire or changes to announce
+        while self._connections or self._dirty:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+
+_tracker = None
+
+
+def get_presence():
+    """Return the process-wide PresenceTracker, configured from settings on first use."""
+    global _tracker
+    if _tracker is None:
+        _tracker = PresenceTracker(
+            interval=getattr(settings, 'CHAT_PRESENCE_INTERVAL', 1.0),
+            timeout=getattr(settings, 'CHAT_PRESENCE_TIMEOUT', 60.0),
+            list_limit=getattr(settings, 'CHAT_PRESENCE_LIST_LIMIT', 100),
+        )
+    return _tracker
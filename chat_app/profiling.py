@@ -0,0 +1,179 @@
+"""
+On-demand sampling profiler for a running worker.
+
+While a ProfileSession is active a background thread snapshots the stack of
+every thread (sys._current_frames) each `interval` seconds and counts the
+stacks. The result is in the collapsed format flamegraph.pl and speedscope
+read: one `root;caller;callee count` line per distinct stack. Each stack is
+rooted at its thread, so the event loop ("MainThread" under Daphne) and the
+sync_to_async pool ("ThreadPoolExecutor-N") show up side by side:
+
+* loop samples outside the selector's select() are time the loop was busy,
+  and tall, wide towers there are what blocks it;
+* pool threads in the database or crypto code all the time mean the pool is
+  saturated, and callers queue behind it.
+
+Coroutines decorated with @timed also record their wall time while a session
+is active; outside one they cost a single global lookup. Nothing is sampled
+or recorded unless a session is running, and only one runs at a time per
+process. views.profile starts one over HTTP (staff only).
+"""
+import asyncio
+import functools
+import os
+import re
+import sys
+import threading
+from collections import Counter
+from time import perf_counter
+
+_active = None
+_lock = threading.Lock()
+
+# ThreadPoolExecutor-0_3 -> ThreadPoolExecutor-0: one flame per pool, not per thread
+_THREAD_INDEX = re.compile(r'_\d+$')
+
+
+class ProfileInProgress(Exception):
+    pass
+
+
+def _thread_label(name):
+    return _THREAD_INDEX.sub('', name).replace(';', ':').replace(' ', '_')
+
+
+class SamplingProfiler:
+    """Counts the stacks of every other thread, sampled from a daemon thread."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._labels = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='chat-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self.sample(skip=own)
+
+    def sample(self, skip=None):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == skip:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.append(_thread_label(names.get(ident, f'thread-{ident}')))
+            stack.reverse()
+            self.stacks[';'.join(stack)] += 1
+        self.samples += 1
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            filename = '/'.join(code.co_filename.replace(os.sep, '/').split('/')[-2:])
+            # co_qualname is new in Python 3.11
+            name = getattr(code, 'co_qualname', code.co_name)
+            label = f'{name} ({filename}:{code.co_firstlineno})'.replace(';', ':').replace(' ', '_')
+            self._labels[code] = label
+        return label
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(self.stacks.items()))
+
+
+class ProfileSession:
+    def __init__(self, interval):
+        self.profiler = SamplingProfiler(interval)
+        self.timings = {}
+        self.started = None
+        self.duration = None
+
+    def record(self, name, seconds):
+        self.timings.setdefault(name, []).append(seconds)
+
+    def timing_summary(self):
+        """Per-name count, total, mean, p99 and max wall time (milliseconds) of @timed calls."""
+        summary = {}
+        for name, samples in sorted(self.timings.items()):
+            ordered = sorted(samples)
+            summary[name] = {
+                'count': len(ordered),
+                'total_ms': round(sum(ordered) * 1000, 3),
+                'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3),
+                'p99_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000, 3),
+                'max_ms': round(ordered[-1] * 1000, 3),
+            }
+        return summary
+
+    def as_dict(self):
+        return {
+            'seconds': round(self.duration, 3) if self.duration is not None else None,
+            'interval': self.profiler.interval,
+            'samples': self.profiler.samples,
+            'stacks': self.profiler.collapsed(),
+            'timings': self.timing_summary(),
+        }
+
+
+def start(interval=0.005):
+    """Start this process's profiling session; raises ProfileInProgress if one is running."""
+    global _active
+    with _lock:
+        if _active is not None:
+            raise ProfileInProgress("A profile is already running in this process.")
+        session = ProfileSession(interval)
+        session.started = perf_counter()
+        session.profiler.start()
+        _active = session
+    return session
+
+
+def stop(session):
+    global _active
+    with _lock:
+        if _active is session:
+            _active = None
+    session.profiler.stop()
+    session.duration = perf_counter() - session.started
+    return session
+
+
+async def profile(seconds, interval=0.005):
+    """Profile this process for `seconds` without blocking the event loop; returns the session."""
+    session = start(interval)
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        stop(session)
+    return session
+
+
+def timed(name):
+    """Record the wall time of each call of the decorated coroutine function during a session."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            session = _active
+            if session is None:
+                return await func(*args, **kwargs)
+            started = perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                session.record(name, perf_counter() - started)
+        return wrapper
+    return decorator
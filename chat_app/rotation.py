@@ -0,0 +1,117 @@
+"""
+Online re-encryption of message content after a key rotation.
+
+Once a new key is first in CHAT_ENCRYPTION_KEYS, new messages use it and old
+ones still decrypt with the keys behind it. rotate_messages() walks the
+Message table by id, re-encrypting rows that are not under the newest key
+(MultiFernet.rotate, which keeps each token's timestamp). The crypto runs
+outside any transaction; each batch is written in one short transaction, and
+a row is only overwritten if its content is unchanged since it was read, so
+edits made while the job runs are never lost.
+
+Progress is checkpointed to a small JSON file after every batch, tagged with
+a fingerprint of the newest key: an interrupted run resumes after the last
+finished batch, and a run for a different key starts over. Archived messages
+(chat_app.archive) are not rewritten, so keep a retired key in the ring while
+the archive holds messages encrypted under it.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .crypto import get_cipher
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+
+def key_fingerprint(key):
+    """A short, non-secret name for a key, as recorded in the checkpoint."""
+    return hashlib.sha256(key if isinstance(key, bytes) else key.encode('utf-8')).hexdigest()[:16]
+
+
+def state_path():
+    return str(getattr(settings, 'CHAT_KEY_ROTATION_STATE', os.path.join(settings.BASE_DIR, 'key_rotation.json')))
+
+
+def load_state(path=None):
+    """The last checkpoint, or None if there is none (or it is unreadable)."""
+    try:
+        with open(path or state_path()) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return state if isinstance(state, dict) else None
+
+
+def _save_state(path, state):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def rotate_messages(batch_size=500, pause=0.05, path=None, restart=False, progress=None):
+    """
+    Re-encrypt every message not yet under the newest key, `batch_size` rows
+    per transaction with `pause` seconds between batches. Resumes from the
+    checkpoint at `path` unless `restart`; `progress(state)` is called after
+    each batch. Returns the final state: counts of rows 'rotated', already
+    'current' and 'failed' (no key decrypts them), and the id reached.
+    """
+    path = path or state_path()
+    cipher = get_cipher()
+    fingerprint = key_fingerprint(cipher.key)
+    state = None if restart else load_state(path)
+    if state is None or state.get('key') != fingerprint:
+        state = {
+            'key': fingerprint, 'last_id': 0, 'rotated': 0, 'current': 0, 'failed': 0,
+            'started_at': timezone.now().isoformat(), 'finished_at': None,
+        }
+    # Rows added after this point were written under the newest key, unless a
+    # worker still runs with the old ring; re-running picks those up
+    state['upto'] = Message.objects.aggregate(last=Max('id'))['last'] or 0
+    state['finished_at'] = None
+
+    while state['last_id'] < state['upto']:
+        rows = list(
+            Message.objects.filter(id__gt=state['last_id'], id__lte=state['upto'])
+            .order_by('id')
+            .values_list('id', 'content')[:batch_size]
+        )
+        if not rows:
+            break
+        results = cipher.rotate_many([content for _, content in rows])
+        changed = [(pk, old, new) for (pk, old), new in zip(rows, results) if new]
+        if changed:
+            with transaction.atomic():
+                for pk, old, new in changed:
+                    Message.objects.filter(pk=pk, content=old).update(content=new)
+        failed = [pk for (pk, _), new in zip(rows, results) if new is False]
+        if failed:
+            logger.warning("No key in CHAT_ENCRYPTION_KEYS decrypts messages %s", failed)
+
+        state['last_id'] = rows[-1][0]
+        state['rotated'] += len(changed)
+        state['failed'] += len(failed)
+        state['current'] += len(rows) - len(changed) - len(failed)
+        _save_state(path, state)
+        if progress is not None:
+            progress(state)
+        if pause and len(rows) == batch_size:
+            time.sleep(pause)
+
+    state['last_id'] = max(state['last_id'], state['upto'])
+    state['finished_at'] = timezone.now().isoformat()
+    _save_state(path, state)
+    return state
@@ -0,0 +1,117 @@
+"""
+Keyword search over encrypted messages through a blind index.
+
+Message content is Fernet ciphertext, so the database can't match words in
+it. Every message instead gets one MessageSearchToken row per distinct
+normalized word: a truncated HMAC-SHA256 of the word under CHAT_SEARCH_KEY.
+The index reveals which messages of a room share a word, but not the word.
+
+A query is normalized and hashed the same way, the (room, token) index finds
+the messages holding every query word, and only those rows are decrypted (a
+final check on the plaintext weeds out hash collisions). Tokens are written
+with each message: by the write-behind writer inside its batch transaction
+and by a post_save signal for Message.save(). `manage.py rebuild_search_index`
+rebuilds them in bulk, e.g. for messages stored before the index existed or
+after changing CHAT_SEARCH_KEY.
+"""
+import hashlib
+import hmac
+import re
+import unicodedata
+
+from django.conf import settings
+from django.db.models import Count, Q
+
+from .history import PAGE_SIZE, HistoryEntry, HistoryPage, clamp_limit, decode_cursor
+from .models import Message, MessageSearchToken
+
+TOKEN_BYTES = 16
+# Longer "words" are almost never searched for and would only bloat the index
+MAX_WORD_LENGTH = 64
+MAX_QUERY_WORDS = 8
+
+_WORD = re.compile(r'\w+')
+_key = None
+
+
+def _search_key():
+    global _key
+    if _key is None:
+        secret = getattr(settings, 'CHAT_SEARCH_KEY', None) or settings.SECRET_KEY
+        # Derived, so the index key is never the raw SECRET_KEY
+        _key = hmac.new(secret.encode('utf-8'), b'chat_app.search', hashlib.sha256).digest()
+    return _key
+
+
+def normalize_words(text):
+    """The distinct searchable words of `text`: NFKC, case-folded, in order of appearance."""
+    words = _WORD.findall(unicodedata.normalize('NFKC', text).casefold())
+    return list(dict.fromkeys(word for word in words if len(word) <= MAX_WORD_LENGTH))
+
+
+def word_token(word):
+    return hmac.new(_search_key(), word.encode('utf-8'), hashlib.sha256).digest()[:TOKEN_BYTES]
+
+
+def tokens_for(text):
+    return [word_token(word) for word in normalize_words(text)]
+
+
+def index_rows(messages):
+    """Unsaved MessageSearchToken rows for saved messages whose plaintext is loaded."""
+    return [
+        MessageSearchToken(message_id=message.pk, room_id=message.room_id, token=token)
+        for message in messages
+        for token in tokens_for(message._decrypted_content)
+    ]
+
+
+def index_message(message, created=True):
+    """(Re)index one saved message whose plaintext is loaded."""
+    if not created:
+        MessageSearchToken.objects.filter(message_id=message.pk).delete()
+    MessageSearchToken.objects.bulk_create(index_rows([message]))
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+def search(room_id, query, before=None, limit=PAGE_SIZE):
+    """
+    HistoryPage of the newest messages in a room containing every word of
+    `query` (oldest first), older than the `before` history cursor if given.
+    """
+    words = normalize_words(query or '')
+    if not words:
+        raise InvalidQuery("Search needs at least one word.")
+    if len(words) > MAX_QUERY_WORDS:
+        raise InvalidQuery(f"Search for at most {MAX_QUERY_WORDS} words.")
+    limit = clamp_limit(limit)
+
+    matches = MessageSearchToken.objects.filter(room_id=room_id, token__in=[word_token(w) for w in words])
+    if before:
+        # The same (timestamp, id) order as history pages, so the cursor of a
+        # backdated or imported message pages correctly
+        timestamp, pk = decode_cursor(before)
+        matches = matches.filter(
+            Q(message__timestamp__lt=timestamp) | Q(message__timestamp=timestamp, message_id__lt=pk)
+        )
+    rows = (
+        matches.values('message_id', 'message__timestamp')
+        .annotate(hits=Count('id'))
+        .filter(hits=len(words))
+        .order_by('-message__timestamp', '-message_id')[:limit + 1]
+    )
+    ids = [row['message_id'] for row in rows]
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+
+    messages = Message.prefetch_decrypted(
+        Message.objects.filter(pk__in=ids).select_related('user').order_by('timestamp', 'id')
+    )
+    entries = [
+        HistoryEntry.from_message(message) for message in messages
+        if set(words) <= set(normalize_words(message.decrypted_content))
+    ]
+    return HistoryPage(entries, has_more)
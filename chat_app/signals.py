@@ -0,0 +1,40 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .caches import get_room_id_cache
+from .history import get_recent_messages
+from .models import ChatRoom, Message
+from .search import index_message
+
+
+@receiver(post_save, sender=ChatRoom)
+def room_saved(sender, instance, created, **kwargs):
+    # Drop whatever name this id was cached under (handles renames), then
+    # prime the current name so the first socket to join doesn't hit the DB
+    cache = get_room_id_cache()
+    cache.invalidate(instance.pk)
+    cache.put(instance.name, instance.pk)
+    if created:
+        # A new room has no history; never serve a buffer left over under this id
+        get_recent_messages().discard(instance.pk)
+
+
+@receiver(post_delete, sender=ChatRoom)
+def room_deleted(sender, instance, **kwargs):
+    get_room_id_cache().invalidate(instance.pk)
+    get_recent_messages().discard(instance.pk)
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def message_changed(sender, instance, **kwargs):
+    # The consumer appends its own (bulk_create) writes to the recent-message
+    # buffer; anything written through the model is picked up by re-seeding
+    get_recent_messages().discard(instance.room_id)
+
+
+@receiver(post_save, sender=Message)
+def index_saved_message(sender, instance, created, raw=False, **kwargs):
+    # Only when save() had the plaintext; rebuild_search_index covers the rest
+    if not raw and '_decrypted_content' in instance.__dict__:
+        index_message(instance, created)
@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+import django
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+from datetime import timedelta
+from io import StringIO
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.utils import timezone
+from chat_app.archive import apply_retention, archive_room, get_archive_store
+from chat_app.history import fetch_page, fetch_since, recent_page
+from chat_app.models import ChatRoom, Message
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        override = override_settings(CHAT_ARCHIVE_DIR=self.archive_dir, CHAT_RETENTION_DAYS=None)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+
+        self.user = User.objects.create_user(username='archive_user', password='password')
+        self.room = ChatRoom.objects.create(name='archive_room', retention_days=30)
+        self.kept = ChatRoom.objects.create(name='kept_room')
+        now = timezone.now()
+        for i in range(10):
+            message = Message.objects.create(user=self.user, room=self.room, content=f"m{i}")
+            # m0-m5 are old, spread over two months; m6-m9 are recent
+            age = timedelta(days=90 - i) if i < 3 else timedelta(days=40 - i) if i < 6 else timedelta(minutes=10 - i)
+            Message.objects.filter(pk=message.pk).update(timestamp=now - age)
+        Message.objects.create(user=self.user, room=self.kept, content="forever")
+        Message.objects.filter(room=self.kept).update(timestamp=now - timedelta(days=900))
+
+    def test_old_messages_move_to_compressed_segments(self):
+        moved = apply_retention(batch_size=4, pause=0)
+        self.assertEqual(moved, {'archive_room': 6})
+        self.assertEqual(
+            list(Message.objects.filter(room=self.room).order_by('id').values_list('seq', flat=True)),
+            [7, 8, 9, 10],
+        )
+        self.assertEqual(Message.objects.filter(room=self.kept).count(), 1)
+
+        store = get_archive_store()
+        self.assertEqual(len(store.months(self.room.id)), 2)
+        self.assertEqual(sum(len(store.read(self.room.id, month, entry)) for month, entry in store.entries(self.room.id)), 6)
+        for name in os.listdir(os.path.join(self.archive_dir, str(self.room.id))):
+            with open(os.path.join(self.archive_dir, str(self.room.id), name), 'rb') as segment:
+                self.assertNotIn(b'm0', segment.read())
+
+        self.assertEqual(apply_retention(pause=0), {})
+
+    def test_history_continues_into_the_archive(self):
+        apply_retention(batch_size=4, pause=0)
+        newest = fetch_page(self.room.id, limit=3)
+        self.assertEqual([m.message for m in newest.messages], ["m7", "m8", "m9"])
+        older = fetch_page(self.room.id, before=newest.before, limit=3)
+        self.assertEqual([m.message for m in older.messages], ["m4", "m5", "m6"])
+        self.assertTrue(older.has_more)
+        oldest = fetch_page(self.room.id, before=older.before, limit=5)
+        self.assertEqual([m.message for m in oldest.messages], ["m0", "m1", "m2", "m3"])
+        self.assertFalse(oldest.has_more)
+        self.assertEqual([m.seq for m in oldest.messages], [1, 2, 3, 4])
+
+        forward = fetch_page(self.room.id, after=oldest.after, limit=4)
+        self.assertEqual([m.message for m in forward.messages], ["m4", "m5", "m6", "m7"])
+        self.assertTrue(forward.has_more)
+
+        self.assertEqual([m.message for m in recent_page(self.room.id, limit=100).messages], [f"m{i}" for i in range(10)])
+
+    def test_replay_reaches_into_the_archive(self):
+        apply_retention(pause=0)
+        page = fetch_since(self.room.id, 4, limit=3)
+        self.assertEqual([m.seq for m in page.messages], [5, 6, 7])
+        self.assertTrue(page.has_more)
+
+    def test_blocks_out_of_timestamp_order_are_paged_in_order(self):
+        room = ChatRoom.objects.create(name='backdated_room', retention_days=30)
+        now = timezone.now()
+        # Ids in this order, timestamps not: each block of two spans the other
+        for name, days in [('a', 50), ('b', 60), ('c', 55), ('d', 45)]:
+            message = Message.objects.create(user=self.user, room=room, content=name)
+            Message.objects.filter(pk=message.pk).update(timestamp=now - timedelta(days=days))
+        self.assertEqual(archive_room(room.id, now - timedelta(days=30), batch_size=2, pause=0), 4)
+
+        seen, before = [], None
+        while True:
+            page = fetch_page(room.id, before=before, limit=1)
+            seen = [m.message for m in page.messages] + seen
+            if not page.has_more:
+                break
+            before = page.before
+        self.assertEqual(seen, ['b', 'c', 'a', 'd'])
+
+        seen, after = [], page.after
+        while True:
+            page = fetch_page(room.id, after=after, limit=1)
+            seen += [m.message for m in page.messages]
+            if not page.has_more:
+                break
+            after = page.after
+        self.assertEqual(seen, ['c', 'a', 'd'])
+
+    def test_interrupted_run_is_recovered(self):
+        store = get_archive_store()
+        cutoff = timezone.now() - timedelta(days=30)
+        rows = [[m.pk, m.seq, m.user_id, 'archive_user', 0, m.content] for m in Message.objects.filter(room=self.room)[:2]]
+
+        # Block written but rows never deleted: dropped, then archived again
+        store.write_block(self.room.id, '1970-01', rows)
+        with self.assertLogs('chat_app.archive', 'WARNING'):
+            self.assertEqual(archive_room(self.room.id, cutoff, pause=0), 6)
+        self.assertEqual(len(store.entries(self.room.id)), 2)
+        self.assertFalse(os.path.exists(os.path.join(self.archive_dir, str(self.room.id), '1970-01.idx')))
+        self.assertEqual(os.path.getsize(os.path.join(self.archive_dir, str(self.room.id), '1970-01.seg')), 0)
+
+        # Block written and rows deleted, but never indexed: indexed on the next run
+        live = Message.objects.filter(room=self.room).order_by('id')[:1]
+        rows = [[m.pk, m.seq, m.user_id, 'archive_user', 0, m.content] for m in live]
+        store.write_block(self.room.id, '1970-01', rows)
+        Message.objects.filter(pk=rows[0][0]).delete()
+        archive_room(self.room.id, cutoff, pause=0)
+        self.assertEqual(len(store.entries(self.room.id)), 3)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('apply_retention', '--pause', '0', stdout=out)
+        self.assertIn("archive_room: archived 6 messages", out.getvalue())
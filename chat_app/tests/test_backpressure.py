@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import socket
+import asyncio
+import subprocess
+import django
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+from unittest import mock
+from django.test import SimpleTestCase, TestCase
+from django.contrib.auth.models import User
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from channels.routing import URLRouter
+from channels.auth import AuthMiddlewareStack
+from chat_app import routing
+from chat_app.backpressure import (
+    HISTORY, MESSAGE, SLOW_CONSUMER_CLOSE_CODE, TYPING, OutboundQueue, stats,
+)
+from chat_app.fanout import broadcast_event
+from chat_app.models import ChatRoom
+
+
+class GatedSend:
+    """A socket that accepts nothing until the gate opens."""
+
+    def __init__(self):
+        self.gate = asyncio.Event()
+        self.sent = []
+
+    async def __call__(self, text_data=None, bytes_data=None):
+        await self.gate.wait()
+        self.sent.append(text_data if text_data is not None else bytes_data)
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def setUp(self):
+        stats.reset()
+
+    async def test_frames_are_sent_in_order(self):
+        send = GatedSend()
+        queue = OutboundQueue(send, high_water=100, max_bytes=1000)
+        for text in ('a', 'b', 'c'):
+            queue.put(MESSAGE, text)
+        send.gate.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(send.sent, ['a', 'b', 'c'])
+        self.assertEqual((queue.size, stats.queued_bytes), (0, 0))
+
+    async def test_typing_then_history_are_shed_first(self):
+        send = GatedSend()
+        queue = OutboundQueue(send, high_water=30, max_bytes=1000)
+        queue.put(MESSAGE, 'm' * 10)
+        queue.put(TYPING, 't' * 10)
+        queue.put(HISTORY, 'h' * 10)
+        await asyncio.sleep(0)  # the first message is now in flight
+
+        self.assertTrue(queue.put(TYPING, 't' * 10))  # over the mark: dropped
+        self.assertTrue(queue.put(MESSAGE, 'n' * 10))  # sheds the queued typing frame
+        self.assertTrue(queue.put(MESSAGE, 'o' * 10))  # then the queued history page
+        self.assertEqual(stats.typing_dropped, 2)
+        self.assertEqual(stats.history_skipped, 1)
+        self.assertEqual(stats.high_water_crossings, 1)
+
+        send.gate.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(send.sent, ['m' * 10, 'n' * 10, 'o' * 10])
+
+    async def test_backlog_past_the_limit_is_evicted(self):
+        send = GatedSend()
+        queue = OutboundQueue(send, high_water=10, max_bytes=25)
+        queue.put(MESSAGE, 'x' * 10)
+        queue.put(MESSAGE, 'x' * 10)
+        self.assertFalse(queue.put(MESSAGE, 'x' * 10))
+        self.assertEqual((len(queue), stats.evicted), (0, 1))
+
+    async def test_a_single_large_frame_is_accepted(self):
+        send = GatedSend()
+        queue = OutboundQueue(send, high_water=10, max_bytes=20)
+        self.assertTrue(queue.put(HISTORY, 'h' * 100))
+        queue.discard()
+
+    async def test_skipped_history_leaves_its_notice(self):
+        """A shed page is answered with its small notice, so the client can retry."""
+        send = GatedSend()
+        queue = OutboundQueue(send, high_water=30, max_bytes=1000)
+        queue.put(MESSAGE, 'm' * 10)
+        queue.put(HISTORY, 'h' * 10, notice='skip1')
+        await asyncio.sleep(0)  # the first message is now in flight
+
+        self.assertTrue(queue.put(HISTORY, 'h' * 30, notice='skip2'))  # over the mark: skipped
+        self.assertTrue(queue.put(MESSAGE, 'n' * 20))  # sheds the queued page
+        self.assertEqual(stats.history_skipped, 2)
+
+        send.gate.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(send.sent, ['m' * 10, 'skip1', 'skip2', 'n' * 20])
+
+
+class SlowConsumerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='slow_user', password='password')
+        self.room = ChatRoom.objects.create(name='slow_room')
+        stats.reset()
+
+    async def test_slow_connection_is_closed(self):
+        send = None
+
+        def stalled_queue(socket_send, flow=None):
+            nonlocal send
+            send = GatedSend()
+            return OutboundQueue(send, high_water=100, max_bytes=500)
+
+        with mock.patch('chat_app.consumers.outbound_queue', stalled_queue):
+            test_app = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+            communicator = WebsocketCommunicator(test_app, f"/ws/chat/{self.room.name}/")
+            communicator.scope['user'] = self.user
+            await communicator.connect()
+
+            layer = get_channel_layer()
+            await layer.group_send('chat_slow_room', broadcast_event({'type': 'typing_state', 'typing': ['a']}))
+            for i in range(10):
+                await layer.group_send('chat_slow_room', broadcast_event({
+                    'type': 'chat_message', 'message': 'x' * 100, 'username': 'other',
+                }))
+            output = await communicator.receive_output()
+
+        self.assertEqual(output, {'type': 'websocket.close', 'code': SLOW_CONSUMER_CLOSE_CODE})
+        self.assertEqual(stats.evicted, 1)
+        self.assertEqual(stats.queued_bytes, 0)
+        self.assertEqual(send.sent, [])
+        await communicator.disconnect()
+
+
+# A Daphne server whose one WebSocket app writes 16 KiB frames through an
+# OutboundQueue until it is told to close the connection, then reports why
+DAPHNE_FLOOD = """
+import asyncio, json, sys, django
+django.setup()
+from daphne.server import Server
+from chat_app.backpressure import MESSAGE, OutboundQueue, TransportFlowMiddleware
+
+async def app(scope, receive, send):
+    if scope['type'] != 'websocket':
+        return
+    await receive()
+    await send({'type': 'websocket.accept'})
+
+    async def send_frame(text_data=None, bytes_data=None):
+        await send({'type': 'websocket.send', 'text': text_data})
+
+    queue = OutboundQueue(send_frame, high_water=64 * 1024, max_bytes=256 * 1024, flow=scope['transport_flow'])
+    for sent in range(2000):
+        if not queue.put(MESSAGE, 'x' * 16384):
+            break
+        await asyncio.sleep(0)
+    print(json.dumps({'flow': scope['transport_flow'] is not None, 'evicted': sent < 1999, 'frames': sent}), flush=True)
+
+Server(
+    TransportFlowMiddleware(app), endpoints=['tcp:port=%s:interface=127.0.0.1' % sys.argv[1]],
+    signal_handlers=False, ready_callable=lambda: print('ready', flush=True),
+).run()
+"""
+
+
+class DaphneFlowTests(SimpleTestCase):
+    def test_client_that_stops_reading_fills_the_queue(self):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        server = subprocess.Popen(
+            [sys.executable, '-c', DAPHNE_FLOOD, str(port)],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+            env=dict(os.environ, DJANGO_SETTINGS_MODULE='config.settings'),
+        )
+        self.addCleanup(server.wait)
+        self.addCleanup(server.kill)
+        self.assertEqual(server.stdout.readline().strip(), 'ready')
+
+        # Handshake, then never read again: the server's socket buffers fill
+        client = socket.socket()
+        self.addCleanup(client.close)
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        client.connect(('127.0.0.1', port))
+        client.sendall(
+            b'GET /ws/ HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+            b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n'
+        )
+        self.assertIn(b' 101 ', client.recv(256))
+
+        result = json.loads(server.stdout.readline())
+        self.assertTrue(result['flow'])
+        self.assertTrue(result['evicted'])
+        self.assertLess(result['frames'], 1999)
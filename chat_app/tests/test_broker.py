@@ -0,0 +1,145 @@
+import os
+import asyncio
+import tempfile
+from contextlib import asynccontextmanager
+import django
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+from django.test import SimpleTestCase
+from chat_app.broker import ChatBroker, encode_frame, read_frame, channel_owner
+from chat_app.layers import SocketChannelLayer
+
+class FrameTests(SimpleTestCase):
+    async def test_frame_round_trip_with_bytes(self):
+        reader = asyncio.StreamReader()
+        ops = [['send', 'specific..abc!x', {'type': 'chat.broadcast', 'bytes': b'\x00\xff'}]]
+        reader.feed_data(encode_frame(ops) + encode_frame([['hello', 'w']]))
+        self.assertEqual(await read_frame(reader), ops)
+        self.assertEqual(await read_frame(reader), [['hello', 'w']])
+
+    def test_channel_owner(self):
+        self.assertEqual(channel_owner('specific..a1b2!xyz'), 'a1b2')
+
+class SocketLayerTests(SimpleTestCase):
+    """Two layers on one broker stand in for two worker processes."""
+
+    @asynccontextmanager
+    async def workers(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'broker.sock')
+            self.broker = await ChatBroker(path).start()
+            worker_a = SocketChannelLayer(path=path)
+            worker_b = SocketChannelLayer(path=path)
+            try:
+                yield worker_a, worker_b
+            finally:
+                await worker_a.close()
+                await worker_b.close()
+                await self.broker.close()
+
+    async def _settle(self):
+        # Let both outboxes flush and the broker route the frames
+        for _ in range(5):
+            await asyncio.sleep(0.01)
+
+    async def test_send_crosses_processes(self):
+        async with self.workers() as (worker_a, worker_b):
+            channel_b = await worker_b.new_channel()
+            receive = asyncio.create_task(worker_b.receive(channel_b))
+            await self._settle()
+
+            await worker_a.send(channel_b, {'type': 'hello', 'text': 'from a'})
+            self.assertEqual((await asyncio.wait_for(receive, 2))['text'], 'from a')
+
+    async def test_group_send_reaches_members_in_every_process(self):
+        async with self.workers() as (worker_a, worker_b):
+            channel_a = await worker_a.new_channel()
+            channels_b = [await worker_b.new_channel() for _ in range(3)]
+            await worker_a.group_add('chat_room', channel_a)
+            for channel in channels_b:
+                await worker_b.group_add('chat_room', channel)
+            await self._settle()
+
+            await worker_a.group_send('chat_room', {'type': 'chat.broadcast', 'text': 'all'})
+            for layer, channel in [(worker_a, channel_a)] + [(worker_b, c) for c in channels_b]:
+                message = await asyncio.wait_for(layer.receive(channel), 2)
+                self.assertEqual(message['text'], 'all')
+
+    async def test_disconnected_worker_leaves_groups(self):
+        async with self.workers() as (worker_a, worker_b):
+            channel_b = await worker_b.new_channel()
+            await worker_b.group_add('chat_room', channel_b)
+            await self._settle()
+            self.assertIn(channel_b, self.broker.groups['chat_room'][worker_b.worker_id])
+
+            await worker_b.close()
+            await self._settle()
+            self.assertNotIn('chat_room', self.broker.groups)
+
+    async def test_reconnect_replaces_stale_memberships(self):
+        async with self.workers():
+            path = self.broker.path
+            old_reader, old_writer = await asyncio.open_unix_connection(path)
+            old_writer.write(encode_frame([['hello', 'w1'], ['group_add', 'chat_room', 'specific..w1!old']]))
+            await self._settle()
+
+            # The same worker again, before the broker saw the old connection close
+            _, new_writer = await asyncio.open_unix_connection(path)
+            new_writer.write(encode_frame([['hello', 'w1'], ['group_add', 'chat_room', 'specific..w1!new']]))
+            await self._settle()
+            self.assertEqual(self.broker.groups['chat_room'], {'w1': {'specific..w1!new'}})
+            self.assertEqual(await asyncio.wait_for(old_reader.read(), 2), b'')
+            old_writer.close()
+            new_writer.close()
+
+    async def test_publishing_waits_for_a_slow_broker(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'broker.sock')
+            stalled = asyncio.Event()
+            # A broker that accepts the connection and never reads from it
+            server = await asyncio.start_unix_server(lambda reader, writer: stalled.wait(), path=path)
+            layer = SocketChannelLayer(path=path)
+            sent = 0
+
+            async def flood():
+                nonlocal sent
+                while True:
+                    await layer.group_send('chat_room', {'type': 'chat.broadcast', 'text': 'x' * 65536})
+                    sent += 1
+                    await asyncio.sleep(0)
+
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(flood(), 1)
+            self.assertLess(sent, 100)
+            self.assertLess(layer._writer.transport.get_write_buffer_size(), 1024 * 1024)
+            stalled.set()
+            await layer.close()
+            server.close()
+            await server.wait_closed()
+
+    async def test_worker_that_stops_reading_is_dropped(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'broker.sock')
+            broker = await ChatBroker(path, max_pending=5).start()
+            publisher = SocketChannelLayer(path=path)
+            # Joins a group, then never reads its deliveries
+            _, writer = await asyncio.open_unix_connection(path)
+            writer.write(encode_frame([['hello', 'w1'], ['group_add', 'chat_room', 'specific..w1!a']]))
+            await self._settle()
+            try:
+                with self.assertLogs('chat_app.broker', 'WARNING'):
+                    for _ in range(200):
+                        await publisher.group_send('chat_room', {'type': 'chat.broadcast', 'text': 'x' * 65536})
+                        await asyncio.sleep(0)
+                        if 'w1' not in broker.workers:
+                            break
+                self.assertNotIn('w1', broker.workers)
+                self.assertNotIn('chat_room', broker.groups)
+            finally:
+                writer.close()
+                await publisher.close()
+                await broker.close()
@@ -0,0 +1,155 @@
+import os
+import django
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+import asyncio
+import sys
+import time
+from unittest import mock
+from django.test import TestCase
+from django.contrib.auth.models import User
+from channels.testing import WebsocketCommunicator
+from channels.routing import URLRouter
+from channels.auth import AuthMiddlewareStack
+from chat_app import routing
+from chat_app.caches import (
+    PlaintextCache, RoomIdCache, SendDedup, ENTRY_OVERHEAD,
+    get_plaintext_cache, get_room_id_cache, get_send_dedup, resolve_room_id,
+)
+from chat_app.models import ChatRoom, Message
+
+class PlaintextCacheTests(TestCase):
+    def test_hit_miss_counters(self):
+        cache = PlaintextCache()
+        self.assertIsNone(cache.get(1, 'token'))
+        cache.put(1, 'token', 'hello')
+        self.assertEqual(cache.get(1, 'token'), 'hello')
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_changed_ciphertext_is_a_miss(self):
+        """A reused pk or re-encrypted row never returns stale plaintext."""
+        cache = PlaintextCache()
+        cache.put(1, 'old-token', 'old')
+        self.assertIsNone(cache.get(1, 'new-token'))
+
+    def test_evicts_least_recently_used_within_budget(self):
+        entry_cost = sys.getsizeof('a') + ENTRY_OVERHEAD
+        cache = PlaintextCache(max_bytes=entry_cost * 2)
+        cache.put(1, 't1', 'a')
+        cache.put(2, 't2', 'b')
+        cache.get(1, 't1')
+        cache.put(3, 't3', 'c')
+
+        self.assertEqual(cache.get(2, 't2'), None)
+        self.assertEqual(cache.get(1, 't1'), 'a')
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertLessEqual(cache.size, cache.max_bytes)
+
+class DecryptedContentCacheTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='cache_user', password='password')
+        self.room = ChatRoom.objects.create(name='cache_room')
+
+    def test_saved_message_is_served_from_cache(self):
+        """Reloading a saved row reads its plaintext without decrypting."""
+        msg = Message.objects.create(user=self.user, room=self.room, content="Cached text")
+        fresh = Message.objects.get(pk=msg.pk)
+
+        with mock.patch('chat_app.crypto.MessageCipher.decrypt') as decrypt:
+            self.assertEqual(fresh.decrypted_content, "Cached text")
+            decrypt.assert_not_called()
+
+    def test_history_prefetch_fills_cache(self):
+        msg = Message.objects.create(user=self.user, room=self.room, content="From history")
+        get_plaintext_cache().discard(msg.pk)
+
+        Message.prefetch_decrypted(Message.objects.filter(pk=msg.pk))
+        self.assertEqual(get_plaintext_cache().get(msg.pk, Message.objects.get(pk=msg.pk).content), "From history")
+
+class RoomIdCacheTests(TestCase):
+    def test_entries_expire_after_ttl(self):
+        cache = RoomIdCache(ttl=10)
+        cache.put('lobby', 1)
+        self.assertEqual(cache.get('lobby'), 1)
+        with mock.patch('chat_app.caches.time.monotonic', return_value=time.monotonic() + 11):
+            self.assertIsNone(cache.get('lobby'))
+
+    def test_rename_and_delete_invalidate(self):
+        """Room saves and deletes drop the cached name in this process."""
+        room = ChatRoom.objects.create(name='before_rename')
+        self.assertEqual(resolve_room_id('before_rename'), room.id)
+
+        room.name = 'after_rename'
+        room.save()
+        self.assertIsNone(resolve_room_id('before_rename'))
+        self.assertEqual(resolve_room_id('after_rename'), room.id)
+
+        room.delete()
+        self.assertIsNone(get_room_id_cache().get('after_rename'))
+
+    async def test_unknown_room_is_refused(self):
+        user = await User.objects.acreate_user(username='no_room_user', password='password')
+        test_app = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+        communicator = WebsocketCommunicator(test_app, "/ws/chat/does_not_exist/")
+        communicator.scope['user'] = user
+        connected, code = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, 4004)
+
+class SendDedupTests(TestCase):
+    async def test_retry_waits_for_the_original_ack(self):
+        dedup = SendDedup()
+        self.assertIsNone(await dedup.claim((1, 'a')))
+        retry = asyncio.ensure_future(dedup.claim((1, 'a')))
+        await asyncio.sleep(0)
+        self.assertFalse(retry.done())
+        dedup.complete((1, 'a'), 'ack-a')
+        self.assertEqual(await retry, 'ack-a')
+        self.assertEqual(dedup.duplicates, 1)
+
+    async def test_failed_send_lets_a_retry_through(self):
+        dedup = SendDedup()
+        await dedup.claim((1, 'a'))
+        dedup.release((1, 'a'))
+        self.assertIsNone(await dedup.claim((1, 'a')))
+
+    async def test_window_and_size_bounds(self):
+        dedup = SendDedup(window=60, max_entries=2)
+        for key in ((1, 'a'), (1, 'b'), (1, 'c')):
+            await dedup.claim(key)
+            dedup.complete(key, 'ack')
+        self.assertEqual(len(dedup), 2)
+        self.assertIsNone(await dedup.claim((1, 'a')))
+        dedup.complete((1, 'a'), 'ack')
+
+        with mock.patch('chat_app.caches.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(await dedup.claim((1, 'b')))
+        self.assertEqual(len(dedup), 1)
+
+    async def test_socket_retry_is_acked_without_a_second_broadcast(self):
+        user = await User.objects.acreate_user(username='dedup_user', password='password')
+        room = await ChatRoom.objects.acreate(name='dedup_room')
+        get_send_dedup().clear()
+        test_app = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+        communicator = WebsocketCommunicator(test_app, f"/ws/chat/{room.name}/")
+        communicator.scope['user'] = user
+        await communicator.connect()
+
+        send = {'type': 'chat_message', 'message': 'retried', 'client_msg_id': 'r-1'}
+        await communicator.send_json_to(send)
+        ack = await communicator.receive_json_from()
+        self.assertEqual((await communicator.receive_json_from())['type'], 'chat_message')
+
+        await communicator.send_json_to(send)
+        self.assertEqual(await communicator.receive_json_from(), ack)
+        self.assertTrue(await communicator.receive_nothing())
+        self.assertEqual(await Message.objects.filter(room=room).acount(), 1)
+
+        await communicator.send_json_to({'type': 'chat_message', 'message': 'x', 'client_msg_id': 'x' * 65})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'error')
+        await communicator.disconnect()
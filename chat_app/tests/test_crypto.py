@@ -0,0 +1,65 @@
+import os
+import django
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+from cryptography.fernet import Fernet
+from django.test import TestCase
+from django.contrib.auth.models import User
+from chat_app.crypto import MessageCipher, DECRYPTION_ERROR, get_cipher
+from chat_app.models import ChatRoom, Message, ENCRYPTION_KEY
+
+class MessageCipherTests(TestCase):
+    def test_batch_round_trip_preserves_order(self):
+        """encrypt_many/decrypt_many return values in input order."""
+        cipher = MessageCipher(ENCRYPTION_KEY)
+        texts = [f"message {i}" for i in range(20)]
+        self.assertEqual(cipher.decrypt_many(cipher.encrypt_many(texts)), texts)
+
+    def test_bad_tokens_decrypt_to_default(self):
+        """A corrupt row does not break the rest of the batch."""
+        cipher = MessageCipher(ENCRYPTION_KEY)
+        tokens = [cipher.encrypt("good"), "not-a-token"]
+        self.assertEqual(cipher.decrypt_many(tokens), ["good", DECRYPTION_ERROR])
+
+    def test_process_pool_mode(self):
+        """Batches over the threshold are split across worker processes."""
+        cipher = MessageCipher(ENCRYPTION_KEY, pool_threshold=4, pool_workers=2)
+        try:
+            texts = [f"pooled {i}" for i in range(10)]
+            tokens = cipher.encrypt_many(texts)
+            self.assertIsNotNone(cipher._pool)
+            self.assertEqual(cipher.decrypt_many(tokens), texts)
+        finally:
+            cipher.close()
+
+    def test_keyring_encrypts_with_newest_and_decrypts_with_any(self):
+        """Old rows keep decrypting after a new key is put first; rotate_many moves them over."""
+        new_key = Fernet.generate_key()
+        old_token = MessageCipher(ENCRYPTION_KEY).encrypt("before")
+        cipher = MessageCipher([new_key, ENCRYPTION_KEY])
+        self.assertEqual(cipher.decrypt(old_token), "before")
+        self.assertEqual(Fernet(new_key).decrypt(cipher.encrypt("after").encode()), b"after")
+
+        rotated, current, bad = cipher.rotate_many([old_token, cipher.encrypt("now"), "not-a-token"])
+        self.assertEqual(Fernet(new_key).decrypt(rotated.encode()), b"before")
+        self.assertEqual((current, bad), (None, False))
+
+class PrefetchDecryptedTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='crypto_user', password='password')
+        self.room = ChatRoom.objects.create(name='crypto_room')
+
+    def test_prefetch_decrypted_sets_plaintext(self):
+        """History rows are decrypted in one batch and cached on the instance."""
+        for i in range(3):
+            Message.objects.create(user=self.user, room=self.room, content=f"history {i}")
+        messages = Message.prefetch_decrypted(Message.objects.filter(room=self.room).order_by('id'))
+        self.assertEqual([m.decrypted_content for m in messages], ["history 0", "history 1", "history 2"])
+
+    def test_shared_cipher_is_reused(self):
+        """The process keeps a single cipher instance."""
+        self.assertIs(get_cipher(), get_cipher())
@@ -0,0 +1,117 @@
+import os
+import json
+import django
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+from unittest import mock
+from django.test import TestCase
+from django.contrib.auth.models import User
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from channels.routing import URLRouter
+from channels.auth import AuthMiddlewareStack
+from chat_app import routing, wire
+from chat_app.consumers import broadcast_event
+from chat_app.models import ChatRoom
+
+class FanoutTests(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f'fan{i}', password='password') for i in range(3)]
+        self.room = ChatRoom.objects.create(name='fanout')
+
+    async def _connect(self, user):
+        test_app = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+        communicator = WebsocketCommunicator(test_app, f"/ws/chat/{self.room.name}/")
+        communicator.scope['user'] = user
+        await communicator.connect()
+        return communicator
+
+    async def test_broadcast_is_serialized_once(self):
+        """Members forward the sender's encoded frame instead of re-encoding it."""
+        communicators = [await self._connect(user) for user in self.users]
+        event = broadcast_event({'type': 'chat_message', 'message': 'hi', 'username': 'fan0'})
+
+        with mock.patch('chat_app.consumers.json.dumps') as dumps:
+            await get_channel_layer().group_send('chat_fanout', event)
+            frames = [await communicator.receive_from() for communicator in communicators]
+            dumps.assert_not_called()
+
+        self.assertEqual(frames, [event['text']] * 3)
+        self.assertEqual(json.loads(frames[0])['message'], 'hi')
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    async def test_bytes_frames_are_forwarded_as_binary(self):
+        communicator = await self._connect(self.users[0])
+        await get_channel_layer().group_send('chat_fanout', {'type': 'chat.broadcast', 'bytes': b'\x01raw'})
+        response = await communicator.receive_output()
+        self.assertEqual(response['bytes'], b'\x01raw')
+        await communicator.disconnect()
+
+
+class BinaryWireTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='wire_user', password='password')
+        self.room = ChatRoom.objects.create(name='wire_room')
+
+    async def _connect(self, subprotocols=None):
+        test_app = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+        communicator = WebsocketCommunicator(test_app, f"/ws/chat/{self.room.name}/", subprotocols=subprotocols)
+        communicator.scope['user'] = self.user
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, subprotocol
+
+    async def test_json_is_the_default(self):
+        communicator, subprotocol = await self._connect()
+        self.assertIsNone(subprotocol)
+        await communicator.disconnect()
+
+        communicator, subprotocol = await self._connect([wire.JSON_SUBPROTOCOL])
+        self.assertEqual(subprotocol, wire.JSON_SUBPROTOCOL)
+        await communicator.disconnect()
+
+    async def test_binary_send_ack_and_broadcast(self):
+        communicator, subprotocol = await self._connect([wire.SUBPROTOCOL, wire.JSON_SUBPROTOCOL])
+        self.assertEqual(subprotocol, wire.SUBPROTOCOL)
+        await communicator.send_to(bytes_data=wire.encode_client(
+            {'type': 'chat_message', 'message': 'compact', 'client_msg_id': 'b-1'}
+        ))
+
+        usernames = {}
+        ack = wire.decode_server(await communicator.receive_from(), usernames)
+        user = wire.decode_server(await communicator.receive_from(), usernames)
+        chat = wire.decode_server(await communicator.receive_from(), usernames)
+        self.assertEqual(ack, {'type': 'ack', 'seq': 1, 'client_msg_id': 'b-1'})
+        self.assertEqual(user['username'], 'wire_user')
+        self.assertEqual((chat['username'], chat['message'], chat['seq']), ('wire_user', 'compact', 1))
+
+        # The username is only spelled out once per connection
+        await communicator.send_to(bytes_data=wire.encode_client({'type': 'chat_message', 'message': 'again'}))
+        await communicator.receive_from()  # ack
+        self.assertEqual(wire.decode_server(await communicator.receive_from(), usernames)['message'], 'again')
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_binary_frames_are_smaller(self):
+        payload = {
+            'type': 'chat_message', 'message': 'hello there', 'username': 'wire_user',
+            'id': 12345, 'seq': 678, 'cursor': '1792314000123456-12345',
+            'timestamp': '2026-10-18T09:00:00.123456+00:00',
+        }
+        event = broadcast_event(payload)
+        session = wire.Session()
+        session.frames(*event['binary'])  # first use also binds the username
+        frame = session.frames(*event['binary'])[0]
+        self.assertLess(len(frame) * 3, len(event['text'].encode()))
+        self.assertEqual(wire.decode_server(frame, {1: 'wire_user'})['message'], 'hello there')
+
+    async def test_malformed_binary_frame(self):
+        communicator, _ = await self._connect([wire.SUBPROTOCOL])
+        await communicator.send_to(bytes_data=b'\x10\x00\x05ab')
+        self.assertEqual((await communicator.receive_json_from())['type'], 'error')
+        await communicator.disconnect()
@@ -0,0 +1,232 @@
+import os
+import django
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+from django.test import TestCase, Client
+from django.urls import reverse
+from django.contrib.auth.models import User
+from channels.testing import WebsocketCommunicator
+from channels.routing import URLRouter
+from channels.auth import AuthMiddlewareStack
+from chat_app import routing
+from chat_app.history import (
+    HistoryEntry, RecentMessages, fetch_page, recent_page, replay, get_recent_messages,
+    decode_cursor, encode_cursor, InvalidCursor,
+)
+from chat_app.models import ChatRoom, Message
+
+class KeysetHistoryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='history_user', password='password')
+        self.room = ChatRoom.objects.create(name='history_room')
+        for i in range(7):
+            Message.objects.create(user=self.user, room=self.room, content=f"m{i}")
+
+    def test_first_page_is_newest_in_chronological_order(self):
+        page = fetch_page(self.room.id, limit=3)
+        self.assertEqual([m.message for m in page.messages], ["m4", "m5", "m6"])
+        self.assertTrue(page.has_more)
+
+    def test_paging_backwards_and_forwards(self):
+        newest = fetch_page(self.room.id, limit=3)
+        older = fetch_page(self.room.id, before=newest.before, limit=3)
+        oldest = fetch_page(self.room.id, before=older.before, limit=3)
+        self.assertEqual([m.message for m in older.messages], ["m1", "m2", "m3"])
+        self.assertEqual([m.message for m in oldest.messages], ["m0"])
+        self.assertFalse(oldest.has_more)
+
+        newer = fetch_page(self.room.id, after=oldest.after, limit=2)
+        self.assertEqual([m.message for m in newer.messages], ["m1", "m2"])
+
+    def test_cursor_round_trip(self):
+        message = Message.objects.filter(room=self.room).first()
+        self.assertEqual(decode_cursor(encode_cursor(message)), (message.timestamp, message.pk))
+        with self.assertRaises(InvalidCursor):
+            decode_cursor('garbage')
+
+class HistoryEndpointTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='history_http', password='password')
+        self.room = ChatRoom.objects.create(name='history_http_room')
+        for i in range(3):
+            Message.objects.create(user=self.user, room=self.room, content=f"h{i}")
+        self.client.force_login(self.user)
+
+    def test_http_history_page(self):
+        response = self.client.get(reverse('room_history', args=['history_http_room']), {'limit': 2})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([m['message'] for m in data['messages']], ["h1", "h2"])
+        self.assertTrue(data['has_more'])
+
+        response = self.client.get(reverse('room_history', args=['history_http_room']), {'before': data['before']})
+        self.assertEqual([m['message'] for m in response.json()['messages']], ["h0"])
+
+    def test_http_history_rejects_bad_cursor(self):
+        response = self.client.get(reverse('room_history', args=['history_http_room']), {'before': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+    async def test_websocket_fetch_history(self):
+        test_app = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+        communicator = WebsocketCommunicator(test_app, f"/ws/chat/{self.room.name}/")
+        communicator.scope['user'] = self.user
+        await communicator.connect()
+        # Joining without a cursor sends the newest messages straight away
+        joined = await communicator.receive_json_from()
+        self.assertTrue(joined['initial'])
+
+        await communicator.send_json_to({'type': 'fetch_history', 'limit': 2})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['type'], 'history')
+        self.assertEqual([m['message'] for m in response['messages']], ["h1", "h2"])
+
+        await communicator.disconnect()
+
+class RecentMessagesTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='recent_user', password='password')
+        self.room = ChatRoom.objects.create(name='recent_room')
+        for i in range(3):
+            Message.objects.create(user=self.user, room=self.room, content=f"r{i}")
+
+    def test_buffer_is_seeded_once_then_served_from_memory(self):
+        recent_page(self.room.id)
+        with self.assertNumQueries(0):
+            page = recent_page(self.room.id)
+        self.assertEqual([entry.message for entry in page.messages], ["r0", "r1", "r2"])
+
+    def test_appends_roll_the_ring(self):
+        buffer = RecentMessages(per_room=3)
+        entries = fetch_page(self.room.id).messages
+        buffer.seed(self.room.id, entries, False)
+        newest = HistoryEntry(
+            entries[-1].id + 1, self.user.id, 'recent_user', "r3", entries[-1].timestamp, entries[-1].seq + 1
+        )
+        buffer.append(self.room.id, newest)
+
+        kept, truncated = buffer.get(self.room.id)
+        self.assertEqual([entry.message for entry in kept], ["r1", "r2", "r3"])
+        self.assertTrue(truncated)
+
+    def test_appends_during_seeding_are_kept(self):
+        buffer = RecentMessages()
+        pending = buffer.begin_seed(self.room.id)
+        entries = fetch_page(self.room.id).messages
+        last = entries[-1]
+        # The consumer appends while the page is being read: one message the
+        # read already saw, and one written after it
+        buffer.append(self.room.id, last)
+        buffer.append(self.room.id, HistoryEntry(last.id + 1, self.user.id, 'recent_user', "r3", last.timestamp, last.seq + 1))
+        self.assertIsNone(buffer.get(self.room.id))
+
+        buffer.seed(self.room.id, entries, False, pending)
+        kept, _ = buffer.get(self.room.id)
+        self.assertEqual([entry.message for entry in kept], ["r0", "r1", "r2", "r3"])
+
+    def test_discard_during_seeding_wins(self):
+        buffer = RecentMessages()
+        pending = buffer.begin_seed(self.room.id)
+        entries = fetch_page(self.room.id).messages
+        buffer.discard(self.room.id)
+        buffer.seed(self.room.id, entries, False, pending)
+        self.assertIsNone(buffer.get(self.room.id))
+
+    def test_idle_rooms_are_evicted_over_budget(self):
+        entries = fetch_page(self.room.id).messages
+        per_room_bytes = sum(entry.size() for entry in entries)
+        buffer = RecentMessages(max_bytes=per_room_bytes * 2)
+        for room_id in (1, 2, 3):
+            buffer.seed(room_id, entries, False)
+        self.assertIsNone(buffer.get(1))
+        self.assertIsNotNone(buffer.get(3))
+        self.assertEqual(buffer.stats()['evictions'], 1)
+
+    def test_join_after_cursor_only_sends_newer_messages(self):
+        page = recent_page(self.room.id)
+        newer = recent_page(self.room.id, after=page.messages[0].cursor)
+        self.assertEqual([entry.message for entry in newer.messages], ["r1", "r2"])
+
+    def test_model_writes_drop_the_buffer(self):
+        recent_page(self.room.id)
+        Message.objects.create(user=self.user, room=self.room, content="r3")
+        self.assertIsNone(get_recent_messages().get(self.room.id))
+
+    async def test_consumer_sends_are_appended(self):
+        test_app = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+        communicator = WebsocketCommunicator(test_app, f"/ws/chat/{self.room.name}/")
+        communicator.scope['user'] = self.user
+        await communicator.connect()
+        await communicator.receive_json_from()  # initial history seeds the buffer
+
+        await communicator.send_json_to({'type': 'chat_message', 'message': 'live'})
+        await communicator.receive_json_from()  # ack
+        entries, _ = get_recent_messages().get(self.room.id)
+        self.assertEqual(entries[-1].message, 'live')
+        await communicator.disconnect()
+
+class SequenceTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='seq_user', password='password')
+        self.room = ChatRoom.objects.create(name='seq_room')
+        for i in range(5):
+            Message.objects.create(user=self.user, room=self.room, content=f"s{i}")
+
+    def test_messages_are_numbered_per_room(self):
+        other = ChatRoom.objects.create(name='seq_other')
+        first = Message.objects.create(user=self.user, room=other, content="o0")
+        self.assertEqual(list(Message.objects.filter(room=self.room).order_by('id').values_list('seq', flat=True)),
+                         [1, 2, 3, 4, 5])
+        self.assertEqual(first.seq, 1)
+
+    def test_saving_a_stale_room_keeps_its_counter(self):
+        stale = ChatRoom.objects.get(pk=self.room.pk)
+        Message.objects.create(user=self.user, room=self.room, content="s5")
+        stale.name = 'seq_renamed'
+        stale.save()
+        self.assertEqual(ChatRoom.objects.get(pk=self.room.pk).last_seq, 6)
+
+    def test_replay_from_memory(self):
+        recent_page(self.room.id)
+        with self.assertNumQueries(0):
+            page = replay(self.room.id, 3)
+        self.assertEqual([entry.seq for entry in page.messages], [4, 5])
+        self.assertFalse(page.has_more)
+
+    def test_replay_behind_the_buffer_reads_the_db(self):
+        get_recent_messages().seed(self.room.id, fetch_page(self.room.id, limit=2).messages, True)
+        with self.assertNumQueries(1):
+            page = replay(self.room.id, 1, limit=2)
+        self.assertEqual([entry.message for entry in page.messages], ["s1", "s2"])
+        self.assertTrue(page.has_more)
+
+    def test_append_with_a_gap_drops_the_buffer(self):
+        recent_page(self.room.id)
+        entries, _ = get_recent_messages().get(self.room.id)
+        skipped = HistoryEntry(999, self.user.id, 'seq_user', "x", entries[-1].timestamp, entries[-1].seq + 2)
+        get_recent_messages().append(self.room.id, skipped)
+        self.assertIsNone(get_recent_messages().get(self.room.id))
+
+    async def test_reconnect_and_resume_only_send_missed_messages(self):
+        test_app = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+        communicator = WebsocketCommunicator(test_app, f"/ws/chat/{self.room.name}/?last_seq=3")
+        communicator.scope['user'] = self.user
+        await communicator.connect()
+        replayed = await communicator.receive_json_from()
+        self.assertTrue(replayed['resume'])
+        self.assertEqual([m['seq'] for m in replayed['messages']], [4, 5])
+
+        await communicator.send_json_to({'type': 'chat_message', 'message': 'live'})
+        ack = await communicator.receive_json_from()
+        broadcast = await communicator.receive_json_from()
+        self.assertEqual(ack['seq'], 6)
+        self.assertEqual(broadcast['seq'], 6)
+
+        await communicator.send_json_to({'type': 'resume', 'last_seq': 4})
+        resumed = await communicator.receive_json_from()
+        self.assertEqual([m['message'] for m in resumed['messages']], ["s4", "live"])
+        await communicator.disconnect()
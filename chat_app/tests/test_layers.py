@@ -0,0 +1,120 @@
+import os
+import asyncio
+import django
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+import time
+from unittest import mock
+from django.test import SimpleTestCase
+from channels.exceptions import ChannelFull
+from chat_app.layers import ShardedInMemoryChannelLayer
+
+class ShardedLayerTests(SimpleTestCase):
+    async def test_send_receive(self):
+        layer = ShardedInMemoryChannelLayer()
+        channel = await layer.new_channel()
+        await layer.send(channel, {'type': 'test.message', 'text': 'hi'})
+        self.assertEqual(await layer.receive(channel), {'type': 'test.message', 'text': 'hi'})
+
+    async def test_receive_waits_for_send(self):
+        layer = ShardedInMemoryChannelLayer()
+        channel = await layer.new_channel()
+        receiver = asyncio.create_task(layer.receive(channel))
+        await asyncio.sleep(0)
+        await layer.send(channel, {'type': 'late'})
+        self.assertEqual((await asyncio.wait_for(receiver, 1))['type'], 'late')
+
+    async def test_group_send_reaches_every_member(self):
+        layer = ShardedInMemoryChannelLayer(send_batch=10)
+        channels = [await layer.new_channel() for _ in range(50)]
+        for channel in channels:
+            await layer.group_add('room', channel)
+        await layer.group_discard('room', channels[0])
+
+        await layer.group_send('room', {'type': 'chat.broadcast', 'text': 'x'})
+        for channel in channels[1:]:
+            self.assertEqual((await layer.receive(channel))['text'], 'x')
+        self.assertNotIn(channels[0], layer.channels)
+
+    async def test_drop_oldest_keeps_newest(self):
+        layer = ShardedInMemoryChannelLayer(capacity=2, full_policy='drop_oldest')
+        channel = await layer.new_channel()
+        for i in range(3):
+            await layer.send(channel, {'type': 'n', 'i': i})
+        self.assertEqual([(await layer.receive(channel))['i'] for _ in range(2)], [1, 2])
+        self.assertEqual(layer.dropped, 1)
+
+    async def test_raise_policy(self):
+        layer = ShardedInMemoryChannelLayer(capacity=1, full_policy='raise')
+        channel = await layer.new_channel()
+        await layer.send(channel, {'type': 'n'})
+        with self.assertRaises(ChannelFull):
+            await layer.send(channel, {'type': 'n'})
+
+    async def test_close_policy_evicts_slow_channel(self):
+        layer = ShardedInMemoryChannelLayer(capacity=2, full_policy='close')
+        channel = await layer.new_channel()
+        await layer.group_add('room', channel)
+        for _ in range(3):
+            await layer.group_send('room', {'type': 'chat.broadcast', 'text': 'x'})
+
+        self.assertEqual(await layer.receive(channel), {'type': 'layer.overflow'})
+        self.assertNotIn(channel, layer.memberships)
+
+    async def test_dead_channels_expire_from_groups(self):
+        layer = ShardedInMemoryChannelLayer(expiry=1, cleanup_interval=0)
+        channel = await layer.new_channel()
+        await layer.group_add('room', channel)
+        await layer.send(channel, {'type': 'unread'})
+
+        with mock.patch('chat_app.layers.time.time', return_value=time.time() + 5):
+            await layer.group_send('room', {'type': 'after'})
+        self.assertNotIn(channel, layer.memberships)
+
+    async def test_cleanup_only_visits_due_channels(self):
+        layer = ShardedInMemoryChannelLayer(expiry=10, cleanup_interval=0)
+        dead, live = await layer.new_channel(), await layer.new_channel()
+        await layer.send(dead, {'type': 'unread'})
+        with mock.patch('chat_app.layers.time.time', return_value=time.time() + 8):
+            await layer.send(live, {'type': 'fresh'})
+        self.assertEqual(len(layer._expiry_heap), 2)
+
+        with mock.patch('chat_app.layers.time.time', return_value=time.time() + 12):
+            layer._maybe_clean()
+        self.assertNotIn(dead, layer.channels)
+        self.assertEqual(await layer.receive(live), {'type': 'fresh'})
+        self.assertEqual(len(layer._expiry_heap), 1)
+
+    async def test_group_memberships_expire_from_the_heap(self):
+        layer = ShardedInMemoryChannelLayer(group_expiry=100, cleanup_interval=0)
+        old, rejoined, fresh = [await layer.new_channel() for _ in range(3)]
+        await layer.group_add('room', old)
+        await layer.group_add('room', rejoined)
+        with mock.patch('chat_app.layers.time.time', return_value=time.time() + 50):
+            await layer.group_add('room', rejoined)
+            await layer.group_add('room', fresh)
+        self.assertEqual(len(layer._group_heap), 4)
+
+        with mock.patch('chat_app.layers.time.time', return_value=time.time() + 120):
+            layer._maybe_clean()
+        self.assertEqual(set(layer.shards[hash('room') % layer.shard_count]['room']), {rejoined, fresh})
+        self.assertNotIn(old, layer.memberships)
+        # Only the two entries that came due were looked at
+        self.assertEqual(len(layer._group_heap), 2)
+
+    async def test_group_heap_is_rebuilt_when_mostly_stale(self):
+        layer = ShardedInMemoryChannelLayer()
+        channel = await layer.new_channel()
+        for _ in range(500):
+            await layer.group_add('room', channel)
+            await layer.group_discard('room', channel)
+        await layer.group_add('room', channel)
+        self.assertLessEqual(len(layer._group_heap), 2 * 1 + 64)
+
+    def test_rejects_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            ShardedInMemoryChannelLayer(full_policy='block')
@@ -0,0 +1,119 @@
+import os
+import django
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+from time import perf_counter
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.contrib.auth.models import User
+from django.urls import reverse
+from channels.testing import WebsocketCommunicator
+from channels.routing import URLRouter
+from channels.auth import AuthMiddlewareStack
+from chat_app import metrics, routing
+from chat_app.models import ChatRoom, Message
+
+
+class MetricTypeTests(SimpleTestCase):
+    def test_counter_and_gauge_render(self):
+        counter = metrics.Counter('t_events_total', "Events.", ['kind'], register=False)
+        counter.labels('a').inc()
+        counter.labels('a').inc(2)
+        counter.labels('b"x').inc()
+        gauge = metrics.Gauge('t_level', "Level.", register=False)
+        gauge.inc(5)
+        gauge.dec()
+
+        self.assertEqual(counter.render(), (
+            '# HELP t_events_total Events.\n'
+            '# TYPE t_events_total counter\n'
+            't_events_total{kind="a"} 3\n'
+            't_events_total{kind="b\\"x"} 1\n'
+        ))
+        self.assertTrue(gauge.render().endswith('t_level 4\n'))
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('t_seconds', "Durations.", buckets=(0.1, 1), register=False)
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        lines = histogram.render().splitlines()[2:]
+        self.assertEqual(lines, [
+            't_seconds_bucket{le="0.1"} 2',
+            't_seconds_bucket{le="1"} 3',
+            't_seconds_bucket{le="+Inf"} 4',
+            't_seconds_sum 3.65',
+            't_seconds_count 4',
+        ])
+
+    def test_recording_costs_well_under_a_microsecond(self):
+        counter = metrics.Counter('t_fast_total', "Fast.", register=False)
+        histogram = metrics.Histogram('t_fast_seconds', "Fast.", register=False)
+        rounds = 100_000
+        started = perf_counter()
+        for _ in range(rounds):
+            counter.inc()
+            histogram.observe(0.0003)
+        per_event = (perf_counter() - started) / rounds / 2
+        self.assertLess(per_event, 1e-6)
+
+
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='metrics_user', password='password')
+        self.room = ChatRoom.objects.create(name='metrics_room')
+
+    async def test_socket_send_is_counted(self):
+        connects = metrics.WS_CONNECTS.get()
+        saved = metrics.MESSAGES_SAVED.get()
+        frames = metrics.WS_FRAMES_BY_TYPE['chat_message'].get()
+        save_count = sum(metrics.MESSAGE_SAVE_SECONDS.counts)
+
+        test_app = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+        communicator = WebsocketCommunicator(test_app, f"/ws/chat/{self.room.name}/")
+        communicator.scope['user'] = self.user
+        await communicator.connect()
+        open_connections = metrics.WS_OPEN.get()
+        await communicator.send_json_to({'type': 'chat_message', 'message': 'counted'})
+        await communicator.receive_json_from()  # ack
+        await communicator.receive_json_from()  # broadcast
+        await communicator.disconnect()
+
+        self.assertEqual(metrics.WS_CONNECTS.get(), connects + 1)
+        self.assertEqual(metrics.MESSAGES_SAVED.get(), saved + 1)
+        self.assertEqual(metrics.WS_FRAMES_BY_TYPE['chat_message'].get(), frames + 1)
+        self.assertEqual(sum(metrics.MESSAGE_SAVE_SECONDS.counts), save_count + 1)
+        self.assertEqual(metrics.WS_OPEN.get(), open_connections - 1)
+
+    def test_decrypt_errors_are_counted(self):
+        message = Message.objects.create(user=self.user, room=self.room, content='fine')
+        Message.objects.filter(pk=message.pk).update(content='not-a-token')
+        errors = metrics.DECRYPT_ERRORS.get()
+        Message.prefetch_decrypted(Message.objects.filter(pk=message.pk))
+        self.assertEqual(metrics.DECRYPT_ERRORS.get(), errors + 1)
+
+
+class MetricsEndpointTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='metrics_viewer', password='password')
+
+    @override_settings(CHAT_METRICS_ALLOWED_IPS=['127.0.0.1'])
+    def test_allowlisted_scrape(self):
+        self.client.get(reverse('login'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('# TYPE chat_ws_connects_total counter', body)
+        self.assertIn('chat_http_requests_total{view="login",method="GET",status="200"}', body)
+        self.assertIn('chat_plaintext_cache_hits_total', body)
+
+    def test_scrape_needs_staff_by_default(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
@@ -0,0 +1,116 @@
+import os
+import asyncio
+import threading
+import time
+import django
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+from asgiref.sync import SyncToAsync
+from django.test import SimpleTestCase, override_settings
+from chat_app import metrics, monitoring
+
+
+def hold_the_thread(started, release):
+    started.set()
+    release.wait()
+
+
+def block_the_loop():
+    time.sleep(0.3)
+
+
+class MonitoredExecutorTests(SimpleTestCase):
+    def test_slow_wait_is_logged_with_the_busy_stack(self):
+        executor = monitoring.MonitoredExecutor(max_workers=1, name='test_pool', wait_threshold=0.05)
+        slow = metrics.EXECUTOR_SLOW_WAITS.labels('test_pool').get()
+        started, release = threading.Event(), threading.Event()
+        try:
+            with self.assertLogs('chat_app.monitoring', 'WARNING') as logs:
+                executor.submit(hold_the_thread, started, release)
+                started.wait(timeout=1)
+                queued = executor.submit(str, 1)
+                self.assertEqual(executor.queued, 1)
+                time.sleep(0.1)
+                executor.check()
+                executor.check()  # one report per stall
+                release.set()
+                self.assertEqual(queued.result(timeout=1), '1')
+        finally:
+            release.set()
+            executor.shutdown()
+
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn("str has waited", logs.output[0])
+        self.assertIn("for a thread of the 'test_pool' executor (1 queued)", logs.output[0])
+        self.assertIn('--- hold_the_thread, running for', logs.output[0])
+        self.assertIn('release.wait()', logs.output[0])
+        self.assertEqual(metrics.EXECUTOR_SLOW_WAITS.labels('test_pool').get(), slow + 1)
+        self.assertEqual(metrics.EXECUTOR_QUEUE_DEPTH.labels('test_pool').get(), 0)
+
+
+class LoopMonitorTests(SimpleTestCase):
+    async def test_blocked_loop_is_logged_with_its_stack(self):
+        stalls = metrics.LOOP_STALLS.get()
+        monitor = monitoring.LoopMonitor(interval=0.02, threshold=0.1)
+        monitor.start()
+        try:
+            with self.assertLogs('chat_app.monitoring', 'WARNING') as logs:
+                await asyncio.sleep(0.05)
+                block_the_loop()
+                await asyncio.sleep(0.1)
+        finally:
+            monitor.stop()
+
+        self.assertIn('Event loop blocked for', logs.output[0])
+        self.assertIn('in block_the_loop', logs.output[0])
+        self.assertIn('Event loop responsive again', logs.output[1])
+        self.assertEqual(metrics.LOOP_STALLS.get(), stalls + 1)
+
+
+class SyncPoolTests(SimpleTestCase):
+    def tearDown(self):
+        for name in ('_sync_pool', '_write_thread'):
+            executor = getattr(monitoring, name)
+            if executor is not None:
+                executor.shutdown()
+                setattr(monitoring, name, None)
+
+    @override_settings(CHAT_SYNC_THREADS=2)
+    def test_calls_use_the_configured_pool(self):
+        thread_name = monitoring.db_sync_to_async(lambda: threading.current_thread().name)
+        self.assertTrue(asyncio.run(thread_name()).startswith('chat-sync'))
+
+    @override_settings(CHAT_SYNC_THREADS=2)
+    async def test_calls_under_async_to_sync_stay_on_the_callers_thread(self):
+        thread_name = monitoring.db_sync_to_async(lambda: threading.current_thread().name)
+        self.assertEqual(await thread_name(), threading.main_thread().name)
+
+    @override_settings(CHAT_SYNC_THREADS=2, CHAT_DB_WRITER_THREAD=True)
+    def test_writes_use_the_dedicated_thread(self):
+        write = monitoring.db_sync_to_async(
+            lambda: threading.current_thread().name, executor=monitoring.get_write_executor,
+        )
+        self.assertTrue(asyncio.run(write()).startswith('chat-db-writer'))
+
+    @override_settings(CHAT_LOOP_MONITOR=True)
+    def test_shared_thread_calls_are_tracked_without_patching_asgiref(self):
+        shared = SyncToAsync.single_thread_executor
+        waits = metrics.EXECUTOR_WAIT_SECONDS.labels('thread_sensitive')
+        before = sum(waits.counts)
+
+        async def connect():
+            monitoring.watch_current_loop().stop()
+            return await monitoring.db_sync_to_async(lambda: threading.current_thread().name)()
+
+        self.assertNotEqual(asyncio.run(connect()), threading.main_thread().name)
+        self.assertIs(SyncToAsync.single_thread_executor, shared)
+        self.assertEqual(sum(waits.counts), before + 1)
+        self.assertEqual(monitoring.get_shared_thread_tracker().queued, 0)
+
+    def test_unset_keeps_the_shared_thread(self):
+        self.assertIsNone(monitoring.get_sync_executor())
+        self.assertIsNone(monitoring.get_write_executor())
@@ -1,7 +1,9 @@
+import json
 import time
 from django.test import TestCase, Client
 from django.contrib.auth.models import User
 from django.urls import reverse
+from chat_app.benchmark import percentiles, run_benchmark
 from chat_app.models import ChatRoom, Message
 
 class PerformanceTests(TestCase):
@@ -52,4 +54,65 @@ class PerformanceTests(TestCase):
         print(f"\n    -> 100 Messages Encrypted & Saved in: {duration:.4f} seconds")
         
         # Fail if it takes longer than 0.5 seconds
-        self.assertLess(duration, 0.5, "Database insertion is too slow!")
\ No newline at end of file
+        self.assertLess(duration, 0.5, "Database insertion is too slow!")
+
+class QueryBudgetTests(TestCase):
+    """
+    Fixed query budgets for the read paths. A view that starts issuing a query
+    per row (N+1) or re-querying per request fails here long before it shows
+    up as latency in production.
+    """
+    # session + user + room lookup + one history page
+    ROOM_VIEW_QUERIES = 4
+    # session + user + room list
+    INDEX_VIEW_QUERIES = 3
+
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='budget_user', password='password')
+        self.other = User.objects.create_user(username='budget_other', password='password')
+        self.room = ChatRoom.objects.create(name='budget_room')
+        self.client.force_login(self.user)
+
+    def test_room_view_query_budget(self):
+        for i in range(30):
+            Message.objects.create(user=self.user if i % 2 else self.other, room=self.room, content=f"row {i}")
+
+        with self.assertNumQueries(self.ROOM_VIEW_QUERIES):
+            response = self.client.get(reverse('room', args=['budget_room']))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'budget_other')
+
+    def test_index_view_query_budget(self):
+        for i in range(20):
+            ChatRoom.objects.create(name=f'budget_room_{i}')
+
+        with self.assertNumQueries(self.INDEX_VIEW_QUERIES):
+            response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
+
+
+class BenchmarkHarnessTests(TestCase):
+    """Smoke test of the chat_benchmark harness on a handful of clients."""
+
+    async def test_small_run_reports_latencies(self):
+        from config.asgi import application
+
+        results = await run_benchmark(
+            application=application, clients=6, rooms=2, duration=0.5, warmup=0,
+            rate=4, typing_rate=2, seed=7, drain_timeout=2,
+        )
+
+        self.assertEqual(results['connected'], 6)
+        self.assertGreater(results['messages_sent'], 0)
+        self.assertEqual(results['messages_acked'], results['messages_sent'])
+        self.assertGreater(results['deliveries'], 0)
+        self.assertEqual(results['errors'], 0)
+        self.assertIsNotNone(results['ack_latency_ms']['p99'])
+        json.dumps(results)
+        self.assertFalse(await User.objects.filter(username__startswith='bench-').aexists())
+
+    def test_percentiles(self):
+        stats = percentiles([float(i) for i in range(1, 101)])
+        self.assertEqual((stats['p50'], stats['p99'], stats['max']), (50.0, 99.0, 100.0))
+        self.assertIsNone(percentiles([]))
@@ -0,0 +1,82 @@
+import os
+import asyncio
+import django
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+from django.test import TestCase
+from django.contrib.auth.models import User
+from chat_app.models import ChatRoom, Message
+from chat_app.persistence import MessageWriter, PendingMessage
+
+class MessageWriterTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='writer_user', password='password')
+        self.room = ChatRoom.objects.create(name='writer_room')
+
+    async def test_concurrent_sends_share_one_batch(self):
+        """Messages submitted together are committed by a single bulk insert."""
+        writer = MessageWriter(max_batch=10, max_delay=0.05)
+        batches = []
+        write_batch = writer.write_batch
+
+        def recording_write_batch(batch):
+            batches.append(len(batch))
+            return write_batch(batch)
+
+        writer.write_batch = recording_write_batch
+        saved = await asyncio.gather(*[
+            writer.submit(self.user.id, self.room.id, f"msg {i}") for i in range(5)
+        ])
+
+        self.assertEqual(batches, [5])
+        self.assertTrue(all(message.pk for message in saved))
+        self.assertEqual([message.seq for message in saved], [1, 2, 3, 4, 5])
+        self.assertEqual(await Message.objects.filter(room=self.room).acount(), 5)
+
+    async def test_batch_content_is_encrypted(self):
+        """bulk_create bypasses Message.save(), so the writer must encrypt itself."""
+        writer = MessageWriter(max_batch=10, max_delay=0)
+        message = await writer.submit(self.user.id, self.room.id, "Batched secret")
+
+        stored = await Message.objects.aget(pk=message.pk)
+        self.assertNotEqual(stored.content, "Batched secret")
+        self.assertEqual(stored.decrypted_content, "Batched secret")
+
+    async def test_unknown_room_fails_only_that_message(self):
+        """A bad item raises for its sender without losing the rest of the batch."""
+        writer = MessageWriter(max_batch=10, max_delay=0.05)
+        results = await asyncio.gather(
+            writer.submit(self.user.id, self.room.id + 1000, "lost"),
+            writer.submit(self.user.id, self.room.id, "kept"),
+            return_exceptions=True,
+        )
+
+        self.assertIsInstance(results[0], ChatRoom.DoesNotExist)
+        self.assertEqual(results[1].decrypted_content, "kept")
+
+    def test_drain_writes_queued_messages(self):
+        """Anything still queued at shutdown is written synchronously."""
+        writer = MessageWriter()
+        writer._pending.append(PendingMessage(self.user.id, self.room.id, "late", None))
+        writer.drain()
+        self.assertEqual(Message.objects.get(room=self.room).decrypted_content, "late")
+
+    async def test_repeated_client_msg_id_is_stored_once(self):
+        """A retry reusing a client_msg_id returns the stored message instead of a new row."""
+        writer = MessageWriter(max_batch=10, max_delay=0.05)
+        first, repeat = await asyncio.gather(
+            writer.submit(self.user.id, self.room.id, "once", "c-1"),
+            writer.submit(self.user.id, self.room.id, "once", "c-1"),
+        )
+        later = await writer.submit(self.user.id, self.room.id, "once", "c-1")
+
+        self.assertEqual(first.pk, repeat.pk)
+        self.assertEqual(first.pk, later.pk)
+        self.assertFalse(getattr(first, '_duplicate', False))
+        self.assertTrue(repeat._duplicate)
+        self.assertTrue(later._duplicate)
+        self.assertEqual(await Message.objects.filter(room=self.room).acount(), 1)
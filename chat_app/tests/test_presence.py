@@ -0,0 +1,125 @@
+import os
+import json
+import django
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+import time
+from unittest import mock
+from django.test import SimpleTestCase, TestCase
+from django.contrib.auth.models import User
+from channels.testing import WebsocketCommunicator
+from channels.routing import URLRouter
+from channels.auth import AuthMiddlewareStack
+from chat_app import routing
+from chat_app.models import ChatRoom
+from chat_app.presence import PresenceTracker, get_presence
+
+class RecordingLayer:
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((group, json.loads(message['text'])))
+
+class PresenceTrackerTests(SimpleTestCase):
+    def setUp(self):
+        self.tracker = PresenceTracker(interval=60, timeout=30, list_limit=3)
+        self.layer = RecordingLayer()
+
+    def tearDown(self):
+        if self.tracker._flusher is not None:
+            self.tracker._flusher.cancel()
+
+    async def test_counts_users_not_connections(self):
+        self.tracker.touch('lobby', 'alice', 'c1')
+        self.tracker.touch('lobby', 'alice', 'c2')
+        self.tracker.touch('lobby', 'bob', 'c3')
+        self.assertEqual((self.tracker.count('lobby'), self.tracker.count('other')), (2, 0))
+        self.tracker.leave('c1')
+        self.assertEqual(self.tracker.online('lobby'), ['alice', 'bob'])
+        self.tracker.leave('c2')
+        self.assertEqual(self.tracker.online('lobby'), ['bob'])
+
+    async def test_joins_coalesce_into_one_diff_per_room(self):
+        """A burst of joins and leaves becomes one group_send per room per flush."""
+        for i in range(3):
+            self.tracker.touch('lobby', f'user{i}', f'c{i}')
+        self.tracker.touch('lobby', 'flicker', 'cf')
+        self.tracker.leave('cf')
+        await self.tracker.flush(self.layer)
+        self.assertEqual(self.layer.sent, [
+            ('presence_lobby', {'type': 'presence', 'count': 3, 'joined': ['user0', 'user1', 'user2'], 'left': []}),
+        ])
+
+        self.tracker.leave('c0')
+        self.tracker.touch('lobby', 'user1', 'c1-tab2')
+        await self.tracker.flush(self.layer)
+        await self.tracker.flush(self.layer)
+        self.assertEqual(self.layer.sent[1:], [
+            ('presence_lobby', {'type': 'presence', 'count': 2, 'joined': [], 'left': ['user0']}),
+        ])
+
+    async def test_big_changes_only_carry_the_count(self):
+        for i in range(5):
+            self.tracker.touch('lobby', f'user{i}', f'c{i}')
+        await self.tracker.flush(self.layer)
+        self.assertEqual(self.layer.sent, [('presence_lobby', {'type': 'presence', 'count': 5, 'truncated': True})])
+        self.assertNotIn('online', self.tracker.snapshot('lobby'))
+
+    async def test_silent_connections_expire(self):
+        self.tracker.touch('lobby', 'alice', 'c1')
+        self.tracker.touch('lobby', 'bob', 'c2')
+        await self.tracker.flush(self.layer)
+        with mock.patch('chat_app.presence.time.monotonic', return_value=time.monotonic() + 20):
+            self.tracker.touch('lobby', 'bob', 'c2')
+        with mock.patch('chat_app.presence.time.monotonic', return_value=time.monotonic() + 40):
+            await self.tracker.flush(self.layer)
+        self.assertEqual(self.layer.sent[-1], ('presence_lobby', {'type': 'presence', 'count': 1, 'joined': [], 'left': ['alice']}))
+        self.assertEqual(self.tracker.online('lobby'), ['bob'])
+
+class PresenceConsumerTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='presence_alice', password='password')
+        self.bob = User.objects.create_user(username='presence_bob', password='password')
+        self.room = ChatRoom.objects.create(name='presence_room')
+
+    async def _connect(self, user, query=''):
+        test_app = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+        communicator = WebsocketCommunicator(test_app, f"/ws/chat/{self.room.name}/{query}")
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_followers_get_a_snapshot_and_diffs(self):
+        presence = get_presence()
+        bob = await self._connect(self.bob)
+        self.assertTrue(await bob.receive_nothing())
+        alice = await self._connect(self.alice, '?presence=1')
+        snapshot = json.loads(await alice.receive_from())
+        self.assertEqual(snapshot['online'], ['presence_alice', 'presence_bob'])
+        self.assertEqual(presence.count('presence_room'), 2)
+        await presence.flush()
+        diff = json.loads(await alice.receive_from())
+        self.assertEqual(diff['joined'], ['presence_alice', 'presence_bob'])
+
+        await bob.disconnect()
+        await presence.flush()
+        diff = json.loads(await alice.receive_from())
+        self.assertEqual((diff['count'], diff['left']), (1, ['presence_bob']))
+        await alice.disconnect()
+        self.assertEqual(presence.count('presence_room'), 0)
+
+    def test_index_shows_online_counts(self):
+        ChatRoom.objects.create(name='presence_empty')
+        tracker = PresenceTracker()
+        tracker._users['presence_room'] = {'presence_bob': 1}
+        self.client.force_login(self.alice)
+        with mock.patch('chat_app.views.get_presence', return_value=tracker):
+            response = self.client.get('/')
+        self.assertContains(response, "1 online")
+        self.assertContains(response, "0 online")
@@ -0,0 +1,84 @@
+import os
+import threading
+import django
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+from django.test import SimpleTestCase, TestCase
+from django.contrib.auth.models import User
+from django.urls import reverse
+from chat_app import profiling
+
+
+def parked_in_test(event):
+    event.wait()
+
+
+class SamplingProfilerTests(SimpleTestCase):
+    def test_samples_are_collapsed_per_thread(self):
+        release = threading.Event()
+        worker = threading.Thread(target=parked_in_test, args=(release,), name='ThreadPoolExecutor-999_3')
+        worker.start()
+        try:
+            profiler = profiling.SamplingProfiler()
+            profiler.sample()
+            profiler.sample()
+        finally:
+            release.set()
+            worker.join()
+
+        lines = profiler.collapsed().splitlines()
+        parked = [line for line in lines if line.startswith('ThreadPoolExecutor-999;')]
+        self.assertEqual(len(parked), 1)
+        stack, count = parked[0].rsplit(' ', 1)
+        self.assertEqual(count, '2')
+        self.assertIn(';parked_in_test_(tests/test_profiling.py:', stack)
+        self.assertEqual(profiler.samples, 2)
+
+    async def test_timed_records_only_during_a_session(self):
+        @profiling.timed('work')
+        async def work():
+            return 'done'
+
+        self.assertEqual(await work(), 'done')
+        session = profiling.start()
+        try:
+            await work()
+            await work()
+        finally:
+            profiling.stop(session)
+        await work()
+        self.assertEqual(session.timing_summary()['work']['count'], 2)
+
+    def test_one_session_at_a_time(self):
+        session = profiling.start()
+        try:
+            with self.assertRaises(profiling.ProfileInProgress):
+                profiling.start()
+        finally:
+            profiling.stop(session)
+        profiling.stop(profiling.start())
+
+
+class ProfileViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='profiler', password='password')
+        self.client.force_login(self.user)
+
+    def test_staff_only(self):
+        self.assertEqual(self.client.get(reverse('profile'), {'seconds': 0.01}).status_code, 403)
+
+    def test_profile_as_json(self):
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(reverse('profile'), {'seconds': 0.05, 'format': 'json'})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertGreater(data['samples'], 0)
+        self.assertIn('MainThread;', data['stacks'])
+
+        self.assertEqual(self.client.get(reverse('profile'), {'seconds': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('profile'), {'seconds': 3600}).status_code, 400)
@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import django
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+from io import StringIO
+from unittest import mock
+from cryptography.fernet import Fernet
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from chat_app.crypto import get_cipher
+from chat_app.models import ChatRoom, Message, ENCRYPTION_KEY
+from chat_app.rotation import load_state, rotate_messages
+
+
+class Interrupted(Exception):
+    pass
+
+
+class KeyRotationTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.state = os.path.join(self.tmp, 'rotation.json')
+        self.new_key = Fernet.generate_key()
+
+        user = User.objects.create_user(username='rotation_user', password='password')
+        room = ChatRoom.objects.create(name='rotation_room')
+        with override_settings(CHAT_ENCRYPTION_KEYS=[ENCRYPTION_KEY]):
+            for i in range(5):
+                Message.objects.create(user=user, room=room, content=f"secret {i}")
+
+        override = override_settings(CHAT_ENCRYPTION_KEYS=[self.new_key, ENCRYPTION_KEY])
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def under_new_key(self):
+        fernet = Fernet(self.new_key)
+        plaintexts = []
+        for content in Message.objects.order_by('id').values_list('content', flat=True):
+            plaintexts.append(fernet.decrypt(content.encode()).decode())
+        return plaintexts
+
+    def test_rotates_every_row_and_checkpoints(self):
+        state = rotate_messages(batch_size=2, pause=0, path=self.state)
+        self.assertEqual((state['rotated'], state['current'], state['failed']), (5, 0, 0))
+        self.assertEqual(self.under_new_key(), [f"secret {i}" for i in range(5)])
+        self.assertIsNotNone(load_state(self.state)['finished_at'])
+
+        with override_settings(CHAT_ENCRYPTION_KEYS=[self.new_key]):
+            message = Message.objects.order_by('id').first()
+            self.assertEqual(message.decrypted_content, "secret 0")
+
+    def test_interrupted_run_resumes(self):
+        def stop(state):
+            raise Interrupted
+
+        with self.assertRaises(Interrupted):
+            rotate_messages(batch_size=2, pause=0, path=self.state, progress=stop)
+        self.assertEqual(load_state(self.state)['rotated'], 2)
+
+        cipher = get_cipher()
+        with mock.patch.object(cipher, 'rotate_many', wraps=cipher.rotate_many) as rotate_many:
+            state = rotate_messages(batch_size=2, pause=0, path=self.state)
+        self.assertEqual([len(call.args[0]) for call in rotate_many.call_args_list], [2, 1])
+        self.assertEqual(state['rotated'], 5)
+        self.assertEqual(self.under_new_key(), [f"secret {i}" for i in range(5)])
+
+    def test_concurrent_edit_is_kept(self):
+        cipher = get_cipher()
+        rotate_many = cipher.rotate_many
+
+        def edit_then_rotate(tokens):
+            results = rotate_many(tokens)
+            message = Message.objects.order_by('id').first()
+            message.content = "edited meanwhile"
+            message.save()
+            return results
+
+        with mock.patch.object(cipher, 'rotate_many', side_effect=edit_then_rotate):
+            rotate_messages(batch_size=10, pause=0, path=self.state)
+        self.assertEqual(self.under_new_key()[0], "edited meanwhile")
+
+    def test_command(self):
+        out = StringIO()
+        call_command('rotate_encryption_key', '--state', self.state, '--pause', '0', stdout=out)
+        self.assertIn("finished; 5 re-encrypted", out.getvalue())
+        with override_settings(CHAT_ENCRYPTION_KEYS=[self.new_key]):
+            with self.assertRaisesMessage(CommandError, "Only one key"):
+                call_command('rotate_encryption_key', '--state', self.state)
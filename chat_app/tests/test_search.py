@@ -0,0 +1,110 @@
+import os
+import django
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.urls import reverse
+from django.utils import timezone
+from chat_app.caches import get_plaintext_cache
+from chat_app.crypto import get_cipher
+from chat_app.models import ChatRoom, Message, MessageSearchToken
+from chat_app.persistence import MessageWriter
+from chat_app.search import InvalidQuery, normalize_words, search
+
+
+class BlindIndexTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='search_user', password='password')
+        self.room = ChatRoom.objects.create(name='search_room')
+        self.other = ChatRoom.objects.create(name='other_room')
+        for text in ("Deploy the release tonight", "release notes are out", "lunch?", "The RELEASE is live"):
+            Message.objects.create(user=self.user, room=self.room, content=text)
+        Message.objects.create(user=self.user, room=self.other, content="release elsewhere")
+
+    def test_normalization(self):
+        self.assertEqual(normalize_words("Ｒelease, release! café CAFÉ"), ['release', 'café'])
+
+    def test_index_holds_hashes_not_words(self):
+        tokens = MessageSearchToken.objects.filter(room=self.room)
+        self.assertEqual(tokens.count(), 4 + 4 + 1 + 4)
+        self.assertFalse(any(b'release' in bytes(row.token) for row in tokens))
+
+    def test_search_is_room_scoped_and_matches_every_word(self):
+        page = search(self.room.id, "release")
+        self.assertEqual([m.message for m in page.messages], [
+            "Deploy the release tonight", "release notes are out", "The RELEASE is live",
+        ])
+        self.assertEqual([m.message for m in search(self.room.id, "the release").messages], [
+            "Deploy the release tonight", "The RELEASE is live",
+        ])
+        self.assertEqual(search(self.room.id, "nothing").messages, [])
+
+    def test_only_matching_rows_are_decrypted(self):
+        cipher = get_cipher()
+        with mock.patch.object(cipher, 'decrypt_many', wraps=cipher.decrypt_many) as decrypt_many:
+            get_plaintext_cache().clear()
+            search(self.room.id, "lunch")
+        self.assertEqual([len(call.args[0]) for call in decrypt_many.call_args_list], [1])
+
+    def test_paging_back(self):
+        newest = search(self.room.id, "release", limit=2)
+        self.assertTrue(newest.has_more)
+        older = search(self.room.id, "release", before=newest.before, limit=2)
+        self.assertEqual([m.message for m in older.messages], ["Deploy the release tonight"])
+        self.assertFalse(older.has_more)
+
+    def test_paging_follows_timestamps_not_ids(self):
+        now = timezone.now()
+        # Ids in this order, timestamps not (e.g. an imported backlog)
+        for text, minutes in (("alpha new", 1), ("alpha oldest", 30), ("alpha middle", 20)):
+            message = Message.objects.create(user=self.user, room=self.room, content=text)
+            Message.objects.filter(pk=message.pk).update(timestamp=now - timedelta(minutes=minutes))
+
+        seen, before = [], None
+        while True:
+            page = search(self.room.id, "alpha", before=before, limit=1)
+            seen = [m.message for m in page.messages] + seen
+            if not page.has_more:
+                break
+            before = page.before
+        self.assertEqual(seen, ["alpha oldest", "alpha middle", "alpha new"])
+
+    def test_empty_query_is_rejected(self):
+        with self.assertRaises(InvalidQuery):
+            search(self.room.id, " ?! ")
+
+    def test_edit_reindexes(self):
+        message = Message.objects.get(room=self.room, seq=3)
+        message.content = "dinner?"
+        message.save()
+        self.assertEqual(search(self.room.id, "lunch").messages, [])
+        self.assertEqual(len(search(self.room.id, "dinner").messages), 1)
+
+    async def test_writer_batches_are_indexed(self):
+        writer = MessageWriter(max_batch=10, max_delay=0)
+        await writer.submit(self.user.id, self.room.id, "batched keyword")
+        self.assertEqual(await MessageSearchToken.objects.filter(room=self.room).acount(), 13 + 2)
+
+    def test_rebuild_command(self):
+        MessageSearchToken.objects.all().delete()
+        out = StringIO()
+        call_command('rebuild_search_index', '--room', 'search_room', '--batch-size', '2', stdout=out)
+        self.assertIn("Indexed 4 messages (13 tokens).", out.getvalue())
+        self.assertEqual(len(search(self.room.id, "release").messages), 3)
+        self.assertEqual(search(self.other.id, "release").messages, [])
+
+    def test_search_view(self):
+        self.client.force_login(self.user)
+        url = reverse('room_search', args=['search_room'])
+        data = self.client.get(url, {'q': 'live release'}).json()
+        self.assertEqual([m['message'] for m in data['messages']], ["The RELEASE is live"])
+        self.assertEqual(self.client.get(url, {'q': ''}).status_code, 400)
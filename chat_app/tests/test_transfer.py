@@ -0,0 +1,125 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import django
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.utils import timezone
+from chat_app.archive import apply_retention
+from chat_app.models import ChatRoom, Message
+from chat_app.search import search
+
+
+class TransferTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        override = override_settings(CHAT_ARCHIVE_DIR=os.path.join(self.tmp, 'archive'), CHAT_RETENTION_DAYS=None)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.alice = User.objects.create_user(username='transfer_alice', password='password')
+        self.bob = User.objects.create_user(username='transfer_bob', password='password')
+        self.room = ChatRoom.objects.create(name='transfer_room')
+        now = timezone.now()
+        for i in range(7):
+            message = Message.objects.create(user=self.alice if i % 2 else self.bob, room=self.room, content=f"line {i}")
+            Message.objects.filter(pk=message.pk).update(timestamp=now - timedelta(days=10 - i))
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def history(self, room):
+        return [
+            (m.seq, m.user.username, m.timestamp, m.decrypted_content)
+            for m in Message.objects.filter(room=room).select_related('user').order_by('seq')
+        ]
+
+    def test_encrypted_round_trip(self):
+        before = self.history(self.room)
+        call_command('export_room', 'transfer_room', '--output', self.path('room.ndjson'), '--batch-size', '3', stderr=StringIO())
+        with open(self.path('room.ndjson')) as f:
+            header, first = json.loads(f.readline()), json.loads(f.readline())
+        self.assertTrue(header['encrypted'])
+        self.assertNotIn('line', first['content'])
+
+        out = StringIO()
+        call_command('import_room', self.path('room.ndjson'), '--room', 'copy_room', '--batch-size', '2', stdout=out)
+        self.assertIn("Imported 7 messages into 'copy_room'.", out.getvalue())
+        copy = ChatRoom.objects.get(name='copy_room')
+        self.assertEqual(self.history(copy), before)
+        self.assertEqual(copy.last_seq, 7)
+        self.assertEqual(len(search(copy.id, "line").messages), 7)
+
+    def test_decrypted_gzip_export_creates_missing_authors(self):
+        call_command('export_room', 'transfer_room', '--output', self.path('room.ndjson.gz'), '--decrypt', stderr=StringIO())
+        with gzip.open(self.path('room.ndjson.gz'), 'rt') as f:
+            lines = [json.loads(line) for line in f]
+        self.assertFalse(lines[0]['encrypted'])
+        self.assertEqual([line['message'] for line in lines[1:]], [f"line {i}" for i in range(7)])
+
+        Message.objects.filter(room=self.room).delete()
+        self.bob.delete()
+        call_command('import_room', self.path('room.ndjson.gz'), stdout=StringIO())
+        self.assertEqual([m.decrypted_content for m in Message.objects.filter(room=self.room).order_by('seq')], [f"line {i}" for i in range(7)])
+        self.assertFalse(User.objects.get(username='transfer_bob').has_usable_password())
+
+    def test_archived_messages_are_exported(self):
+        self.room.retention_days = 6
+        self.room.save()
+        apply_retention(pause=0)
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 2)
+        call_command('export_room', 'transfer_room', '--output', self.path('room.ndjson'), stderr=StringIO())
+        call_command('import_room', self.path('room.ndjson'), '--room', 'copy_room', stdout=StringIO())
+        copy = ChatRoom.objects.get(name='copy_room')
+        self.assertEqual([m.decrypted_content for m in Message.objects.filter(room=copy).order_by('seq')], [f"line {i}" for i in range(7)])
+
+    def test_other_saves_keep_auto_timestamps_during_import(self):
+        call_command('export_room', 'transfer_room', '--output', self.path('room.ndjson'), stderr=StringIO())
+        allocate_seq = ChatRoom.allocate_seq
+        saved = []
+
+        def save_meanwhile(room_id, count=1):
+            if room_id != self.room.id and not saved:
+                # A chat message saved while the import is inserting a batch
+                saved.append(Message.objects.create(user=self.alice, room=self.room, content="live"))
+            return allocate_seq(room_id, count)
+
+        with mock.patch.object(ChatRoom, 'allocate_seq', side_effect=save_meanwhile):
+            call_command('import_room', self.path('room.ndjson'), '--room', 'copy_room', stdout=StringIO())
+        self.assertIsNotNone(Message.objects.get(pk=saved[0].pk).timestamp)
+        copy = ChatRoom.objects.get(name='copy_room')
+        self.assertEqual(
+            list(Message.objects.filter(room=copy).order_by('seq').values_list('timestamp', flat=True)),
+            list(Message.objects.filter(room=self.room).exclude(pk=saved[0].pk).order_by('seq').values_list('timestamp', flat=True)),
+        )
+
+    def test_refuses_non_empty_room_without_append(self):
+        call_command('export_room', 'transfer_room', '--output', self.path('room.ndjson'), stderr=StringIO())
+        with self.assertRaisesMessage(CommandError, "already has messages"):
+            call_command('import_room', self.path('room.ndjson'), stdout=StringIO())
+        call_command('import_room', self.path('room.ndjson'), '--append', stdout=StringIO())
+        self.assertEqual(
+            list(Message.objects.filter(room=self.room).order_by('seq').values_list('seq', flat=True)),
+            list(range(1, 15)),
+        )
+
+    def test_rejects_other_files(self):
+        with open(self.path('bad.ndjson'), 'w') as f:
+            f.write('{"hello": "world"}\n')
+        with self.assertRaisesMessage(CommandError, "Not a room export"):
+            call_command('import_room', self.path('bad.ndjson'), stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('export_room', 'no_such_room', '--output', self.path('x.ndjson'))
@@ -0,0 +1,57 @@
+import os
+import json
+import django
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+import time
+from unittest import mock
+from django.test import SimpleTestCase
+from chat_app.typing_indicators import TypingAggregator
+
+class RecordingLayer:
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((group, json.loads(message['text'])))
+
+class TypingAggregatorTests(SimpleTestCase):
+    def setUp(self):
+        self.aggregator = TypingAggregator(interval=60, timeout=3)
+        self.layer = RecordingLayer()
+
+    def tearDown(self):
+        if self.aggregator._flusher is not None:
+            self.aggregator._flusher.cancel()
+
+    async def test_keystrokes_coalesce_into_one_snapshot(self):
+        """Many typing frames from several users become one group_send per room."""
+        for _ in range(20):
+            self.aggregator.update('chat_room', 'alice', True)
+            self.aggregator.update('chat_room', 'bob', True)
+        await self.aggregator.flush(self.layer)
+
+        self.assertEqual(self.layer.sent, [('chat_room', {'type': 'typing_state', 'typing': ['alice', 'bob']})])
+
+    async def test_unchanged_state_is_not_resent(self):
+        self.aggregator.update('chat_room', 'alice', True)
+        await self.aggregator.flush(self.layer)
+        # Stop and start again within one interval: nothing observable changed
+        self.aggregator.update('chat_room', 'alice', False)
+        self.aggregator.update('chat_room', 'alice', True)
+        await self.aggregator.flush(self.layer)
+
+        self.assertEqual(len(self.layer.sent), 1)
+
+    async def test_typing_expires_without_refresh(self):
+        self.aggregator.update('chat_room', 'alice', True)
+        await self.aggregator.flush(self.layer)
+        with mock.patch('chat_app.typing_indicators.time.monotonic', return_value=time.monotonic() + 5):
+            await self.aggregator.flush(self.layer)
+
+        self.assertEqual(self.layer.sent[-1], ('chat_room', {'type': 'typing_state', 'typing': []}))
+        self.assertEqual(self.aggregator.snapshot('chat_room'), [])
@@ -0,0 +1,210 @@
+"""
+Streaming export and import of a room's messages (see the export_room and
+import_room commands).
+
+The format is NDJSON, gzip-compressed when the file name ends in .gz: a
+header line describing the room, then one line per message, oldest first:
+
+    {"format":"chat-room","version":1,"room":"lobby","encrypted":true}
+    {"seq":1,"username":"alice","timestamp":"2026-01-01T10:00:00+00:00","content":"gAAAA..."}
+
+Encrypted exports carry the Fernet tokens as stored (including messages in
+the archive) and only import into an instance whose keyring holds the key; with
+decrypt=True lines carry "message" with the plaintext instead. Both sides
+work in fixed-size batches, so memory stays flat however big the room is:
+export pages through the table by id, import parses, encrypts and indexes
+the next batch on a worker thread while the current one is inserted.
+"""
+import gzip
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from .archive import iter_archived
+from .crypto import DECRYPTION_ERROR, get_cipher
+from .models import ChatRoom, Message, MessageSearchToken
+from .search import index_rows
+
+FORMAT = 'chat-room'
+VERSION = 1
+
+
+class TransferError(Exception):
+    pass
+
+
+def open_stream(path, mode):
+    """A text stream for `path` ('-' for stdin/stdout), gzipped when it ends in .gz."""
+    if path == '-':
+        # closefd=False: closing the stream must not close the process's stdio
+        return open((sys.stdin if mode == 'r' else sys.stdout).fileno(), mode, encoding='utf-8', closefd=False)
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', compresslevel=6)
+    return open(path, mode, encoding='utf-8')
+
+
+def _batches(room, batch_size):
+    """(seq, username, timestamp, token) tuples in batches, archived messages first."""
+    yield from iter_archived(room.id)
+
+    last_id = 0
+    while True:
+        rows = list(
+            Message.objects.filter(room=room, id__gt=last_id)
+            .order_by('id')
+            .values_list('id', 'seq', 'user__username', 'timestamp', 'content')[:batch_size]
+        )
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield [row[1:] for row in rows]
+
+
+def export_room(room, out, decrypt=False, batch_size=5000):
+    """Write a room to the text stream `out`. Returns the number of messages written."""
+    dumps = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False).encode
+    out.write(dumps({
+        'format': FORMAT, 'version': VERSION, 'room': room.name,
+        'encrypted': not decrypt, 'exported_at': timezone.now().isoformat(),
+    }) + '\n')
+    cipher = get_cipher()
+    written = 0
+    for batch in _batches(room, batch_size):
+        # decrypt_many spreads big batches over the crypto process pool
+        values = cipher.decrypt_many([row[3] for row in batch]) if decrypt else [row[3] for row in batch]
+        key = 'message' if decrypt else 'content'
+        out.write(''.join(
+            dumps({'seq': seq, 'username': username, 'timestamp': timestamp.isoformat(), key: value}) + '\n'
+            for (seq, username, timestamp, _), value in zip(batch, values)
+        ))
+        written += len(batch)
+    return written
+
+
+def _read_header(stream):
+    try:
+        header = json.loads(stream.readline())
+    except ValueError:
+        header = None
+    if not isinstance(header, dict) or header.get('format') != FORMAT:
+        raise TransferError("Not a room export (missing header line).")
+    if header.get('version') != VERSION:
+        raise TransferError(f"Unsupported export version {header.get('version')!r}.")
+    return header
+
+
+def _read_batches(stream, batch_size):
+    batch = []
+    for number, line in enumerate(stream, start=2):
+        if not line.strip():
+            continue
+        try:
+            batch.append(json.loads(line))
+        except ValueError:
+            raise TransferError(f"Line {number} is not valid JSON.")
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class _Importer:
+    def __init__(self, room, encrypted):
+        self.room = room
+        self.encrypted = encrypted
+        self.cipher = get_cipher()
+        self.user_ids = {}
+        self.undecryptable = 0
+
+    def prepare(self, records):
+        """Worker thread: Message rows for a batch, encrypted (or checked) and with plaintext loaded."""
+        try:
+            if self.encrypted:
+                tokens = [record['content'] for record in records]
+                plaintexts = self.cipher.decrypt_many(tokens)
+            else:
+                plaintexts = [record['message'] for record in records]
+                tokens = self.cipher.encrypt_many(plaintexts)
+            rows = []
+            for record, token, plaintext in zip(records, tokens, plaintexts):
+                row = Message(
+                    room_id=self.room.id, content=token,
+                    timestamp=datetime.fromisoformat(record['timestamp']),
+                )
+                row._username = record['username']
+                if plaintext == DECRYPTION_ERROR and self.encrypted:
+                    self.undecryptable += 1
+                else:
+                    row._decrypted_content = plaintext
+                rows.append(row)
+            return rows
+        except (KeyError, TypeError, ValueError) as e:
+            raise TransferError(f"Malformed message in export: {e!r}")
+
+    def insert(self, rows):
+        self._resolve_users({row._username for row in rows})
+        for row in rows:
+            row.user_id = self.user_ids[row._username]
+        with transaction.atomic():
+            first = ChatRoom.allocate_seq(self.room.id, len(rows))
+            for offset, row in enumerate(rows):
+                row.seq = first + offset
+            Message.objects.bulk_create(rows)
+            MessageSearchToken.objects.bulk_create(
+                index_rows([row for row in rows if '_decrypted_content' in row.__dict__])
+            )
+
+    def _resolve_users(self, usernames):
+        missing = usernames - self.user_ids.keys()
+        if not missing:
+            return
+        self.user_ids.update(User.objects.filter(username__in=missing).values_list('username', 'id'))
+        new = []
+        for username in missing - self.user_ids.keys():
+            # Authors who don't exist here get an account nobody can log into
+            user = User(username=username)
+            user.set_unusable_password()
+            new.append(user)
+        if new:
+            User.objects.bulk_create(new)
+            self.user_ids.update(
+                User.objects.filter(username__in=[user.username for user in new]).values_list('username', 'id')
+            )
+
+
+def import_room(stream, room_name=None, append=False, batch_size=2000):
+    """
+    Read an export from the text stream `stream` into `room_name` (default:
+    the exported room's name). Messages are numbered after the room's existing
+    ones. Returns (room, messages imported, messages that failed to decrypt).
+    """
+    header = _read_header(stream)
+    room_name = room_name or header.get('room')
+    if not room_name:
+        raise TransferError("The export names no room; pass one.")
+    room, created = ChatRoom.objects.get_or_create(name=room_name)
+    if not created and not append and Message.objects.filter(room=room).exists():
+        raise TransferError(f"Room {room_name!r} already has messages; pass append to add to them.")
+
+    importer = _Importer(room, encrypted=header.get('encrypted', True))
+    imported = 0
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-import') as worker:
+        pending = None
+        for records in _read_batches(stream, batch_size):
+            prepared = worker.submit(importer.prepare, records)
+            if pending is not None:
+                rows = pending.result()
+                importer.insert(rows)
+                imported += len(rows)
+            pending = prepared
+        if pending is not None:
+            rows = pending.result()
+            importer.insert(rows)
+            imported += len(rows)
+    return room, imported, importer.undecryptable
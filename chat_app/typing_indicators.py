@@ -0,0 +1,93 @@
+"""
+Server-side typing indicator aggregation.
+
+Clients send a 'typing' frame on keystrokes. Instead of turning each one into a
+group_send, the aggregator keeps the set of typing users per room and every
+`interval` seconds sends one 'typing_state' snapshot per room whose set has
+actually changed since the last snapshot. A user's typing state lapses
+`timeout` seconds after their last 'typing' frame unless refreshed.
+"""
+import asyncio
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .fanout import broadcast_event
+
+
+class TypingAggregator:
+    def __init__(self, interval=0.5, timeout=3.0):
+        self.interval = interval
+        self.timeout = timeout
+        # group name -> {username: expiry}
+        self._typing = {}
+        # group name -> last snapshot sent to that group
+        self._sent = {}
+        self._flusher = None
+
+    def update(self, group, username, is_typing):
+        """Record a user's typing state. Cheap; nothing is sent until the next flush."""
+        typists = self._typing.get(group)
+        if is_typing:
+            if typists is None:
+                typists = self._typing[group] = {}
+            typists[username] = time.monotonic() + self.timeout
+        elif typists is not None:
+            typists.pop(username, None)
+        else:
+            return
+        self._ensure_flusher()
+
+    def snapshot(self, group):
+        return sorted(self._typing.get(group, ()))
+
+    async def flush(self, channel_layer=None):
+        """Expire stale typists and send one snapshot to every room whose set changed."""
+        channel_layer = channel_layer or get_channel_layer()
+        now = time.monotonic()
+        for group in list(self._typing):
+            typists = self._typing[group]
+            for username, expires in list(typists.items()):
+                if expires <= now:
+                    del typists[username]
+
+            snapshot = sorted(typists)
+            if not typists:
+                del self._typing[group]
+            if snapshot == self._sent.get(group, []):
+                continue
+
+            if snapshot:
+                self._sent[group] = snapshot
+            else:
+                self._sent.pop(group, None)
+            await channel_layer.group_send(group, broadcast_event({
+                'type': 'typing_state',
+                'typing': snapshot,
+            }))
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._flusher = loop.create_task(self._run())
+
+    async def _run(self):
+        # Runs only while some room has typing state (or an unsent final snapshot)
+        while self._typing:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+
+_aggregator = None
+
+
+def get_typing_aggregator():
+    """Return the process-wide TypingAggregator, configured from settings on first use."""
+    global _aggregator
+    if _aggregator is None:
+        _aggregator = TypingAggregator(
+            interval=getattr(settings, 'CHAT_TYPING_INTERVAL', 0.5),
+            timeout=getattr(settings, 'CHAT_TYPING_TIMEOUT', 3.0),
+        )
+    return _aggregator
@@ -7,5 +7,9 @@ urlpatterns = [
     path('signup/', views.signup_view, name='signup'),
     path('logout/', views.logout_view, name='logout'),
     path('room/<str:room_name>/', views.room, name='room'),
+    path('room/<str:room_name>/history/', views.room_history, name='room_history'),
+    path('room/<str:room_name>/search/', views.room_search, name='room_search'),
+    path('metrics', views.metrics, name='metrics'),
+    path('profile/', views.profile, name='profile'),
 
 ]
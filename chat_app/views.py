@@ -1,8 +1,15 @@
-from django.shortcuts import render, redirect
+from django.shortcuts import render, redirect, get_object_or_404
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.decorators import login_required
 from .models import ChatRoom, Message
 from .forms import SignUpForm, LoginForm
+from .history import fetch_page, recent_page, InvalidCursor
+from .presence import get_presence
+from .search import InvalidQuery, search
+from . import metrics as chat_metrics
+from . import profiling
 
 def signup_view(request):
     if request.method == 'POST':
@@ -32,12 +39,16 @@ def logout_view(request):
 
 @login_required
 def index(request):
-    rooms = ChatRoom.objects.all()
     if request.method == "POST":
         room_name = request.POST.get("room_name")
         if room_name:
             ChatRoom.objects.get_or_create(name=room_name)
             return redirect('index')
+    # The dashboard only shows names, so don't load anything else
+    rooms = list(ChatRoom.objects.only('name').order_by('name'))
+    presence = get_presence()
+    for room in rooms:
+        room.online = presence.count(room.name)
     return render(request, 'index.html', {'rooms': rooms})
 
 @login_required
@@ -56,14 +67,75 @@ def room(request, room_name):
     # Wait, the encrypted messages need to be decrypted.
     # The Model has a property `decrypted_content`.
     
-    messages = Message.objects.filter(room=chat_room).order_by('timestamp')[:50]
+    # Newest page of history, from the room's in-memory buffer when it is warm;
+    # older pages are fetched by cursor from room_history or over the socket
+    page = recent_page(chat_room.id)
     
     return render(request, 'room.html', {
         'room_name': room_name,
-        'messages': messages,
+        'messages': page.messages,
+        'history_cursor': page.before if page.has_more else None,
         'user': request.user
     })
 
+@login_required
+def room_history(request, room_name):
+    """JSON page of room history: ?before=<cursor> or ?after=<cursor>, plus optional ?limit=."""
+    chat_room = get_object_or_404(ChatRoom, name=room_name)
+    try:
+        page = fetch_page(
+            chat_room.id,
+            before=request.GET.get('before'),
+            after=request.GET.get('after'),
+            limit=request.GET.get('limit'),
+        )
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(page.as_dict())
 
+@login_required
+def room_search(request, room_name):
+    """JSON page of messages containing every word of ?q=, newest last; ?before=<cursor> pages back."""
+    chat_room = get_object_or_404(ChatRoom, name=room_name)
+    try:
+        page = search(
+            chat_room.id,
+            request.GET.get('q'),
+            before=request.GET.get('before'),
+            limit=request.GET.get('limit'),
+        )
+    except (InvalidQuery, InvalidCursor) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(page.as_dict())
 
+def metrics(request):
+    """Process metrics in the Prometheus text format, for staff and CHAT_METRICS_ALLOWED_IPS."""
+    allowed_ips = getattr(settings, 'CHAT_METRICS_ALLOWED_IPS', [])
+    if not request.user.is_staff and request.META.get('REMOTE_ADDR') not in allowed_ips:
+        return HttpResponseForbidden()
+    return HttpResponse(chat_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
+async def profile(request):
+    """
+    Staff only: sample this worker's stacks for ?seconds=N (default 10) and
+    return them collapsed for a flame graph, or with ?format=json together
+    with the @profiling.timed summaries. Only the worker serving the request
+    is profiled.
+    """
+    user = await request.auser()
+    if not user.is_staff:
+        return HttpResponseForbidden()
+    max_seconds = getattr(settings, 'CHAT_PROFILE_MAX_SECONDS', 60)
+    try:
+        seconds = float(request.GET.get('seconds', 10))
+    except ValueError:
+        return JsonResponse({'error': "seconds must be a number"}, status=400)
+    if not 0 < seconds <= max_seconds:
+        return JsonResponse({'error': f"seconds must be between 0 and {max_seconds}"}, status=400)
+    try:
+        session = await profiling.profile(seconds, getattr(settings, 'CHAT_PROFILE_INTERVAL', 0.005))
+    except profiling.ProfileInProgress as e:
+        return JsonResponse({'error': str(e)}, status=409)
+    if request.GET.get('format') == 'json':
+        return JsonResponse(session.as_dict())
+    return HttpResponse(session.profiler.collapsed(), content_type='text/plain; charset=utf-8')
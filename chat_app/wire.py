@@ -0,0 +1,209 @@
+"""
+Compact binary wire protocol for ChatConsumer ('chat.bin.v1').
+
+JSON text frames stay the default. A client that offers the 'chat.bin.v1'
+subprotocol in the WebSocket handshake gets the high-volume events (chat
+messages, acks and typing snapshots) as binary frames instead, and may send
+chat messages and typing updates as binary frames too. Everything else
+(history pages, errors) still arrives as JSON text on the same socket.
+
+A frame is a one-byte event tag, the ids of the users the event refers to
+(a count, then the ids), then the tag's fields. Integers are unsigned LEB128
+varints; strings are a varint byte length followed by UTF-8.
+
+User ids are per connection: the first time a username appears on a
+connection the server sends a USER frame binding it to the next free id, and
+later events carry only the id. The rest of a broadcast frame is the same for
+every member, so it is still encoded once per broadcast (see fanout).
+
+    server -> client
+        0x01 CHAT           users=[sender]  seq, id, timestamp (microseconds since epoch), message
+        0x02 USER           users=[id]      username
+        0x03 ACK            users=[]        seq, client_msg_id ('' if none)
+        0x04 TYPING_STATE   users=[...]     -
+    client -> server
+        0x10 SEND           users=[]        client_msg_id ('' if none), message
+        0x11 TYPING         users=[]        is_typing (0 or 1)
+
+Numbers a JSON event leaves out (seq, id) are sent as 0.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+SUBPROTOCOL = 'chat.bin.v1'
+JSON_SUBPROTOCOL = 'chat.json.v1'
+
+CHAT = 0x01
+USER = 0x02
+ACK = 0x03
+TYPING_STATE = 0x04
+SEND = 0x10
+TYPING = 0x11
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+class WireError(ValueError):
+    pass
+
+
+def encode_varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def encode_str(value):
+    data = value.encode('utf-8')
+    return encode_varint(len(data)) + data
+
+
+class Reader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def varint(self):
+        value = shift = 0
+        while True:
+            if self.pos >= len(self.data):
+                raise WireError("Truncated frame")
+            byte = self.data[self.pos]
+            self.pos += 1
+            value |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return value
+            shift += 7
+            if shift > 63:
+                raise WireError("Varint too long")
+
+    def str(self):
+        length = self.varint()
+        end = self.pos + length
+        if end > len(self.data):
+            raise WireError("Truncated frame")
+        try:
+            value = self.data[self.pos:end].decode('utf-8')
+        except UnicodeDecodeError:
+            raise WireError("Invalid UTF-8 in frame")
+        self.pos = end
+        return value
+
+    def header(self):
+        """(tag, [user ids]) at the start of a frame."""
+        if not self.data:
+            raise WireError("Empty frame")
+        self.pos = 1
+        return self.data[0], [self.varint() for _ in range(self.varint())]
+
+
+def _micros(timestamp):
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    return (timestamp - _EPOCH) // timedelta(microseconds=1)
+
+
+def broadcast_parts(payload):
+    """
+    The shared part of a broadcast payload's binary form, as [tag, usernames,
+    body], or None if the event type has no binary form (it is then sent to
+    binary connections as JSON text).
+    """
+    event_type = payload.get('type')
+    if event_type == 'chat_message':
+        timestamp = payload.get('timestamp')
+        body = (
+            encode_varint(payload.get('seq') or 0)
+            + encode_varint(payload.get('id') or 0)
+            + encode_varint(_micros(timestamp) if timestamp else 0)
+            + encode_str(payload['message'])
+        )
+        return [CHAT, [payload['username']], body]
+    if event_type == 'typing_state':
+        return [TYPING_STATE, list(payload['typing']), b'']
+    return None
+
+
+def ack_parts(ack):
+    body = encode_varint(ack.get('seq') or 0) + encode_str(ack.get('client_msg_id') or '')
+    return [ACK, [], body]
+
+
+class Session:
+    """Per-connection username -> id table for binary frames."""
+
+    def __init__(self):
+        self.user_ids = {}
+
+    def frames(self, tag, usernames, body):
+        """
+        Frames to send for one event: a USER frame for every username this
+        connection hasn't seen yet, then the event itself.
+        """
+        frames = []
+        header = bytearray((tag,))
+        header += encode_varint(len(usernames))
+        for username in usernames:
+            user_id = self.user_ids.get(username)
+            if user_id is None:
+                user_id = self.user_ids[username] = len(self.user_ids) + 1
+                frames.append(bytes((USER, 1)) + encode_varint(user_id) + encode_str(username))
+            header += encode_varint(user_id)
+        frames.append(bytes(header) + body)
+        return frames
+
+
+def decode_client(data):
+    """Decode a client frame into the same dict its JSON form would parse to."""
+    reader = Reader(data)
+    tag, _ = reader.header()
+    if tag == SEND:
+        client_msg_id = reader.str()
+        return {
+            'type': 'chat_message',
+            'client_msg_id': client_msg_id or None,
+            'message': reader.str(),
+        }
+    if tag == TYPING:
+        return {'type': 'typing', 'is_typing': bool(reader.varint())}
+    raise WireError(f"Unknown client frame tag {tag:#04x}")
+
+
+def encode_client(payload):
+    """Binary form of a client 'chat_message' or 'typing' payload (tests and tools)."""
+    if payload['type'] == 'chat_message':
+        return bytes((SEND, 0)) + encode_str(payload.get('client_msg_id') or '') + encode_str(payload['message'])
+    if payload['type'] == 'typing':
+        return bytes((TYPING, 0)) + encode_varint(int(bool(payload.get('is_typing', True))))
+    raise WireError(f"No binary form for {payload['type']!r}")
+
+
+def decode_server(data, usernames=None):
+    """
+    Decode a server frame into a dict shaped like its JSON form (tests and
+    tools). `usernames` is the id -> username table, updated by USER frames.
+    """
+    usernames = {} if usernames is None else usernames
+    reader = Reader(data)
+    tag, user_ids = reader.header()
+    if tag == USER:
+        usernames[user_ids[0]] = reader.str()
+        return {'type': 'user', 'id': user_ids[0], 'username': usernames[user_ids[0]]}
+    if tag == CHAT:
+        seq, message_id, micros = reader.varint(), reader.varint(), reader.varint()
+        return {
+            'type': 'chat_message',
+            'username': usernames.get(user_ids[0]),
+            'seq': seq or None,
+            'id': message_id or None,
+            'timestamp': (_EPOCH + timedelta(microseconds=micros)).isoformat(),
+            'message': reader.str(),
+        }
+    if tag == ACK:
+        seq = reader.varint()
+        return {'type': 'ack', 'seq': seq or None, 'client_msg_id': reader.str() or None}
+    if tag == TYPING_STATE:
+        return {'type': 'typing_state', 'typing': [usernames.get(user_id) for user_id in user_ids]}
+    raise WireError(f"Unknown server frame tag {tag:#04x}")
@@ -7,13 +7,14 @@ django.setup()
 
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
+from chat_app.backpressure import TransportFlowMiddleware
 import chat_app.routing
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    "websocket": TransportFlowMiddleware(AuthMiddlewareStack(
         URLRouter(
             chat_app.routing.websocket_urlpatterns
         )
-    ),
+    )),
 })
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat_app.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -91,6 +93,20 @@ CHANNEL_LAYERS = {
         "BACKEND": "channels.layers.InMemoryChannelLayer",
     },
 }
+# chat_app.layers.ShardedInMemoryChannelLayer is an opt-in, drop-in
+# replacement with sharded group tables and bounded per-channel queues. Unlike
+# the stock layer, a full queue is handled by full_policy (raise / drop_oldest
+# / drop_newest / close); with drop_oldest a slow connection silently loses
+# its oldest undelivered events instead of send() raising ChannelFull.
+# CHANNEL_LAYERS = {
+#     "default": {
+#         "BACKEND": "chat_app.layers.ShardedInMemoryChannelLayer",
+#         "CONFIG": {
+#             "capacity": 500,
+#             "full_policy": "drop_oldest",
+#         },
+#     },
+# }
 # CHANNEL_LAYERS = {
 #     "default": {
 #         "BACKEND": "channels_redis.core.RedisChannelLayer",
@@ -100,6 +116,152 @@ CHANNEL_LAYERS = {
 #     },
 # }
 
+# Chat message persistence
+# Messages are written behind the WebSocket in batches: a batch is flushed once
+# CHAT_WRITE_BATCH_SIZE messages are queued or CHAT_WRITE_BATCH_DELAY seconds
+# after the first one arrived, whichever comes first.
+CHAT_WRITE_BATCH_SIZE = 100
+CHAT_WRITE_BATCH_DELAY = 0.005
+
+# Message encryption
+# Batches of at least CHAT_CRYPTO_POOL_THRESHOLD values are encrypted/decrypted
+# across a process pool of CHAT_CRYPTO_POOL_WORKERS processes (None = one per
+# CPU). Set the threshold to None to keep all crypto in-process.
+CHAT_CRYPTO_POOL_THRESHOLD = 2000
+CHAT_CRYPTO_POOL_WORKERS = None
+
+# Fernet keyring, newest first, from a comma-separated CHAT_ENCRYPTION_KEYS
+# environment variable; None uses the demo key in chat_app.models. New content
+# is encrypted with the first key and any listed key decrypts. To rotate, put
+# the new key first, restart the workers and run `manage.py
+# rotate_encryption_key`, which re-encrypts CHAT_KEY_ROTATION_BATCH_SIZE rows
+# per transaction with CHAT_KEY_ROTATION_PAUSE seconds between batches and
+# checkpoints to CHAT_KEY_ROTATION_STATE so it can resume; then drop the old key
+# (keep it while the archive still holds messages written under it).
+CHAT_ENCRYPTION_KEYS = [key.strip() for key in os.environ.get('CHAT_ENCRYPTION_KEYS', '').split(',') if key.strip()] or None
+CHAT_KEY_ROTATION_BATCH_SIZE = 500
+CHAT_KEY_ROTATION_PAUSE = 0.05
+CHAT_KEY_ROTATION_STATE = BASE_DIR / 'key_rotation.json'
+
+# Decrypted message content is kept in an in-process LRU keyed by message id,
+# bounded to roughly this many bytes.
+CHAT_PLAINTEXT_CACHE_BYTES = 16 * 1024 * 1024
+
+# Room name -> id lookups made by WebSocket connects are cached for this many
+# seconds (entries are also dropped whenever a room is saved or deleted).
+CHAT_ROOM_CACHE_TTL = 300
+
+# Typing indicators are aggregated per room and sent as one snapshot every
+# CHAT_TYPING_INTERVAL seconds; a user stops "typing" CHAT_TYPING_TIMEOUT
+# seconds after their last typing frame.
+CHAT_TYPING_INTERVAL = 0.5
+CHAT_TYPING_TIMEOUT = 3.0
+
+# Presence (chat_app.presence): clients following a room's presence get one
+# batched 'presence' diff every CHAT_PRESENCE_INTERVAL seconds; a connection that sends nothing (pages send a
+# heartbeat every third of the timeout) goes offline after CHAT_PRESENCE_TIMEOUT
+# seconds. Past CHAT_PRESENCE_LIST_LIMIT users, snapshots and diffs carry only
+# the count.
+CHAT_PRESENCE_INTERVAL = 1.0
+CHAT_PRESENCE_TIMEOUT = 60.0
+CHAT_PRESENCE_LIST_LIMIT = 100
+
+# The newest CHAT_RECENT_MESSAGES messages of each active room are kept in
+# memory for joins; rooms are evicted (least recently used first) once the
+# buffers together exceed CHAT_RECENT_MESSAGES_BYTES.
+CHAT_RECENT_MESSAGES = 100
+CHAT_RECENT_MESSAGES_BYTES = 32 * 1024 * 1024
+
+# Sends carrying a client_msg_id are remembered for CHAT_DEDUP_WINDOW seconds
+# (at most CHAT_DEDUP_MAX_ENTRIES of them) so retries are acked without being
+# stored or broadcast again.
+CHAT_DEDUP_WINDOW = 300
+CHAT_DEDUP_MAX_ENTRIES = 100_000
+
+# Outbound frames are queued per connection. Past CHAT_OUTBOUND_HIGH_WATER
+# queued bytes typing frames are dropped and then history pages skipped; past
+# CHAT_OUTBOUND_MAX_BYTES the connection is closed with code 4008. Frames
+# only queue up while the server holds back sends: under Daphne that needs
+# chat_app.backpressure.TransportFlowMiddleware, which config/asgi.py installs.
+CHAT_OUTBOUND_HIGH_WATER = 64 * 1024
+CHAT_OUTBOUND_MAX_BYTES = 256 * 1024
+
+# /metrics (Prometheus text format) is served to staff users and to requests
+# from these addresses, e.g. ['127.0.0.1'] for a scraper on the same host.
+# Empty by default: behind a reverse proxy every request arrives from the
+# proxy's address (often 127.0.0.1), so listing it would open /metrics to all.
+CHAT_METRICS_ALLOWED_IPS = []
+
+# /profile/?seconds=N (staff only) samples the serving worker's stacks every
+# CHAT_PROFILE_INTERVAL seconds for at most CHAT_PROFILE_MAX_SECONDS.
+CHAT_PROFILE_INTERVAL = 0.005
+CHAT_PROFILE_MAX_SECONDS = 60
+
+# Event-loop and sync-executor monitoring (chat_app.monitoring). A loop blocked
+# for more than CHAT_LOOP_LAG_THRESHOLD seconds, or a sync call that waited more
+# than CHAT_EXECUTOR_WAIT_THRESHOLD seconds for a thread, is logged with the
+# stack of what was running.
+CHAT_LOOP_MONITOR = True
+CHAT_LOOP_MONITOR_INTERVAL = 0.1
+CHAT_LOOP_LAG_THRESHOLD = 0.25
+CHAT_EXECUTOR_WAIT_THRESHOLD = 0.5
+
+# Threads for the consumer's and message writer's ORM calls. Unset, they all
+# share Channels' single thread-sensitive thread. Sized per deployment through
+# the environment, e.g. CHAT_SYNC_THREADS=8 (keep it within the database's
+# connection limit: each thread holds a connection).
+CHAT_SYNC_THREADS = int(os.environ['CHAT_SYNC_THREADS']) if os.environ.get('CHAT_SYNC_THREADS') else None
+
+# Message inserts from the write-behind writer run on one dedicated thread
+# (chat_app.monitoring.get_write_executor) instead of the shared ORM threads.
+CHAT_DB_WRITER_THREAD = False
+
+# Tuned SQLite profile, opt in with CHAT_SQLITE_TUNED=1:
+# - WAL journaling lets reads proceed while a write commits;
+# - synchronous=NORMAL fsyncs at checkpoints rather than on every commit (a
+#   power loss can lose the last commits, never corrupt the database);
+# - a 64 MB page cache and 256 MB memory map keep hot pages out of read();
+# - BEGIN IMMEDIATE takes the write lock up front, so writers queue on the
+#   busy timeout instead of failing with "database is locked";
+# - connections persist across requests and ORM calls;
+# - every message insert goes through one writer thread while reads run on
+#   CHAT_SYNC_THREADS threads (4 unless set).
+SQLITE_TUNED_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-65536',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA temp_store=MEMORY',
+)
+
+if os.environ.get('CHAT_SQLITE_TUNED', '').lower() in ('1', 'true', 'yes'):
+    DATABASES['default'].update({
+        'CONN_MAX_AGE': None,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'init_command': ';'.join(SQLITE_TUNED_PRAGMAS),
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+    })
+    CHAT_DB_WRITER_THREAD = True
+    CHAT_SYNC_THREADS = CHAT_SYNC_THREADS or 4
+
+# Retention: messages older than a room's retention_days (CHAT_RETENTION_DAYS
+# when unset; None keeps them forever) are moved by `manage.py apply_retention`
+# into compressed per-room, per-month segments under CHAT_ARCHIVE_DIR, deleting
+# CHAT_RETENTION_BATCH_SIZE rows per transaction with CHAT_RETENTION_PAUSE
+# seconds between batches. History reads continue into the archive.
+CHAT_ARCHIVE_DIR = BASE_DIR / 'archive'
+CHAT_RETENTION_DAYS = None
+CHAT_RETENTION_BATCH_SIZE = 500
+CHAT_RETENTION_PAUSE = 0.05
+
+# Message search (chat_app.search) indexes words as HMACs under a key derived
+# from CHAT_SEARCH_KEY, or from SECRET_KEY when unset. Run
+# `manage.py rebuild_search_index` after changing either.
+CHAT_SEARCH_KEY = None
+
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
 
@@ -1,16 +1,83 @@
 const roomName = JSON.parse(document.getElementById('room-name').textContent);
 const username = JSON.parse(document.getElementById('user-username').textContent);
+// Cursor of the oldest rendered message; null once there is nothing older
+let historyCursor = JSON.parse(document.getElementById('history-cursor').textContent);
+
+// Tell the server which messages the page already rendered, so the join
+// only sends what arrived after it
+function newestRenderedCursor() {
+    const rendered = document.querySelectorAll('#chat-log [data-cursor]');
+    return rendered.length ? rendered[rendered.length - 1].dataset.cursor : null;
+}
+
+// Highest per-room sequence number on screen. Reconnects pass it so the
+// server replays only the messages sent while we were away
+let lastSeq = null;
+document.querySelectorAll('#chat-log [data-seq]').forEach(function (el) {
+    noteSeq(parseInt(el.dataset.seq, 10));
+});
+
+function noteSeq(seq) {
+    if (Number.isInteger(seq) && (lastSeq === null || seq > lastSeq)) {
+        lastSeq = seq;
+    }
+}
+
+function socketUrl() {
+    // Follow who is online (chat_app/presence.py)
+    let query = '?presence=1';
+    if (lastSeq !== null) {
+        query += '&last_seq=' + lastSeq;
+    } else {
+        const cursor = newestRenderedCursor();
+        query += cursor ? '&after=' + encodeURIComponent(cursor) : '';
+    }
+    return 'ws://'
+        + window.location.host
+        + '/ws/chat/'
+        + roomName
+        + '/'
+        + query;
+}
+
+// Wire protocol (see chat_app/wire.py). Set localStorage chat_wire=json to
+// stay on JSON frames, e.g. while inspecting traffic in dev tools
+const WIRE_BINARY = 'chat.bin.v1';
+const WIRE_JSON = 'chat.json.v1';
+const useBinaryWire = localStorage.getItem('chat_wire') !== 'json';
+const textEncoder = new TextEncoder();
+const textDecoder = new TextDecoder();
+// Per-connection user id -> username, filled by USER frames
+let wireUsers = new Map();
+
+let chatSocket = null;
+let reconnectAttempts = 0;
+// Sent but not yet acked, by client_msg_id; resent after a reconnect
+const pendingSends = new Map();
+
+function newClientMsgId() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+}
 
-const chatSocket = new WebSocket(
-    'ws://'
-    + window.location.host
-    + '/ws/chat/'
-    + roomName
-    + '/'
-);
+function connect() {
+    // Offer the compact binary protocol first; the server falls back to JSON
+    chatSocket = new WebSocket(socketUrl(), useBinaryWire ? [WIRE_BINARY, WIRE_JSON] : undefined);
+    chatSocket.binaryType = 'arraybuffer';
+    wireUsers = new Map();
+    chatSocket.onopen = onSocketOpen;
+    chatSocket.onclose = onSocketClose;
+    chatSocket.onmessage = onSocketMessage;
+}
 
 const chatLog = document.getElementById('chat-log');
 const typingIndicator = document.getElementById('typing-indicator');
+const presenceLabel = document.getElementById('presence');
+// Usernames online in the room, or null when it is too big to be listed
+let onlineUsers = null;
+let heartbeatTimer = null;
 
 // Notification Setup
 const notificationCheckbox = document.getElementById('notification-checkbox');
@@ -52,49 +119,54 @@ notificationCheckbox.addEventListener('change', function () {
     }
 });
 
-chatSocket.onopen = function (e) {
+function onSocketOpen(e) {
     console.log('Chat socket connected');
+    reconnectAttempts = 0;
     document.querySelector('.status-indicator').textContent = 'Connected';
     document.querySelector('.status-indicator').classList.add('connected');
-};
+    // Retry sends that were never acked; the server drops any it already stored
+    pendingSends.forEach(function (payload) {
+        sendEvent(payload);
+    });
+}
 
-chatSocket.onclose = function (e) {
+function onSocketClose(e) {
     console.error('Chat socket closed unexpectedly');
+    clearInterval(heartbeatTimer);
     document.querySelector('.status-indicator').textContent = 'Disconnected';
     document.querySelector('.status-indicator').classList.remove('connected');
-};
+    if (e.code === 4004) {
+        return;  // the room doesn't exist; retrying won't help
+    }
+    // Exponential backoff with jitter, so a server restart isn't met by every
+    // client reconnecting in the same instant
+    const delay = Math.min(30000, 500 * 2 ** reconnectAttempts) * (0.5 + Math.random() / 2);
+    reconnectAttempts += 1;
+    setTimeout(connect, delay);
+}
 
-chatSocket.onmessage = function (e) {
-    const data = JSON.parse(e.data);
+function onSocketMessage(e) {
+    const data = typeof e.data === 'string' ? JSON.parse(e.data) : decodeFrame(e.data);
+    if (data === null) {
+        return;  // a USER frame; it only updates the id table
+    }
 
     if (data.type === 'chat_message') {
         const message = data.message;
         const sender = data.username;
         const isMe = sender === username;
 
-        const wrapper = document.createElement('div');
-        wrapper.className = `message-wrapper ${isMe ? 'sent' : 'received'}`;
-
-        const bubble = document.createElement('div');
-        bubble.className = 'message-bubble';
-
-        const userDisplay = document.createElement('small');
-        userDisplay.className = 'message-user';
-        userDisplay.textContent = sender;
-
-        const content = document.createElement('p');
-        content.textContent = message;
-
-        const time = document.createElement('span');
-        time.className = 'message-time';
-        time.textContent = new Date().toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
-
-        bubble.appendChild(userDisplay);
-        bubble.appendChild(content);
-        bubble.appendChild(time);
-        wrapper.appendChild(bubble);
-
-        chatLog.appendChild(wrapper);
+        if (data.seq != null && lastSeq !== null && data.seq <= lastSeq
+                && chatLog.querySelector(`[data-seq="${data.seq}"]`)) {
+            return;  // already shown by a replay
+        }
+        if (data.seq != null && lastSeq !== null && data.seq > lastSeq + 1) {
+            // Missed something (e.g. dropped while reconnecting); fetch the gap
+            sendResume(lastSeq);
+        }
+        const timestamp = data.timestamp ? new Date(data.timestamp) : new Date();
+        insertBySeq(buildMessage(sender, message, timestamp, data.id, data.cursor, data.seq));
+        noteSeq(data.seq);
         scrollToBottom();
 
         // Remove typing indicator if the message is from the person typing
@@ -117,15 +189,31 @@ chatSocket.onmessage = function (e) {
             showNotification(`New message from ${sender}`, message);
         }
 
+    } else if (data.type === 'typing_state') {
+        // Aggregated snapshot of everyone typing in the room (includes us)
+        renderTyping(data.typing.filter((user) => user !== username));
     } else if (data.type === 'typing') {
         if (data.username !== username) {
             handleTyping(data.username, data.is_typing);
         }
+    } else if (data.type === 'presence') {
+        updatePresence(data);
+    } else if (data.type === 'history' && data.resume) {
+        mergeReplay(data);
+    } else if (data.type === 'history' && data.initial) {
+        appendHistory(data);
+    } else if (data.type === 'history') {
+        prependHistory(data);
+    } else if (data.type === 'history_skipped') {
+        retryHistory(data);
     } else if (data.type === 'ack') {
         console.log('Message delivered:', data.message);
+        pendingSends.delete(data.client_msg_id);
         // Could update UI to show "Delivered"
     }
-};
+}
+
+connect();
 
 document.querySelector('#chat-message-input').focus();
 document.querySelector('#chat-message-input').onkeyup = function (e) {
@@ -140,10 +228,16 @@ document.querySelector('#chat-message-submit').onclick = function (e) {
 
     if (message.trim() === "") return;
 
-    chatSocket.send(JSON.stringify({
+    const clientMsgId = newClientMsgId();
+    const payload = {
         'type': 'chat_message',
-        'message': message
-    }));
+        'message': message,
+        'client_msg_id': clientMsgId
+    };
+    pendingSends.set(clientMsgId, payload);
+    if (chatSocket.readyState === WebSocket.OPEN) {
+        sendEvent(payload);
+    }
     messageInputDom.value = '';
 
     // Stop typing immediately when sent
@@ -153,37 +247,292 @@ document.querySelector('#chat-message-submit').onclick = function (e) {
 // Typing Indicators
 let typingTimer;
 let typingUser = null;
+let typingSentAt = 0;
 const doneTypingInterval = 2000;
+// The server keeps typing state alive for a few seconds, so while typing
+// continuously we only need to refresh it now and then, not per keystroke
+const typingRefreshInterval = 1000;
 const input = document.getElementById('chat-message-input');
 
 input.addEventListener('input', () => {
-    sendTypingStatus(true);
+    if (Date.now() - typingSentAt > typingRefreshInterval) {
+        sendTypingStatus(true);
+    }
     clearTimeout(typingTimer);
     typingTimer = setTimeout(() => sendTypingStatus(false), doneTypingInterval);
 });
 
 function sendTypingStatus(isTyping) {
+    typingSentAt = isTyping ? Date.now() : 0;
     if (chatSocket.readyState === WebSocket.OPEN) {
-        chatSocket.send(JSON.stringify({
+        sendEvent({
             'type': 'typing',
             'is_typing': isTyping
-        }));
+        });
+    }
+}
+
+// A snapshot on connect, then batched joined/left diffs (see chat_app/presence.py)
+function updatePresence(data) {
+    if (data.online) {
+        onlineUsers = new Set(data.online);
+    } else if (data.truncated) {
+        onlineUsers = null;
+    } else if (onlineUsers !== null) {
+        (data.joined || []).forEach((user) => onlineUsers.add(user));
+        (data.left || []).forEach((user) => onlineUsers.delete(user));
+    }
+    presenceLabel.textContent = `${data.count} online`;
+    presenceLabel.title = onlineUsers !== null ? Array.from(onlineUsers).sort().join(', ') : '';
+
+    if (data.heartbeat) {
+        // Without any frame for a while the server counts us as gone
+        clearInterval(heartbeatTimer);
+        heartbeatTimer = setInterval(function () {
+            if (chatSocket.readyState === WebSocket.OPEN) {
+                chatSocket.send(JSON.stringify({'type': 'heartbeat'}));
+            }
+        }, data.heartbeat * 1000);
     }
 }
 
 function handleTyping(user, isTyping) {
-    if (isTyping) {
-        typingIndicator.innerHTML = `<span class="typing-text">${user} is typing</span>
-                                     <div class="typing-dots">
-                                        <span></span>
-                                        <span></span>
-                                        <span></span>
-                                     </div>`;
-        typingUser = user;
-    } else {
+    renderTyping(isTyping ? [user] : []);
+}
+
+function renderTyping(users) {
+    if (users.length === 0) {
         typingIndicator.textContent = '';
         typingUser = null;
+        return;
+    }
+    const text = document.createElement('span');
+    text.className = 'typing-text';
+    text.textContent = users.length === 1
+        ? `${users[0]} is typing`
+        : `${users.slice(0, 3).join(', ')}${users.length > 3 ? ' and others' : ''} are typing`;
+
+    const dots = document.createElement('div');
+    dots.className = 'typing-dots';
+    for (let i = 0; i < 3; i++) {
+        dots.appendChild(document.createElement('span'));
+    }
+
+    typingIndicator.replaceChildren(text, dots);
+    typingUser = users.length === 1 ? users[0] : null;
+}
+
+function buildMessage(sender, message, timestamp, id, cursor, seq) {
+    const wrapper = document.createElement('div');
+    wrapper.className = `message-wrapper ${sender === username ? 'sent' : 'received'}`;
+    if (id !== undefined) {
+        wrapper.dataset.id = id;
+    }
+    if (cursor !== undefined) {
+        wrapper.dataset.cursor = cursor;
+    }
+    if (seq != null) {
+        wrapper.dataset.seq = seq;
+    }
+
+    const bubble = document.createElement('div');
+    bubble.className = 'message-bubble';
+
+    const userDisplay = document.createElement('small');
+    userDisplay.className = 'message-user';
+    userDisplay.textContent = sender;
+
+    const content = document.createElement('p');
+    content.textContent = message;
+
+    const time = document.createElement('span');
+    time.className = 'message-time';
+    time.textContent = timestamp.toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
+
+    bubble.appendChild(userDisplay);
+    bubble.appendChild(content);
+    bubble.appendChild(time);
+    wrapper.appendChild(bubble);
+    return wrapper;
+}
+
+// History paging (keyset cursors, see chat_app/history.py)
+const loadOlderButton = document.getElementById('load-older');
+
+loadOlderButton.onclick = function () {
+    if (historyCursor && chatSocket.readyState === WebSocket.OPEN) {
+        loadOlderButton.disabled = true;
+        chatSocket.send(JSON.stringify({
+            'type': 'fetch_history',
+            'before': historyCursor
+        }));
+    }
+};
+
+function prependHistory(page) {
+    // Keep the visible messages in place while older ones are inserted above
+    const previousHeight = chatLog.scrollHeight;
+    const fragment = document.createDocumentFragment();
+    page.messages.forEach(function (item) {
+        fragment.appendChild(buildMessage(item.username, item.message, new Date(item.timestamp), item.id, item.cursor, item.seq));
+    });
+    chatLog.insertBefore(fragment, chatLog.firstChild);
+    chatLog.scrollTop += chatLog.scrollHeight - previousHeight;
+
+    historyCursor = page.has_more ? page.before : null;
+    loadOlderButton.hidden = !historyCursor;
+    loadOlderButton.disabled = false;
+}
+
+// The server dropped a history page because we were falling behind; ask
+// again once the backlog has had a moment to drain
+function retryHistory(notice) {
+    if (notice.before !== undefined && notice.before !== null) {
+        loadOlderButton.disabled = false;
+        return;  // an older page: the button is there to try again
+    }
+    setTimeout(function () {
+        if (notice.resume) {
+            sendResume(notice.last_seq);
+        } else if (notice.initial) {
+            // Everything newer than what is on screen (all of it on a fresh page)
+            sendResume(lastSeq !== null ? lastSeq : 0);
+        }
+    }, 1000);
+}
+
+function appendHistory(page) {
+    // Messages sent while the page was loading; skip any already on screen
+    page.messages.forEach(function (item) {
+        if (!chatLog.querySelector(`[data-id="${item.id}"]`)) {
+            chatLog.appendChild(buildMessage(item.username, item.message, new Date(item.timestamp), item.id, item.cursor, item.seq));
+        }
+        noteSeq(item.seq);
+    });
+    scrollToBottom();
+}
+
+function sendEvent(payload) {
+    if (chatSocket.protocol === WIRE_BINARY
+            && (payload.type === 'chat_message' || payload.type === 'typing')) {
+        chatSocket.send(encodeFrame(payload));
+    } else {
+        chatSocket.send(JSON.stringify(payload));
+    }
+}
+
+function encodeFrame(payload) {
+    const bytes = [];
+    function varint(value) {
+        while (value > 0x7f) {
+            bytes.push((value & 0x7f) | 0x80);
+            value = Math.floor(value / 128);
+        }
+        bytes.push(value);
+    }
+    function str(text) {
+        const data = textEncoder.encode(text || '');
+        varint(data.length);
+        for (let i = 0; i < data.length; i++) {
+            bytes.push(data[i]);
+        }
+    }
+    if (payload.type === 'chat_message') {
+        bytes.push(0x10, 0);  // SEND, no user ids
+        str(payload.client_msg_id);
+        str(payload.message);
+    } else {
+        bytes.push(0x11, 0);  // TYPING
+        varint(payload.is_typing ? 1 : 0);
+    }
+    return new Uint8Array(bytes);
+}
+
+// Returns an event shaped like its JSON form, or null for USER frames
+function decodeFrame(buffer) {
+    const bytes = new Uint8Array(buffer);
+    let pos = 1;
+    function varint() {
+        let value = 0;
+        let scale = 1;
+        let byte;
+        do {
+            byte = bytes[pos++];
+            value += (byte & 0x7f) * scale;
+            scale *= 128;
+        } while (byte & 0x80);
+        return value;
+    }
+    function str() {
+        const length = varint();
+        const text = textDecoder.decode(bytes.subarray(pos, pos + length));
+        pos += length;
+        return text;
+    }
+    const tag = bytes[0];
+    const ids = [];
+    for (let count = varint(); count > 0; count--) {
+        ids.push(varint());
+    }
+    if (tag === 0x01) {  // CHAT
+        const seq = varint();
+        const id = varint();
+        const micros = varint();
+        return {
+            'type': 'chat_message',
+            'username': wireUsers.get(ids[0]),
+            'seq': seq || null,
+            'id': id || undefined,
+            'cursor': id ? `${micros}-${id}` : undefined,
+            'timestamp': micros ? new Date(micros / 1000).toISOString() : null,
+            'message': str()
+        };
+    } else if (tag === 0x02) {  // USER
+        wireUsers.set(ids[0], str());
+    } else if (tag === 0x03) {  // ACK
+        const seq = varint();
+        return {'type': 'ack', 'seq': seq || null, 'client_msg_id': str() || undefined};
+    } else if (tag === 0x04) {  // TYPING_STATE
+        return {'type': 'typing_state', 'typing': ids.map((id) => wireUsers.get(id))};
+    }
+    return null;
+}
+
+function sendResume(seq) {
+    if (chatSocket.readyState === WebSocket.OPEN) {
+        chatSocket.send(JSON.stringify({
+            'type': 'resume',
+            'last_seq': seq
+        }));
+    }
+}
+
+// Place a message by sequence number, so gap fills land before newer
+// messages that arrived live in the meantime
+function insertBySeq(wrapper) {
+    const seq = parseInt(wrapper.dataset.seq, 10);
+    if (Number.isInteger(seq)) {
+        const later = Array.from(chatLog.querySelectorAll('[data-seq]'))
+            .find((el) => parseInt(el.dataset.seq, 10) > seq);
+        if (later) {
+            chatLog.insertBefore(wrapper, later);
+            return;
+        }
+    }
+    chatLog.appendChild(wrapper);
+}
+
+function mergeReplay(page) {
+    page.messages.forEach(function (item) {
+        if (!chatLog.querySelector(`[data-seq="${item.seq}"]`)) {
+            insertBySeq(buildMessage(item.username, item.message, new Date(item.timestamp), item.id, item.cursor, item.seq));
+        }
+        noteSeq(item.seq);
+    });
+    if (page.has_more && page.messages.length) {
+        sendResume(page.messages[page.messages.length - 1].seq);
     }
+    scrollToBottom();
 }
 
 function scrollToBottom() {